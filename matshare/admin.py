@@ -18,6 +18,7 @@ from django.contrib.auth.forms import (
 from django.contrib.auth.views import redirect_to_login
 from django.core.exceptions import PermissionDenied, ValidationError
 from django.shortcuts import get_object_or_404, redirect, render
+from django.template.defaultfilters import filesizeformat
 from django.urls import path
 from django.utils import timezone
 from django.utils.html import format_html
@@ -527,21 +528,71 @@ class MaterialBuildAdmin(rules_admin.ObjectPermissionsModelAdmin):
         "format",
         "revision",
         "status",
+        "priority",
         "error_message",
         "date_created",
+        "date_started",
         "date_done",
+        "wait_duration",
+        "build_duration",
+        "phase_durations",
+        "get_peak_rss",
+        "get_output_size",
+        "output_files",
     )
     readonly_fields = fields
-    list_display = ("course", "format", "get_short_revision", "status", "date_created")
-    list_filter = ("format", "status")
+    list_display = (
+        "course",
+        "format",
+        "get_short_revision",
+        "status",
+        "priority",
+        "date_created",
+        "wait_duration",
+        "build_duration",
+        "get_peak_rss",
+        "get_output_size",
+    )
+    list_filter = ("format", "status", "priority")
     ordering = ("-date_created",)
     search_fields = ("course__name", "revision")
+    change_list_template = "admin/material_build/change_list.html"
+
+    def changelist_view(self, request, extra_context=None):
+        extra_context = {
+            "queue_stats": MaterialBuild.objects.get_queue_stats(),
+            "telemetry_stats": MaterialBuild.objects.get_telemetry_stats(limit=20),
+            **(extra_context or {}),
+        }
+        return super().changelist_view(request, extra_context)
+
+    def get_output_size(self, obj):
+        return None if obj.output_size is None else filesizeformat(obj.output_size)
+
+    get_output_size.short_description = _("output size")
+
+    def get_peak_rss(self, obj):
+        return None if obj.peak_rss is None else filesizeformat(obj.peak_rss)
+
+    get_peak_rss.short_description = _("peak memory usage")
 
     def get_short_revision(self, obj):
         return obj.revision[:7]
 
     get_short_revision.short_description = _("revision")
 
+    def build_duration(self, obj):
+        return obj.build_duration
+
+    build_duration.short_description = _("build time")
+
+    def wait_duration(self, obj):
+        if obj.status == MaterialBuild.Status.superseded:
+            return None
+        return obj.wait_duration
+
+    wait_duration.short_description = _("wait time")
+
 
 @admin.register(StudyCourse, site=admin_site)
 class StudyCourseAdmin(rules_admin.ObjectPermissionsModelAdmin):
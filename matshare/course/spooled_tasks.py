@@ -1,18 +1,18 @@
+import concurrent.futures
 import datetime
 import logging
 import os
 import posixpath
-import shutil
-import tempfile
+import threading
 
 from django.conf import settings
-from django.db import transaction
+from django.db import connection, transaction
 from django.utils import timezone
 import pygit2
 
 from .. import material_building
 from ..git import utils as git_utils
-from ..models import Course, MaterialBuild
+from ..models import Course, CourseCommit, MaterialBuild, MaterialBundle
 from ..spooled_tasks import spooled_task
 
 
@@ -20,114 +20,190 @@ LOGGER = logging.getLogger(__name__)
 
 
 @spooled_task(at=datetime.timedelta(seconds=1), retry_count=3, retry_timeout=10)
-def spooled_build_material(build_pk):
-    """Performs material building for :class:`MaterialBuild` with given pk."""
-    qs = (
-        MaterialBuild.objects.with_prefetching().filter(pk=build_pk)
-        # Lock the MaterialBuild object until the transaction ends
-        .select_for_update(of=("self",))
-    )
+def spooled_run_material_builds():
+    """Runs queued material builds until there are none left to run.
 
-    # Ensure we are the first one trying to build this
-    with transaction.atomic():
-        build = qs.get()
-        if build.status != MaterialBuild.Status.waiting:
-            LOGGER.warning("MaterialBuild already locked: %r", build)
-            return
-        build.status = MaterialBuild.Status.building
-        build.save()
-
-    # Now, no one else will start building this
-    LOGGER.info("Building material: %r", build)
+    This is spooled whenever a :class:`MaterialBuild` is created. Which build runs
+    next is decided by :meth:`MaterialBuildQuerySet.claim_next`, hence spooler
+    processes finding nothing left to do just return. Up to
+    ``MS_MATERIAL_BUILD_WORKERS`` builds are run in parallel threads.
+    """
+    workers = settings.MS_MATERIAL_BUILD_WORKERS
+    if workers == 1:
+        _run_material_builds()
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_run_material_builds) for _ in range(workers)]
+    for future in futures:
+        future.result()
+
+
+def _run_material_builds():
+    try:
+        while True:
+            build = MaterialBuild.objects.claim_next()
+            if build is None:
+                return
+            LOGGER.info(
+                "Building material after waiting %s: %r", build.wait_duration, build
+            )
+            try:
+                _build_material(build)
+            finally:
+                build.release_lock()
+            LOGGER.info("Built material in %s: %r", build.build_duration, build)
+    finally:
+        if threading.current_thread() is not threading.main_thread():
+            # Django doesn't clean up connections of threads it didn't start
+            connection.close()
+
+
+def _build_material(build):
+    """Performs material building for a :class:`MaterialBuild` claimed already."""
     with transaction.atomic():
-        build = qs.get()
         try:
             builder = getattr(material_building, "build_" + build.format.name)
-            # Not create the final directory, so that shutil.copytree() can be used
-            try:
-                os.makedirs(os.path.dirname(build.absolute_path))
-            except FileExistsError:
-                pass
-            # Pull the edited material into a temporary directory as scratchpad
-            repo = pygit2.Repository(build.course.absolute_repository_path)
-            browser = git_utils.ContentBrowser(repo, settings.MS_GIT_MAIN_REF)
-            with tempfile.TemporaryDirectory() as tmpdir:
-                # Create an inner working directory because matuc sometimes pollutes
-                # the parent directory
-                scratchdir = os.path.join(tmpdir, "build")
-                os.makedirs(scratchdir)
-                browser.write_to_fs(scratchdir, settings.MS_GIT_EDIT_SUBDIR)
-                os.chdir(scratchdir)
+            # Bring the persistent workspace to the revision to build, re-using
+            # outputs and caches of the previous build
+            repo = git_utils.open_repository(build.course.absolute_repository_path)
+            with material_building.BuildWorkspace(
+                build.absolute_workspace_path
+            ) as workspace:
+                with build.record_phase("update_workspace"):
+                    chapters = workspace.update(repo, build.revision)
                 # Open another transaction block so that Django can roll back and
                 # leave in a clean state if anything goes wrong, still allowing to
                 # mark the build failed
                 with transaction.atomic():
-                    builder(build)
-            # Ensure the build results directory exists
-            try:
-                os.makedirs(build.absolute_path)
-            except FileExistsError:
-                pass
-            # Fix permissions that were preserved from temporary directory
-            os.chmod(build.absolute_path, 0o755)
+                    builder(build, workspace.build_dir, chapters)
+                workspace.finish(build.revision)
         except Exception as err:
             build.status = MaterialBuild.Status.failed
             build.error_message = repr(err)
             LOGGER.exception("Failed to build material: %r", build)
         else:
             build.status = MaterialBuild.Status.completed
+            # Download archives including this material might be complete now
+            transaction.on_commit(lambda: _spool_material_archives(build))
         finally:
             build.date_done = timezone.now()
             build.save()
 
 
+def _spool_material_archives(build):
+    """Spool creation of all download archives the given build is part of."""
+    course = build.course
+    spooled_build_material_archive(course.pk, build.format.value, False)
+    if course.sub_courses.exists():
+        spooled_build_material_archive(course.pk, build.format.value, True)
+    for super_course_pk in course.super_courses.values_list("pk", flat=True):
+        spooled_build_material_archive(super_course_pk, build.format.value, True)
+
+
+@spooled_task(at=datetime.timedelta(seconds=1), retry_count=3, retry_timeout=10)
+def spooled_build_material_archive(course_pk, format, include_sub_courses):
+    """Creates the cached download archive of a :class:`MaterialBundle`.
+
+    Nothing is done if the archive exists already, isn't needed because the bundle
+    is just a single file or not all builds have completed yet. The last build to
+    complete spools this again.
+    """
+    try:
+        course = Course.objects.select_related("study_course", "term", "type").get(
+            pk=course_pk
+        )
+    except Course.DoesNotExist:
+        return
+    bundle = MaterialBundle(course, MaterialBuild.Format(format), include_sub_courses)
+    if os.path.isfile(bundle.absolute_archive_path):
+        return
+    builds = bundle.get_builds(create=False)
+    if builds is None or not builds and not bundle.static_courses:
+        return
+    if any(build.status != MaterialBuild.Status.completed for build in builds):
+        return
+    if bundle.get_single_file(builds) is not None:
+        return
+    bundle.write_archive(builds)
+
+
+@spooled_task(at=datetime.timedelta(seconds=1), retry_count=3, retry_timeout=10)
+def spooled_index_course_commits(course_pk):
+    """Brings the commit index of a course up to date with its main reference.
+
+    This is spooled whenever the main reference has changed. Tasks spooled for an
+    outdated state of the reference just find nothing left to index.
+    """
+    CourseCommit.objects.index_main_ref(Course.objects.get(pk=course_pk))
+
+
 @spooled_task(at=datetime.timedelta(seconds=1), retry_count=3, retry_timeout=10)
 def spooled_import_course_repository(src_course_pk, dest_course_pk):
-    """Updates the repository of a course with the contents of another one."""
+    """Updates the repository of a course with the contents of another one.
+
+    The course is only locked for recording the new revision, committing is safe
+    against concurrent changes of the repository on its own. Should the main
+    reference have been moved further meanwhile, the newer revision is recorded.
+    """
+    dest_course = Course.objects.get(pk=dest_course_pk)
+    src_course = Course.objects.get(pk=src_course_pk)
+    src_repo = git_utils.open_repository(src_course.absolute_repository_path)
+    dest_repo = git_utils.open_repository(dest_course.absolute_repository_path)
+    browser = git_utils.ContentBrowser(dest_repo, settings.MS_GIT_MAIN_REF)
+    browser.add_from_other_repo(
+        src_repo,
+        settings.MS_GIT_MAIN_REF,
+        exclude=(
+            # Don't copy the matuc config
+            posixpath.normpath(
+                posixpath.join(
+                    settings.MS_GIT_EDIT_SUBDIR, settings.MS_MATUC_CONFIG_FILE
+                )
+            ),
+        ),
+    )
+    commit_id = browser.commit(
+        git_utils.create_admin_signature(),
+        f"Import from {src_course}",
+        settings.MS_GIT_MAIN_REF,
+    )
+    spooled_index_course_commits(dest_course_pk)
     with transaction.atomic():
         dest_course = Course.objects.select_for_update(of=("self",)).get(
             pk=dest_course_pk
         )
-        src_course = Course.objects.get(pk=src_course_pk)
-        src_repo = pygit2.Repository(src_course.absolute_repository_path)
-        dest_repo = pygit2.Repository(dest_course.absolute_repository_path)
-        browser = git_utils.ContentBrowser(dest_repo, settings.MS_GIT_MAIN_REF)
-        browser.add_from_other_repo(
-            src_repo,
-            settings.MS_GIT_MAIN_REF,
-            exclude=(
-                # Don't copy the matuc config
-                posixpath.normpath(
-                    posixpath.join(
-                        settings.MS_GIT_EDIT_SUBDIR, settings.MS_MATUC_CONFIG_FILE
-                    )
-                ),
-            ),
+        # Update revisions to trigger builds and editor notifications, unless a
+        # push recorded while committing was newer
+        dest_course.mark_material_updated(
+            dest_course.get_revision_to_mark(
+                commit_id.hex, dest_course.material_revision
+            )
         )
-        commit_id = browser.commit(
-            git_utils.create_admin_signature(),
-            f"Import from {src_course}",
-            settings.MS_GIT_MAIN_REF,
+        dest_course.mark_sources_updated(
+            dest_course.get_revision_to_mark(
+                commit_id.hex, dest_course.sources_revision
+            )
         )
-        # Update revisions to trigger builds and editor notifications
-        dest_course.mark_material_updated(commit_id.hex)
-        dest_course.mark_sources_updated(commit_id.hex)
         dest_course.save()
 
 
 @spooled_task(at=datetime.timedelta(seconds=1), retry_count=3, retry_timeout=10)
 def spooled_update_matuc_config(course_pk):
-    """Updates matuc configuration file in repository if its content has changed."""
+    """Updates matuc configuration file in repository if its content has changed.
+
+    The course stays locked while committing, so that concurrent metadata updates
+    are committed in order. Other changes of the repository don't wait for it.
+    """
     with transaction.atomic():
         course = Course.objects.select_for_update(of=("self",)).get(pk=course_pk)
         content = course.generate_matuc_config()
         config_file = posixpath.normpath(
             posixpath.join(settings.MS_GIT_EDIT_SUBDIR, settings.MS_MATUC_CONFIG_FILE)
         )
-        repo = pygit2.Repository(course.absolute_repository_path)
-        browser = git_utils.ContentBrowser(repo, settings.MS_GIT_MAIN_REF)
+        repo = git_utils.open_repository(course.absolute_repository_path)
+        editor = git_utils.TreeEditor(repo, settings.MS_GIT_MAIN_REF)
         try:
-            existing_id = browser[config_file].id
+            existing_id = editor[config_file].id
         except KeyError:
             # File wasn't present
             pass
@@ -135,12 +211,13 @@ def spooled_update_matuc_config(course_pk):
             if existing_id == pygit2.hash(content):
                 # File is unchanged
                 return
-        browser.add_from_bytes(config_file, content)
-        commit_id = browser.commit(
+        editor.add_from_bytes(config_file, content)
+        commit_id = editor.commit(
             git_utils.create_admin_signature(),
             "Updated metadata",
             settings.MS_GIT_MAIN_REF,
         )
+        spooled_index_course_commits(course_pk)
         # Update revision to trigger builds
         course.mark_material_updated(commit_id.hex)
         course.save()
@@ -37,6 +37,11 @@ urlpatterns = [
         views.MaterialHTMLView.as_view(),
         name="course_material_html",
     ),
+    path(
+        f"{SLUG_PATH}/material/revisions/<str:revision>/html/<path:path>",
+        views.MaterialHTMLView.as_view(),
+        name="course_material_html_revision",
+    ),
     # Self-subscription and subscription settings
     path(
         f"{SLUG_PATH}/subscription/",
@@ -1,27 +1,35 @@
-import io
+import hashlib
+import mimetypes
 import os
 import posixpath
-import tempfile
-import zipfile
 
 from django import forms
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.views import redirect_to_login
+from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
+from django.core.paginator import Paginator
 from django.core.validators import RegexValidator
 from django.http import (
-    FileResponse,
     Http404,
+    HttpResponse,
     HttpResponseBadRequest,
     HttpResponseRedirect,
     QueryDict,
+    StreamingHttpResponse,
 )
 from django.shortcuts import get_object_or_404
+from django.utils.cache import (
+    add_never_cache_headers,
+    get_conditional_response,
+    patch_cache_control,
+    patch_vary_headers,
+)
 from django.utils.decorators import method_decorator
 from django.utils.functional import cached_property
-from django.utils.http import urlencode
+from django.utils.http import http_date, urlencode
 from django.utils.translation import gettext_lazy as _
 from django.views.decorators.cache import never_cache
 from django.views.generic import TemplateView, View
@@ -40,11 +48,31 @@ from ..models import (
     CourseStudentSubscription,
     CourseType,
     MaterialBuild,
+    MaterialBundle,
     StudyCourse,
     Term,
 )
-from ..utils import MatShareFilterSet, TypedMultipleValueField
+from ..utils import (
+    MatShareFilterSet,
+    TypedMultipleValueField,
+    negotiate_content_encoding,
+    parse_range_header,
+    serve_file,
+    set_content_disposition,
+    stream_zip,
+)
 from ..views import MatShareViewMixin
+from .spooled_tasks import (
+    spooled_build_material_archive,
+    spooled_index_course_commits,
+)
+
+
+# HTML material is served under revision-specific URLs, hence cache it for a year
+HTML_MATERIAL_MAX_AGE = 365 * 24 * 3600
+# Lookups and listings of source files are cached by commit or tree id and never
+# become stale
+SOURCE_CACHE_SECS = 24 * 3600
 
 
 class SingleCourseViewMixin(SingleObjectMixin):
@@ -90,12 +118,7 @@ class SingleCourseViewMixin(SingleObjectMixin):
         return self.object
 
     def get_queryset(self):
-        return (
-            Course.objects.visible(self.request)
-            .distinct()
-            .with_prefetching()
-            .with_access_level_prefetching()
-        )
+        return Course.objects.visible(self.request).with_prefetching()
 
 
 class CourseDetailViewBase(MatShareViewMixin, SingleCourseViewMixin, TemplateView):
@@ -231,9 +254,7 @@ class DirectoryView(MatShareViewMixin, django_filters.views.FilterView):
     def get_queryset(self):
         return (
             Course.objects.visible(self.request)
-            .distinct()
             .with_prefetching()
-            .with_access_level_prefetching()
             .order_by("name", "type__name", "-term__start_date")
         )
 
@@ -306,105 +327,47 @@ class MaterialDownloadView(MaterialViewBase):
         )
         include_sub_courses = forms.BooleanField(required=False)
 
-    def collect_builds_and_static_courses(self, format, include_sub_courses):
-        """Return :class:`MaterialBuild` objects and courses with static material.
-
-        Two tuples are returned.
-        """
-        builds = []
-        static_courses = []
-        if self.object.is_static:
-            static_courses.append(self.object)
-        elif self.object.material_revision:
-            builds.append(
-                MaterialBuild.objects.with_prefetching().get_or_create(
-                    course=self.object,
-                    format=format,
-                    revision=self.object.material_revision,
-                )[0]
-            )
-        if include_sub_courses:
-            for course in self.object.sub_courses.all():
-                if course.is_static:
-                    static_courses.append(course)
-                elif course.material_revision:
-                    builds.append(
-                        MaterialBuild.objects.with_prefetching().get_or_create(
-                            course=course,
-                            format=format,
-                            revision=course.material_revision,
-                        )[0]
-                    )
-        return tuple(builds), tuple(static_courses)
-
-    def collect_material(self, builds, static_courses):
-        """Return file-like object and filename of the collected material."""
+    def serve_material(self, bundle, builds):
+        """Return a response for downloading the material of ``bundle``."""
         # Try if we could just offer a single file for downloading
-        if len(builds) == 1 and not static_courses:
-            root = builds[0].absolute_path
-            if os.path.isdir(root):
-                items = os.listdir(root)
-                if len(items) == 1 and os.path.isfile(os.path.join(root, items[0])):
-                    return (
-                        open(os.path.join(root, items[0]), "rb"),
-                        builds[0].course.download_name + os.path.splitext(items[0])[1],
-                    )
-        elif not builds and len(static_courses):
-            root = static_courses[0].absolute_static_material_path
-            if os.path.isdir(root):
-                items = os.listdir(root)
-                if len(items) == 1 and os.path.isfile(os.path.join(root, items[0])):
-                    return (
-                        open(os.path.join(root, items[0]), "rb"),
-                        static_courses[0].download_name + os.path.splitext(items[0])[1],
-                    )
+        single_file = bundle.get_single_file(builds)
+        if single_file is not None:
+            path, name = single_file
+            return serve_file(path, filename=name, as_attachment=True)
 
         # We have to collect multiple files into a ZIP archive
-        tmp = tempfile.NamedTemporaryFile(prefix="matshare_material_", suffix=".zip")
-        # ZipFile won't close a file it hasn't opened itself, so tmp will survive
-        with zipfile.ZipFile(tmp, mode="w", compression=zipfile.ZIP_DEFLATED) as zip:
-            zip_root = self.object.download_name
-            # Collect build results
-            for build in builds:
-                for root, dirnames, filenames in os.walk(build.absolute_path):
-                    # Directory inside the ZIP file in which files are placed
-                    zip_dir = posixpath.normpath(
-                        posixpath.join(
-                            zip_root,
-                            build.course.download_name,
-                            os.path.relpath(root, build.absolute_path),
-                        )
-                    )
-                    for filename in filenames:
-                        zip.write(
-                            os.path.join(root, filename),
-                            os.path.join(zip_dir, filename),
-                        )
-            # Collect static material
-            for course in static_courses:
-                for root, dirnames, filenames in os.walk(
-                    course.absolute_static_material_path
-                ):
-                    # Directory inside the ZIP file in which files are placed
-                    zip_dir = posixpath.normpath(
-                        posixpath.join(
-                            zip_root,
-                            course.download_name,
-                            os.path.relpath(root, course.absolute_static_material_path),
-                        )
-                    )
-                    for filename in filenames:
-                        zip.write(
-                            os.path.join(root, filename),
-                            os.path.join(zip_dir, filename),
-                        )
-
-        # Go back to the start of the file after ZipFile has written to it
-        tmp.seek(0)
-
-        # The temporary file will be deleted once .close() is called on it, which the
-        # WSGI file wrapper MUST do due to WSGI spec after the file was fully sent off.
-        return tmp, f"{self.object.download_name}.zip"
+        name = f"{self.object.download_name}.zip"
+        try:
+            stat = os.stat(bundle.absolute_archive_path)
+        except FileNotFoundError:
+            # Not cached yet, so let the spooler create the archive for subsequent
+            # downloads, but only once for all the requests coming in meanwhile
+            if cache.add(f"matshare:material_archive:{bundle.cache_key}", True, 300):
+                spooled_build_material_archive(
+                    self.object.pk, bundle.format.value, bundle.include_sub_courses
+                )
+            # Generate the archive while sending, so that the download starts
+            # immediately
+            response = StreamingHttpResponse(
+                stream_zip(bundle.iter_zip_members(builds)),
+                content_type="application/zip",
+            )
+            set_content_disposition(response, name)
+            return response
+
+        # Serve the cached archive, which can also be validated by clients
+        etag = f'"{bundle.cache_key}"'
+        last_modified = int(stat.st_mtime)
+        response = get_conditional_response(
+            self.request, etag=etag, last_modified=last_modified
+        )
+        if response is None:
+            response = serve_file(
+                bundle.absolute_archive_path, filename=name, as_attachment=True
+            )
+        response["ETag"] = etag
+        response["Last-Modified"] = http_date(last_modified)
+        return response
 
     def get(self, request):
         form = self.DownloadForm(request.GET)
@@ -417,10 +380,9 @@ class MaterialDownloadView(MaterialViewBase):
             format = next(iter(MaterialBuild.Format))
         include_sub_courses = form.cleaned_data.get("include_sub_courses", False)
 
-        builds, static_courses = self.collect_builds_and_static_courses(
-            format, include_sub_courses
-        )
-        if not builds and not static_courses:
+        bundle = MaterialBundle(self.object, format, include_sub_courses)
+        builds = bundle.get_builds()
+        if not builds and not bundle.static_courses:
             # Nothing to download
             raise Http404
 
@@ -454,8 +416,7 @@ class MaterialDownloadView(MaterialViewBase):
                         sub.mark_notified(build.course)
                 sub.save()
 
-        file, name = self.collect_material(builds, static_courses)
-        return FileResponse(file, as_attachment=True, filename=name)
+        return self.serve_material(bundle, builds)
 
 
 class MaterialHTMLView(MaterialViewBase):
@@ -465,34 +426,69 @@ class MaterialHTMLView(MaterialViewBase):
 
     no_static_courses = True
 
-    def get(self, request, path="inhalt.html"):
+    def get(self, request, path="inhalt.html", revision=None):
         # There can be at most one build per course, format and revision
-        build, _ = MaterialBuild.objects.with_prefetching().get_or_create(
-            course=self.object,
-            format=MaterialBuild.Format.html,
-            revision=self.object.material_revision,
-        )
-        if build.status == MaterialBuild.Status.completed:
-            # Great, serve the build result
-            return self.serve_build_result(build, path)
-        return self.build_status_page([build])
+        build = MaterialBuild.objects.request(self.object, MaterialBuild.Format.html)
+        if build.status != MaterialBuild.Status.completed:
+            return self.build_status_page([build])
+        if revision != build.revision:
+            # Files are only served under URLs containing the revision, because
+            # those never change and can hence be cached by the browser forever.
+            # The redirect itself must be revalidated every time.
+            response = HttpResponseRedirect(
+                self.object.urls.reverse(
+                    "course_material_html_revision", revision=build.revision, path=path
+                )
+            )
+            patch_cache_control(response, private=True, no_cache=True)
+            return response
+        # Great, serve the build result
+        return self.serve_build_result(build, path)
 
     def serve_build_result(self, build, rel_path):
         """Serve the requested file relative to the build results directory.
 
-        Non-existent files and paths pointing outside the build results directory
-        are answered by raising a :class:`Http404`.
+        The path is resolved through the build's manifest, hence only files that
+        are part of the build can be accessed. Others are answered by raising a
+        :class:`Http404`.
+
+        Responses carry a content-based ETag, so that browsers revalidating a file
+        of an older revision get a ``304 Not Modified`` if it didn't change.
+        Precompressed variants created during the build are preferred if the client
+        accepts them.
         """
-        build_root = os.path.realpath(build.absolute_path)
-        full_path = os.path.realpath(os.path.join(build_root, rel_path))
-        # Don't allow accessing files outside the build results directory
-        if not full_path.startswith(build_root + os.sep):
-            raise Http404
+        rel_path = posixpath.normpath(rel_path)
         try:
-            return FileResponse(open(full_path, "rb"))
-        except OSError:
-            # File not found, permission denied etc.
+            encodings = build.get_encodings(rel_path)
+            encoding = negotiate_content_encoding(self.request, encodings)
+            etag = build.get_etag(rel_path, encoding)
+            full_path = build.resolve_file(rel_path, encoding)
+        except KeyError:
             raise Http404
+        last_modified = int(build.date_done.timestamp())
+        response = get_conditional_response(
+            self.request, etag=etag, last_modified=last_modified
+        )
+        if response is None:
+            try:
+                # Blobs are stored without extension, so the type is guessed from
+                # the requested file name
+                response = serve_file(
+                    full_path,
+                    filename=posixpath.basename(rel_path),
+                    content_encoding=encoding,
+                )
+            except OSError:
+                # File not found, permission denied etc.
+                raise Http404
+        response["ETag"] = etag
+        response["Last-Modified"] = http_date(last_modified)
+        if encodings:
+            patch_vary_headers(response, ("Accept-Encoding",))
+        patch_cache_control(
+            response, private=True, max_age=HTML_MATERIAL_MAX_AGE, immutable=True
+        )
+        return response
 
 
 class OverviewView(CourseDetailViewBase):
@@ -519,7 +515,6 @@ class OverviewView(CourseDetailViewBase):
         )
 
 
-@method_decorator(never_cache, name="dispatch")
 class SourcesView(CourseDetailViewBase):
     """
     Allows managing source files.
@@ -560,6 +555,8 @@ class SourcesView(CourseDetailViewBase):
     min_access_level = Course.AccessLevel.ro
     no_static_courses = True
     is_course_sources = True
+    # Number of items per page of directory listings
+    paginate_by = 200
 
     def dispatch(self, request, path="", **kwargs):
         """Normalizes and splits the path and stores it as tuple in ``self.path``."""
@@ -567,10 +564,14 @@ class SourcesView(CourseDetailViewBase):
             path = f"/{path}"
         path = posixpath.normpath(path)
         self.path = tuple(part for part in path.split("/") if part)
-        return super().dispatch(request, **kwargs)
+        response = super().dispatch(request, **kwargs)
+        # File downloads set up caching themselves
+        if not response.has_header("Cache-Control"):
+            add_never_cache_headers(response)
+        return response
 
-    def find_node(self, path):
-        """Search the commit under the repository's main reference for a path.
+    def find_node(self, path, committish=settings.MS_GIT_MAIN_REF):
+        """Search a commit, the repository's main reference by default, for a path.
 
         As root for searching, ``MS_GIT_SRC_SUBDIR`` is assumed.
         The ``path`` must be an iterable of path components.
@@ -578,7 +579,7 @@ class SourcesView(CourseDetailViewBase):
         :class:`pygit2.Blob` if it was a file.
         A :class:`KeyError` is raised if the path wasn't found.
         """
-        commit = git_utils.resolve_committish(self.repo, settings.MS_GIT_MAIN_REF)
+        commit = git_utils.resolve_committish(self.repo, committish)
         node = commit.tree / settings.MS_GIT_SRC_SUBDIR
         for part in path:
             if not isinstance(node, pygit2.Tree):
@@ -597,31 +598,128 @@ class SourcesView(CourseDetailViewBase):
                 mkdir_form = self.CreateDirectoryForm()
             if upload_form is None:
                 upload_form = self.UploadForm()
-        # Fetch the requested file or directory from git
-        try:
-            node = self.find_node(self.path)
-        except KeyError:
-            # List empty directory
-            node = ()
-        else:
-            if isinstance(node, pygit2.Blob):
-                # Serve the file contents in browser (Content-Disposition: inline)
-                return FileResponse(io.BytesIO(node.read_raw()), filename=node.name)
-        # Directory listing
-        items = []
-        for item in node:
-            if isinstance(item, pygit2.Blob):
-                items.append({"type": "file", "name": item.name, "size": item.size})
-            elif isinstance(item, pygit2.Tree):
-                items.append({"type": "dir", "name": item.name, "size": None})
+        node_type, node_id = self.lookup_path(self.path)
+        if node_type == "file":
+            return self.serve_blob(request, node_id, self.path[-1])
+        # Missing directories are listed as empty
+        items = () if node_id is None else self.get_listing(node_id)
+        paginator = Paginator(items, self.paginate_by)
+        page = paginator.get_page(request.GET.get("page"))
         return super().get(
             request,
-            items=tuple(items),
+            items=page.object_list,
+            page=page,
             delete_form=delete_form,
             mkdir_form=mkdir_form,
             upload_form=upload_form,
         )
 
+    def get_listing(self, tree_id):
+        """Return the entries of the tree with given id for listing.
+
+        Each entry is a dictionary with ``type`` (``"dir"`` or ``"file"``), ``name``
+        and ``size`` (``None`` for directories). As trees are immutable, the
+        listing is cached by tree id and shared between courses.
+        """
+        cache_key = f"matshare:source_listing:{tree_id}"
+        items = cache.get(cache_key)
+        if items is None:
+            entries = [
+                entry
+                for entry in self.repo[tree_id]
+                if isinstance(entry, (pygit2.Blob, pygit2.Tree))
+            ]
+            # Sizes of all blobs are fetched at once, without loading the blobs
+            sizes = git_utils.get_object_sizes(
+                self.repo,
+                (entry.id for entry in entries if isinstance(entry, pygit2.Blob)),
+            )
+            items = [
+                {"type": "file", "name": entry.name, "size": sizes.get(entry.id.hex)}
+                if isinstance(entry, pygit2.Blob)
+                else {"type": "dir", "name": entry.name, "size": None}
+                for entry in entries
+            ]
+            cache.set(cache_key, items, SOURCE_CACHE_SECS)
+        return items
+
+    def lookup_path(self, path):
+        """Find the directory or file at ``path`` in the current main commit.
+
+        A tuple of the type (``"dir"`` or ``"file"``) and the hex id of the tree or
+        blob is returned, which is ``(None, None)`` if there's nothing at that path.
+        Results are cached per commit, so that repeated requests only read the main
+        reference from the repository, not the object database.
+        """
+        try:
+            commit_id = (
+                self.repo.lookup_reference(settings.MS_GIT_MAIN_REF).resolve().target
+            )
+        except KeyError:
+            return None, None
+        path_hash = hashlib.sha1("/".join(path).encode()).hexdigest()
+        cache_key = f"matshare:source_path:{self.object.pk}:{commit_id.hex}:{path_hash}"
+        result = cache.get(cache_key)
+        if result is None:
+            try:
+                node = self.find_node(path, commit_id)
+            except KeyError:
+                result = (None, None)
+            else:
+                if isinstance(node, pygit2.Blob):
+                    result = ("file", node.id.hex)
+                else:
+                    result = ("dir", node.id.hex)
+            cache.set(cache_key, result, SOURCE_CACHE_SECS)
+        return result
+
+    def serve_blob(self, request, blob_id, filename):
+        """Stream the blob with given id for display in the browser.
+
+        The blob id is used as ETag, hence conditional requests are answered
+        without reading the blob. Single byte ranges are supported as well.
+        """
+        etag = f'"{blob_id}"'
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            try:
+                stream = git_utils.BlobStream(self.repo, blob_id)
+            except KeyError:
+                raise Http404
+            byte_range = None
+            # Ranges are only honoured when the client's copy is still current
+            if request.META.get("HTTP_IF_RANGE", etag) == etag:
+                try:
+                    byte_range = parse_range_header(
+                        request.META.get("HTTP_RANGE"), stream.size
+                    )
+                except ValueError:
+                    stream.close()
+                    response = HttpResponse(status=416)
+                    response["Content-Range"] = f"bytes */{stream.size}"
+                    return response
+            if byte_range is None:
+                response = StreamingHttpResponse(stream)
+            else:
+                start, length = byte_range
+                stream.set_range(start, length)
+                response = StreamingHttpResponse(stream, status=206)
+                response[
+                    "Content-Range"
+                ] = f"bytes {start}-{start + length - 1}/{stream.size}"
+            content_type, encoding = mimetypes.guess_type(filename)
+            if content_type is None or encoding is not None:
+                content_type = "application/octet-stream"
+            response["Content-Type"] = content_type
+            response["Content-Length"] = stream.length
+            response["Accept-Ranges"] = "bytes"
+            # Serve the file contents in browser
+            set_content_disposition(response, filename, as_attachment=False)
+        response["ETag"] = etag
+        # Always revalidate, the file at this path might have changed
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
     def get_context_data(self, **kwargs):
         ctx = super().get_context_data(**kwargs)
         ctx["path"] = "/".join(self.path)
@@ -645,7 +743,7 @@ class SourcesView(CourseDetailViewBase):
 
     def handle_delete(self, delete_form):
         """Handle a valid :class:`DeleteForm` by removing files from git."""
-        browser = git_utils.ContentBrowser(self.repo, settings.MS_GIT_MAIN_REF)
+        editor = git_utils.TreeEditor(self.repo, settings.MS_GIT_MAIN_REF)
         rel_paths = []
         for name in delete_form.cleaned_data["select"]:
             name = posixpath.basename(name)
@@ -654,7 +752,7 @@ class SourcesView(CourseDetailViewBase):
                 continue
             rel_path = posixpath.join(*self.path, name)
             try:
-                browser.remove(posixpath.join(settings.MS_GIT_SRC_SUBDIR, rel_path))
+                editor.remove(posixpath.join(settings.MS_GIT_SRC_SUBDIR, rel_path))
             except KeyError:
                 # Ignore missing items
                 continue
@@ -664,13 +762,30 @@ class SourcesView(CourseDetailViewBase):
             commit_msg = "Sources deleted\n\n" + "\n".join(rel_paths[:10])
             if len(rel_paths) > 10:
                 commit_msg += f"\n... and {len(rel_paths)-10} more"
-            commit_id = browser.commit(
-                self.get_git_signature(), commit_msg, settings.MS_GIT_MAIN_REF
+            try:
+                commit_id = editor.commit(
+                    self.get_git_signature(), commit_msg, settings.MS_GIT_MAIN_REF
+                )
+            except git_utils.RefUpdateFailed:
+                messages.error(
+                    self.request,
+                    _(
+                        "The sources are being changed by others at the moment. "
+                        "Please try again."
+                    ),
+                )
+                return
+            spooled_index_course_commits(self.object.pk)
+            # Lock and refresh only now, because processing might have taken some
+            # time and locking that long is no option
+            self.object = Course.objects.select_for_update(of=("self",)).get(
+                pk=self.object.pk
+            )
+            self.object.mark_sources_updated(
+                self.object.get_revision_to_mark(
+                    commit_id.hex, self.object.sources_revision
+                )
             )
-            # Refresh because processing might have taken some time and locking
-            # that long is no option
-            self.object.refresh_from_db()
-            self.object.mark_sources_updated(commit_id.hex)
             self.object.save()
             messages.success(
                 self.request,
@@ -679,7 +794,7 @@ class SourcesView(CourseDetailViewBase):
 
     def handle_upload(self, upload_form):
         """Handle a valid :class:`UploadForm` by adding files to git."""
-        browser = git_utils.ContentBrowser(self.repo, settings.MS_GIT_MAIN_REF)
+        editor = git_utils.TreeEditor(self.repo, settings.MS_GIT_MAIN_REF)
         rel_paths = []
         for file in upload_form.files.getlist("files"):
             name = posixpath.basename(file.name)
@@ -688,8 +803,8 @@ class SourcesView(CourseDetailViewBase):
                 continue
             rel_path = posixpath.join(*self.path, name)
             rel_paths.append(rel_path)
-            browser.add_from_bytes(
-                posixpath.join(settings.MS_GIT_SRC_SUBDIR, rel_path), file.read()
+            editor.add_from_file(
+                posixpath.join(settings.MS_GIT_SRC_SUBDIR, rel_path), file
             )
         if rel_paths:
             rel_paths.sort()
@@ -699,13 +814,30 @@ class SourcesView(CourseDetailViewBase):
             note = upload_form.cleaned_data.get("note")
             if note:
                 commit_msg += "\n\n" + note
-            commit_id = browser.commit(
-                self.get_git_signature(), commit_msg, settings.MS_GIT_MAIN_REF
+            try:
+                commit_id = editor.commit(
+                    self.get_git_signature(), commit_msg, settings.MS_GIT_MAIN_REF
+                )
+            except git_utils.RefUpdateFailed:
+                messages.error(
+                    self.request,
+                    _(
+                        "The sources are being changed by others at the moment. "
+                        "Please try again."
+                    ),
+                )
+                return
+            spooled_index_course_commits(self.object.pk)
+            # Lock and refresh only now, because uploading might have taken some
+            # time and locking that long is no option
+            self.object = Course.objects.select_for_update(of=("self",)).get(
+                pk=self.object.pk
+            )
+            self.object.mark_sources_updated(
+                self.object.get_revision_to_mark(
+                    commit_id.hex, self.object.sources_revision
+                )
             )
-            # Refresh because uploading might have taken some time and locking
-            # that long is no option
-            self.object.refresh_from_db()
-            self.object.mark_sources_updated(commit_id.hex)
             self.object.save()
             messages.success(
                 self.request,
@@ -764,7 +896,7 @@ class SourcesView(CourseDetailViewBase):
     @cached_property
     def repo(self):
         """Open and cache the course's :class:`pygit2.Repository`."""
-        return pygit2.Repository(self.object.absolute_repository_path)
+        return git_utils.open_repository(self.object.absolute_repository_path)
 
 
 @method_decorator(never_cache, name="dispatch")
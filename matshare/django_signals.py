@@ -7,15 +7,24 @@ import logging
 import os
 
 from django.conf import settings
-from django.db.models.signals import post_delete, post_save
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.dispatch import receiver
 from django.utils import timezone, translation
 import pygit2
 
 from . import utils
-from .course.spooled_tasks import spooled_build_material
+from .course.spooled_tasks import spooled_run_material_builds
 from .git import utils as git_utils
-from .models import Course, MaterialBuild
+from .models import (
+    AccessLevelResolver,
+    Course,
+    CourseEditorSubscription,
+    CourseStudentSubscription,
+    MaterialBuild,
+    SubCourseRelation,
+    User,
+)
 
 
 LOGGER = logging.getLogger(__name__)
@@ -23,9 +32,49 @@ LOGGER = logging.getLogger(__name__)
 
 @receiver(post_save, sender=MaterialBuild)
 def build_material(sender, instance, created, **kwargs):
-    """Spools material building after a new :class:`MaterialBuild` was created."""
-    if created:
-        spooled_build_material(instance.pk)
+    """Spools running the build queue after a :class:`MaterialBuild` was queued.
+
+    That's the case for new builds and those queued again. The spooler must only
+    look at the queue once the build is visible to it.
+    """
+    if instance.status == MaterialBuild.Status.waiting:
+        transaction.on_commit(spooled_run_material_builds)
+
+
+@receiver(post_delete, sender=CourseEditorSubscription)
+@receiver(post_save, sender=CourseEditorSubscription)
+@receiver(post_delete, sender=CourseStudentSubscription)
+@receiver(post_save, sender=CourseStudentSubscription)
+def invalidate_access_levels_of_subscriber(sender, instance, **kwargs):
+    """Drop cached authorization data after a subscription was changed."""
+    AccessLevelResolver.invalidate(instance.user_id)
+
+
+@receiver(post_delete, sender=SubCourseRelation)
+@receiver(post_save, sender=SubCourseRelation)
+def invalidate_access_levels_of_super_course(sender, instance, **kwargs):
+    """Drop cached authorization data of all students inheriting access."""
+    if settings.MS_ACCESS_LEVEL_CACHE_SECS:
+        AccessLevelResolver.invalidate(
+            *CourseStudentSubscription.objects.filter(
+                course=instance.super_course_id
+            ).values_list("user", flat=True)
+        )
+
+
+@receiver(m2m_changed, sender=User.study_courses.through)
+def invalidate_access_levels_of_study_course(
+    sender, instance, action, reverse, pk_set, **kwargs
+):
+    """Drop cached authorization data after courses of study were changed."""
+    if not reverse:
+        if action.startswith("post_"):
+            AccessLevelResolver.invalidate(instance.pk)
+    elif action in ("post_add", "post_remove"):
+        AccessLevelResolver.invalidate(*pk_set)
+    elif action == "pre_clear" and settings.MS_ACCESS_LEVEL_CACHE_SECS:
+        # pk_set isn't provided when clearing, so collect the students beforehand
+        AccessLevelResolver.invalidate(*instance.students.values_list("pk", flat=True))
 
 
 @receiver(post_save, sender=Course)
@@ -81,6 +130,12 @@ def remove_course_directories(sender, instance, **kwargs):
     else:
         dir_to_remove = instance.absolute_repository_path
         clean_up_to = settings.MS_GIT_ROOT
+        # Don't hand out the handle of a removed repository anymore
+        git_utils.REPOSITORY_POOL.invalidate(dir_to_remove)
+        workspaces_dir = instance.absolute_material_build_workspaces_path
+        if os.path.isdir(workspaces_dir):
+            LOGGER.info("Removing directory %r", workspaces_dir)
+            utils.rmtree_and_clean(workspaces_dir, settings.MEDIA_ROOT)
     if not os.path.isdir(dir_to_remove):
         LOGGER.warning("Directory %r doesnn't exist, not removing it", dir_to_remove)
         return
@@ -90,10 +145,4 @@ def remove_course_directories(sender, instance, **kwargs):
 
 @receiver(post_delete, sender=MaterialBuild)
 def remove_material_build_directory(sender, instance, **kwargs):
-    if not os.path.exists(instance.absolute_path):
-        return
-    LOGGER.info("Removing material build directory %r", instance.absolute_path)
-    try:
-        utils.rmtree_and_clean(instance.absolute_path, settings.MEDIA_ROOT)
-    except OSError as err:
-        LOGGER.warning("Failed to remove %r: %r", instance.absolute_path, err)
+    instance.remove_results()
@@ -1,19 +1,45 @@
+import collections
+import concurrent.futures
 import datetime
+import logging
 import os
 import posixpath
+import random
 import re
+import subprocess
+import threading
+import time
 
 from django.conf import settings
 from django.utils import timezone
 import pygit2
 
 
+LOGGER = logging.getLogger(__name__)
+
 # Target of a non-existent reference, for both SHA-1 and upcoming SHA-256
 NULL_REFS = (40 * "0", 64 * "0")
 
+# How often committing is attempted when the target reference changes meanwhile
+COMMIT_ATTEMPTS = 10
+
+# Everything is repacked into a single pack when a repository has more packs
+MAINTENANCE_PACK_LIMIT = 20
+
 # Matches valid SHA-1 or SHA-256 git object ids, lower-case only
 OID_PATTERN = re.compile(r"^(?:[a-f0-9]{40}|[a-f0-9]{64})$")
 
+# Modes of tree entries that can be written to the filesystem, links and commits
+# (submodules) can't
+WRITABLE_FILEMODES = (pygit2.GIT_FILEMODE_BLOB, pygit2.GIT_FILEMODE_BLOB_EXECUTABLE)
+
+
+class RefUpdateFailed(Exception):
+    """
+    Raised when a reference couldn't be updated because it kept changing or the
+    changes made concurrently conflict.
+    """
+
 
 def create_admin_signature():
     """Returns a :class:`pygit2.Signature` object to use for administrative commits."""
@@ -40,34 +66,141 @@ def extract_commit_info(commit):
     }
 
 
+def create_blob_from_file(repo, file):
+    """Store the content of a file object as blob and return its id.
+
+    Files stored on disk, like Django's temporary uploaded files, are streamed
+    into the object database by libgit2, so they're never loaded into memory
+    as a whole. Others are read completely.
+    """
+    try:
+        disk_path = file.temporary_file_path()
+    except AttributeError:
+        return repo.create_blob(file.read())
+    return repo.create_blob_fromdisk(disk_path)
+
+
+def get_object_sizes(repo, object_ids):
+    """Return a dictionary mapping the given object ids to the objects' sizes.
+
+    Only the headers of the objects are read, with ``git cat-file``, because
+    libgit2 would inflate every object completely just to tell its size. Ids of
+    objects that don't exist are left out.
+    """
+    object_ids = [str(object_id) for object_id in object_ids]
+    if not object_ids:
+        return {}
+    proc = subprocess.run(
+        ["git", "--git-dir", repo.path, "cat-file", "--batch-check"],
+        input="".join(f"{object_id}\n" for object_id in object_ids).encode(),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        check=True,
+    )
+    sizes = {}
+    for line in proc.stdout.decode().splitlines():
+        # Either "<oid> <type> <size>" or "<oid> missing"
+        fields = line.split()
+        if len(fields) == 3:
+            sizes[fields[0]] = int(fields[2])
+    return sizes
+
+
+def get_object_stats(path):
+    """Return the output of ``git count-objects -v`` for the repository at ``path``.
+
+    It's a dictionary with keys like ``"count"`` (number of loose objects),
+    ``"packs"`` and ``"size-pack"``. Sizes are converted to bytes.
+    """
+    proc = subprocess.run(
+        ["git", "--git-dir", path, "count-objects", "-v"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        check=True,
+    )
+    stats = {}
+    for line in proc.stdout.decode().splitlines():
+        key, _, value = line.partition(":")
+        # Sizes are given in KiB
+        stats[key] = int(value) * (1024 if key.startswith("size") else 1)
+    return stats
+
+
+def maintain_repository(path):
+    """Pack loose objects and write a commit-graph for the repository at ``path``.
+
+    Loose objects are packed into a new pack incrementally. When there are more than
+    ``MAINTENANCE_PACK_LIMIT`` packs or no reachability bitmap yet, everything is
+    repacked into a single pack with a bitmap instead, which turns unreachable
+    objects of the old packs into loose ones. Unreachable loose objects older than
+    two weeks are pruned, younger ones might be part of a commit or push in
+    progress. Objects are never removed from packs directly. This is safe to do
+    while the repository is in use.
+
+    A dictionary with ``"duration"`` in seconds, ``"size_before"``, ``"size_after"``
+    (sizes of all objects in bytes) and whether a ``"full_repack"`` was done is
+    returned.
+    """
+    start = time.monotonic()
+    stats_before = get_object_stats(path)
+    pack_dir = os.path.join(path, "objects", "pack")
+    full_repack = stats_before["packs"] > MAINTENANCE_PACK_LIMIT or not any(
+        filename.endswith(".bitmap") for filename in os.listdir(pack_dir)
+    )
+    git = ("git", "--git-dir", path)
+    if full_repack:
+        subprocess.run((*git, "repack", "-A", "-d", "-q", "-b"), check=True)
+    elif stats_before["count"]:
+        subprocess.run((*git, "repack", "-d", "-q"), check=True)
+    subprocess.run((*git, "prune", "--expire=2.weeks.ago"), check=True)
+    subprocess.run((*git, "commit-graph", "write", "--reachable"), check=True)
+    stats_after = get_object_stats(path)
+    return {
+        "duration": time.monotonic() - start,
+        "size_before": _get_objects_size(stats_before),
+        "size_after": _get_objects_size(stats_after),
+        "full_repack": full_repack,
+    }
+
+
+def _get_objects_size(stats):
+    return stats["size"] + stats["size-pack"] + stats["size-garbage"]
+
+
+def open_repository(path):
+    """Return a :class:`pygit2.Repository` for ``path`` from :data:`REPOSITORY_POOL`."""
+    return REPOSITORY_POOL.get(path)
+
+
 def paths_changed(commit1, commit2, *paths):
     """Inspects the difference between two commits.
 
     ``commit1`` and ``commit2`` must be of type :class:`pygit2.Commit`.
     For each of the given ``paths``, it yields a boolean telling whether the path
     (or, if it's a directory, a file therein) has changed.
+
+    No diff is computed. Since git objects are content-addressed, comparing the
+    ids and modes of the tree entries found under each path suffices, no matter
+    how large the trees are.
     """
-    diff = commit1.tree.diff_to_tree(commit2.tree)
+    tree1 = commit1.tree
+    tree2 = commit2.tree
     for path in paths:
         path = posixpath.normpath(path)
         # If the repository root was given, any change is sufficient
         if path == ".":
-            try:
-                next(diff.deltas)
-            except StopIteration:
-                yield False
-            else:
-                yield True
+            yield tree1.id != tree2.id
             continue
-        dir_prefix = path + "/"
-        for delta in diff.deltas:
-            if delta.new_file.path == path or delta.new_file.path.startswith(
-                dir_prefix
-            ):
-                yield True
-                break
-        else:
-            yield False
+        yield _tree_entry_key(tree1, path) != _tree_entry_key(tree2, path)
+
+
+def _tree_entry_key(tree, path):
+    """Return ``(id, filemode)`` of the entry at ``path`` or ``None`` if missing."""
+    try:
+        node = tree[path]
+    except KeyError:
+        return None
+    return node.id, node.filemode
 
 
 def resolve_committish(repo, committish):
@@ -96,6 +229,98 @@ def resolve_committish(repo, committish):
     raise TypeError(f"committish must be string, Oid or Reference, not {committish!r}")
 
 
+def write_tree_to_fs(tree, dest_dir, jobs=None):
+    """Write the files of :class:`pygit2.Tree` ``tree`` to the directory ``dest_dir``.
+
+    Only the given tree is traversed and each directory is created once. Blobs are
+    read here, while writing them out is done by up to ``jobs`` threads (the
+    default of :class:`concurrent.futures.ThreadPoolExecutor` if not given). Links
+    and submodules are skipped, existing files are overwritten.
+    """
+    # Don't keep more blobs in memory than the threads can write
+    pending = threading.BoundedSemaphore(4 * (jobs or os.cpu_count() or 1))
+
+    def _write(path, data, mode):
+        try:
+            _write_file(path, data, mode)
+        finally:
+            pending.release()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = []
+        to_write = [(tree, dest_dir)]
+        while to_write:
+            tree, dir_path = to_write.pop()
+            os.makedirs(dir_path, exist_ok=True)
+            for node in tree:
+                path = os.path.join(dir_path, node.name)
+                if isinstance(node, pygit2.Tree):
+                    to_write.append((node, path))
+                elif node.filemode in WRITABLE_FILEMODES:
+                    pending.acquire()
+                    futures.append(
+                        executor.submit(_write, path, node.data, node.filemode)
+                    )
+    for future in futures:
+        future.result()
+
+
+def _write_file(path, data, mode):
+    with open(path, "wb") as file:
+        file.write(data)
+    os.chmod(path, mode)
+
+
+def _backoff(attempt):
+    """Sleep for a random, with ``attempt`` growing time before retrying.
+
+    This keeps concurrent writers that failed updating a reference from colliding
+    again right away.
+    """
+    time.sleep(random.uniform(0, 0.01 * 2 ** min(attempt, 5)))
+
+
+def update_ref(repo, refname, new_id, old_id):
+    """Point the reference ``refname`` to ``new_id`` if it still points to ``old_id``.
+
+    ``old_id`` being ``None`` means the reference must not exist yet. This is done
+    atomically with ``git update-ref``, because libgit2 can't compare the old
+    value while holding the reference's lock. ``False`` is returned if the
+    reference was changed concurrently, i.e. it doesn't point to ``old_id``
+    anymore or is locked by another writer, and ``True`` if it was updated.
+
+    :raises subprocess.CalledProcessError:
+        if updating failed for any other reason, like a missing object
+    """
+    proc = subprocess.run(
+        [
+            "git",
+            "--git-dir",
+            repo.path,
+            "update-ref",
+            refname,
+            str(new_id),
+            "" if old_id is None else str(old_id),
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        # Untranslated messages are needed for detecting a locked reference
+        env={**os.environ, "LC_ALL": "C"},
+    )
+    if proc.returncode == 0:
+        return True
+    stderr = proc.stderr.decode(errors="replace")
+    ref = repo.references.get(refname)
+    current_id = None if ref is None else ref.target
+    if current_id != (None if old_id is None else pygit2.Oid(hex=str(old_id))):
+        LOGGER.debug("%r in %r was changed to %s", refname, repo.path, current_id)
+        return False
+    if ".lock': File exists" in stderr:
+        LOGGER.debug("%r in %r is locked: %s", refname, repo.path, stderr)
+        return False
+    raise subprocess.CalledProcessError(proc.returncode, proc.args, stderr=proc.stderr)
+
+
 def walk_pairwise(repo, start_committish, end_committish=None):
     """Walks backwards from ``start_committish`` to ``end_committish``.
 
@@ -119,6 +344,176 @@ def walk_pairwise(repo, start_committish, end_committish=None):
         child_commit = commit
 
 
+class RepositoryPool:
+    """
+    Bounded LRU pool of open :class:`pygit2.Repository` handles, keyed by path.
+
+    Opening a repository re-reads its config, references and pack indexes, which
+    is worth avoiding for every request. Since libgit2 handles mustn't be shared
+    between threads, each thread gets its own pool of ``max_size`` handles.
+    A handle is re-opened when the directory at its path has been replaced in
+    the meantime, i.e. because the course was deleted and created again. As the
+    inode of a removed directory may be re-used right away, its change time is
+    compared as well, which git only touches when writing files like
+    ``packed-refs`` directly into the repository.
+
+    If ``max_size`` isn't given, the ``MS_GIT_REPOSITORY_POOL_SIZE`` setting is
+    used. A size of 0 disables pooling.
+    """
+
+    def __init__(self, max_size=None):
+        self._max_size = max_size
+        self._local = threading.local()
+        # Counters are shared by all threads and only meant for sizing the pool
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def _entries(self):
+        try:
+            return self._local.entries
+        except AttributeError:
+            entries = self._local.entries = collections.OrderedDict()
+            return entries
+
+    @property
+    def max_size(self):
+        if self._max_size is None:
+            return settings.MS_GIT_REPOSITORY_POOL_SIZE
+        return self._max_size
+
+    def clear(self):
+        """Drop all handles of the current thread."""
+        self._entries.clear()
+
+    def get(self, path):
+        """Return an open repository for ``path``, re-using a pooled one if possible.
+
+        :raises pygit2.GitError: if there's no repository at ``path``
+        """
+        path = os.path.abspath(path)
+        entries = self._entries
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # Let pygit2 raise its usual error
+            entries.pop(path, None)
+            return pygit2.Repository(path)
+        identity = (stat.st_dev, stat.st_ino, stat.st_ctime_ns)
+        try:
+            repo, pooled_identity = entries[path]
+        except KeyError:
+            pass
+        else:
+            if pooled_identity == identity:
+                self.hits += 1
+                entries.move_to_end(path)
+                return repo
+            # Directory was replaced, the old handle is useless now
+            del entries[path]
+        self.misses += 1
+        repo = pygit2.Repository(path)
+        if self.max_size > 0:
+            entries[path] = (repo, identity)
+            while len(entries) > self.max_size:
+                entries.popitem(last=False)
+                self.evictions += 1
+                LOGGER.debug("Repository pool full: %r", self.stats())
+        return repo
+
+    def invalidate(self, path):
+        """Drop the handle for ``path`` and those of repositories below it."""
+        path = os.path.abspath(path)
+        entries = self._entries
+        for key in tuple(entries):
+            if key == path or key.startswith(path + os.sep):
+                del entries[key]
+
+    def stats(self):
+        """Return a dict with the hit/miss counters and current thread's pool size."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self._entries),
+            "max_size": self.max_size,
+        }
+
+
+# Each uWSGI worker and spooler process has its own pool
+REPOSITORY_POOL = RepositoryPool()
+
+
+class BlobStream:
+    """
+    Reads the content of a blob sequentially without loading it into memory.
+
+    libgit2 always inflates objects as a whole, hence ``git cat-file`` is used,
+    which streams large blobs. The size is known right after opening. Iterating
+    yields the content in chunks, restricted to the range set with
+    :meth:`set_range`. Instances should be closed after use, which terminates the
+    git process, so they can be passed to ``StreamingHttpResponse`` directly.
+
+    :raises KeyError: if there's no blob with given id
+    """
+
+    def __init__(self, repo, blob_id, chunk_size=256 * 1024):
+        self.chunk_size = chunk_size
+        self._proc = subprocess.Popen(
+            ["git", "--git-dir", repo.path, "cat-file", "--batch"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            self._proc.stdin.write(f"{blob_id}\n".encode())
+            self._proc.stdin.close()
+            # Either "<oid> blob <size>" or "<oid> missing"
+            header = self._proc.stdout.readline().split()
+            if len(header) != 3 or header[1] != b"blob":
+                raise KeyError(blob_id)
+            self.size = int(header[2])
+        except BaseException:
+            self.close()
+            raise
+        self.start = 0
+        self.length = self.size
+
+    def __iter__(self):
+        stdout = self._proc.stdout
+        # The pipe can't seek, so content before the range is read and discarded
+        skip = self.start
+        while skip > 0:
+            skipped = len(stdout.read(min(skip, self.chunk_size)))
+            if not skipped:
+                return
+            skip -= skipped
+        remaining = self.length
+        while remaining > 0:
+            chunk = stdout.read(min(remaining, self.chunk_size))
+            if not chunk:
+                return
+            remaining -= len(chunk)
+            yield chunk
+
+    def close(self):
+        if self._proc.poll() is None:
+            self._proc.kill()
+        self._proc.stdout.close()
+        self._proc.wait()
+
+    def set_range(self, start, length):
+        """Only yield ``length`` bytes beginning at offset ``start``.
+
+        This has to be called before iterating.
+        """
+        if start < 0 or length < 0 or start + length > self.size:
+            raise ValueError(f"Range ({start}, {length}) exceeds size {self.size}")
+        self.start = start
+        self.length = length
+
+
 class ContentBrowser:
     """
     Convenience class that provides different means of browsing and updating
@@ -138,6 +533,14 @@ class ContentBrowser:
         """Add given content (bytes object) to index under given path."""
         self.index.add(pygit2.IndexEntry(path, self.repo.create_blob(content), mode))
 
+    def add_from_file(self, path, file, mode=pygit2.GIT_FILEMODE_BLOB):
+        """Add the content of a file object to index under given path.
+
+        See :func:`create_blob_from_file` for how the file is read.
+        """
+        blob_id = create_blob_from_file(self.repo, file)
+        self.index.add(pygit2.IndexEntry(path, blob_id, mode))
+
     def add_from_fs(self, dir_to_add, prefix=""):
         """Add all files under dir_to_add to index recursively."""
         for root, dirnames, filenames in os.walk(dir_to_add):
@@ -148,11 +551,14 @@ class ContentBrowser:
                 repo_path = posixpath.normpath(
                     posixpath.join(prefix, rel_root, filename)
                 )
+                # Git only knows about the executable bit
+                if os.stat(disk_path).st_mode & 0o111:
+                    mode = pygit2.GIT_FILEMODE_BLOB_EXECUTABLE
+                else:
+                    mode = pygit2.GIT_FILEMODE_BLOB
                 self.index.add(
                     pygit2.IndexEntry(
-                        repo_path,
-                        self.repo.create_blob_fromdisk(disk_path),
-                        os.stat(disk_path).st_mode,
+                        repo_path, self.repo.create_blob_fromdisk(disk_path), mode
                     )
                 )
 
@@ -207,11 +613,42 @@ class ContentBrowser:
                 )
 
     def commit(self, sig, msg, to_refname=None):
-        """Commit the index's state and return the commit object id."""
-        tree_id = self.index.write_tree(self.repo)
-        # Allow creating initial commits (with no parent)
-        parents = [] if self.base_commit_id is None else [self.base_commit_id]
-        commit_id = self.repo.create_commit(to_refname, sig, sig, msg, tree_id, parents)
+        """Commit the index's state and return the commit object id.
+
+        ``to_refname`` is only updated if it still points to the base commit. If
+        it was moved meanwhile, the changes made to the index are merged into the
+        new commit it points to and committing is retried.
+
+        :raises RefUpdateFailed:
+            if the changes conflict with the new commit or the reference kept
+            changing for ``COMMIT_ATTEMPTS`` attempts
+        """
+        for attempt in range(COMMIT_ATTEMPTS):
+            tree_id = self.index.write_tree(self.repo)
+            # Allow creating initial commits (with no parent)
+            parents = [] if self.base_commit_id is None else [self.base_commit_id]
+            commit_id = self.repo.create_commit(None, sig, sig, msg, tree_id, parents)
+            if to_refname is None or update_ref(
+                self.repo, to_refname, commit_id, self.base_commit_id
+            ):
+                break
+            # Apply the changes made to the base onto what was committed meanwhile
+            _backoff(attempt)
+            try:
+                tip = resolve_committish(self.repo, to_refname)
+            except KeyError:
+                raise RefUpdateFailed(f"{to_refname} was deleted")
+            if self.base_commit_id is None:
+                base_tree = self.repo[self.repo.TreeBuilder().write()]
+            else:
+                base_tree = self.repo[self.base_commit_id].tree
+            index = self.repo.merge_trees(base_tree, tip.tree, self.repo[tree_id])
+            if index.conflicts is not None:
+                raise RefUpdateFailed(f"Changes conflict with {tip.id} in {to_refname}")
+            self.index = index
+            self.base_commit_id = tip.id
+        else:
+            raise RefUpdateFailed(f"{to_refname} kept changing")
         # This is now same as index and could be used as parent for subsequent commits
         self.base_commit_id = commit_id
         return commit_id
@@ -254,31 +691,232 @@ class ContentBrowser:
         """Write directory structure from index to a directory.
 
         If prefix is specified, only that file/subdirectory will be extracted.
+        See :func:`write_tree_to_fs` for how files are written.
         """
         prefix = posixpath.normpath(prefix)
-        for entry in self.index:
-            # Links and commits can't be written
-            if entry.mode not in (
-                pygit2.GIT_FILEMODE_BLOB,
-                pygit2.GIT_FILEMODE_BLOB_EXECUTABLE,
-            ):
-                continue
+        node = self.repo[self.index.write_tree(self.repo)]
+        if prefix != ".":
+            try:
+                node = node[prefix]
+            except KeyError:
+                return
+        if isinstance(node, pygit2.Tree):
+            write_tree_to_fs(node, dest_dir)
+        elif node.filemode in WRITABLE_FILEMODES:
+            # Extract a single file
+            path = os.path.normpath(os.path.join(dest_dir, prefix))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _write_file(path, node.data, node.filemode)
+
+
+class TreeEditor:
+    """
+    Applies changes to the tree of a commit and commits the result.
+
+    In contrast to :class:`ContentBrowser`, the tree isn't read into an index as a
+    whole. Only the trees along changed paths are loaded into
+    :class:`pygit2.TreeBuilder` objects and written again, while all other subtrees
+    are kept by id. Looking up and removing paths hence costs the same for any size
+    of the repository. As with an index, directories left empty are removed.
+    """
+
+    def __init__(self, repo, base_committish=None):
+        self.repo = repo
+        self.load_base(base_committish)
+
+    def __getitem__(self, path):
+        """Return the blob at given path, taking pending changes into account.
+
+        :raises KeyError: if there's no file at that path
+        """
+        dir_path, name = posixpath.split(posixpath.normpath(path))
+        try:
+            obj = self._get_builder(dir_path).get(name)
+        except KeyError:
+            raise KeyError(path)
+        if not isinstance(obj, pygit2.Blob):
+            raise KeyError(path)
+        return obj
+
+    def _discard_builders(self, path):
+        """Forget changes made under ``path``, which is being replaced."""
+        prefix = f"{path}/"
+        for dir_path in tuple(self._builders):
+            if dir_path == path or dir_path.startswith(prefix):
+                del self._builders[dir_path]
+
+    def _exists(self, path):
+        """Whether there is a file or non-empty directory at ``path``."""
+        if path in self._builders:
+            return not self._is_empty(path)
+        dir_path, name = posixpath.split(path)
+        try:
+            return self._get_builder(dir_path).get(name) is not None
+        except KeyError:
+            return False
+
+    def _get_builder(self, dir_path, create=False):
+        """Return the builder for the directory at ``dir_path``.
+
+        With ``create`` set, the builder is kept for writing, as are those of all
+        its parents. A directory that doesn't exist yet starts out empty then and
+        replaces a file in its way. Otherwise, builders not kept already are only
+        returned for looking into them, changes made to them are lost.
+
+        :raises KeyError:
+            if ``create`` isn't set and there's no directory at that path
+        """
+        dir_path = "" if dir_path == "." else dir_path
+        try:
+            return self._builders[dir_path]
+        except KeyError:
+            pass
+        if dir_path:
+            parent_path, name = posixpath.split(dir_path)
+            try:
+                obj = self._get_builder(parent_path, create).get(name)
+            except KeyError:
+                raise KeyError(dir_path)
+        else:
+            obj = self._base_tree
+        if isinstance(obj, pygit2.Tree):
+            builder = self.repo.TreeBuilder(obj)
+        elif create or (not dir_path and obj is None):
+            builder = self.repo.TreeBuilder()
+        else:
+            raise KeyError(dir_path)
+        if create:
+            self._builders[dir_path] = builder
+        return builder
+
+    def _is_empty(self, dir_path):
+        """Whether the directory at ``dir_path``, which has a builder, is empty.
+
+        Subdirectories with builders are only inserted into their parents when
+        writing, so they're accounted for here.
+        """
+        builder = self._builders[dir_path]
+        num_entries = len(builder)
+        prefix = f"{dir_path}/" if dir_path else ""
+        for path in self._builders:
             if (
-                prefix != "."
-                and entry.path != prefix
-                and not entry.path.startswith(prefix + "/")
+                path != dir_path
+                and path.startswith(prefix)
+                and "/" not in path[len(prefix) :]
             ):
-                continue
-            if prefix == entry.path:
-                # Extract a single file
-                rel_path = prefix
-            else:
-                rel_path = posixpath.relpath(entry.path, prefix)
-            path = os.path.normpath(os.path.join(dest_dir, rel_path))
+                in_builder = builder.get(path[len(prefix) :]) is not None
+                num_entries += (not self._is_empty(path)) - in_builder
+        return num_entries == 0
+
+    def add(self, path, blob_id, mode=pygit2.GIT_FILEMODE_BLOB):
+        """Add the blob with given id under given path, replacing what was there."""
+        path = posixpath.normpath(path)
+        dir_path, name = posixpath.split(path)
+        self._discard_builders(path)
+        self._get_builder(dir_path, create=True).insert(name, blob_id, mode)
+        self._changes.append((self.add, (path, blob_id, mode)))
+
+    def add_from_bytes(self, path, content, mode=pygit2.GIT_FILEMODE_BLOB):
+        """Add given content (bytes object) under given path."""
+        self.add(path, self.repo.create_blob(content), mode)
+
+    def add_from_file(self, path, file, mode=pygit2.GIT_FILEMODE_BLOB):
+        """Add the content of a file object under given path.
+
+        See :func:`create_blob_from_file` for how the file is read.
+        """
+        self.add(path, create_blob_from_file(self.repo, file), mode)
+
+    def commit(self, sig, msg, to_refname=None):
+        """Commit the changed tree and return the commit object id.
+
+        ``to_refname`` is only updated if it still points to the base commit. If
+        it was moved meanwhile, the changes are applied again on top of the new
+        commit it points to and committing is retried. Paths to be removed that
+        are gone already are skipped then, files added replace what's there.
+
+        :raises RefUpdateFailed:
+            if the reference kept changing for ``COMMIT_ATTEMPTS`` attempts
+        """
+        for attempt in range(COMMIT_ATTEMPTS):
+            tree_id = self.write_tree()
+            # Allow creating initial commits (with no parent)
+            parents = [] if self.base_commit_id is None else [self.base_commit_id]
+            commit_id = self.repo.create_commit(None, sig, sig, msg, tree_id, parents)
+            if to_refname is None or update_ref(
+                self.repo, to_refname, commit_id, self.base_commit_id
+            ):
+                break
+            _backoff(attempt)
+            changes = self._changes
             try:
-                os.makedirs(os.path.dirname(path))
-            except FileExistsError:
-                pass
-            with open(path, "wb") as file:
-                file.write(self.repo[entry.id].read_raw())
-            os.chmod(path, entry.mode)
+                self.load_base(to_refname)
+            except KeyError:
+                # The reference was deleted meanwhile
+                self.load_base(None)
+            for func, args in changes:
+                try:
+                    func(*args)
+                except KeyError:
+                    pass
+        else:
+            raise RefUpdateFailed(f"{to_refname} kept changing")
+        # This is now the base for subsequent changes
+        self.load_base(commit_id)
+        return commit_id
+
+    def load_base(self, committish):
+        """Use the tree the committish points to as base, dropping all changes.
+
+        ``None`` starts with an empty tree and causes the next commit to have no
+        parent.
+        """
+        if committish is None:
+            self.base_commit_id = None
+            self._base_tree = None
+        else:
+            base_commit = resolve_committish(self.repo, committish)
+            self.base_commit_id = base_commit.id
+            self._base_tree = base_commit.tree
+        self._builders = {}
+        # Changes made since, for applying them to a different base if needed
+        self._changes = []
+
+    def remove(self, path):
+        """Removes given path or, if it's a directory, everything under it.
+
+        KeyError is raised when the given path didn't exist.
+        """
+        path = posixpath.normpath(path)
+        if path == ".":
+            self._builders = {"": self.repo.TreeBuilder()}
+        else:
+            if not self._exists(path):
+                raise KeyError(path)
+            dir_path, name = posixpath.split(path)
+            builder = self._get_builder(dir_path, create=True)
+            self._discard_builders(path)
+            if builder.get(name) is not None:
+                builder.remove(name)
+        self._changes.append((self.remove, (path,)))
+
+    def write_tree(self):
+        """Write the changed trees to the repository and return the root tree id."""
+        if not self._builders:
+            if self._base_tree is None:
+                return self.repo.TreeBuilder().write()
+            return self._base_tree.id
+        # Write subdirectories before their parents, so that new ids can be inserted
+        for dir_path in sorted(
+            self._builders, key=lambda dir_path: dir_path.count("/"), reverse=True
+        ):
+            if not dir_path:
+                continue
+            builder = self._builders[dir_path]
+            parent_path, name = posixpath.split(dir_path)
+            parent = self._builders[parent_path]
+            if len(builder):
+                parent.insert(name, builder.write(), pygit2.GIT_FILEMODE_TREE)
+            elif parent.get(name) is not None:
+                parent.remove(name)
+        return self._builders[""].write()
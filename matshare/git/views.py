@@ -10,9 +10,9 @@ from django.urls import get_script_prefix, reverse
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import View
-import pygit2
 
 from . import utils as git_utils
+from ..course.spooled_tasks import spooled_index_course_commits
 from ..models import Course
 from ..utils import basic_auth
 
@@ -31,10 +31,8 @@ class GitAuthView(View):
         course = get_object_or_404(
             Course.objects.by_slug_path(**slug_path)
             .visible(user)
-            .distinct()
             .filter(is_static=False)
             .select_related("study_course")
-            .prefetch_related("editors", "students")
         )
         acl = course.get_git_acl(user)
         # Instruct webserver to forward the request to git-http-backend
@@ -112,7 +110,7 @@ class GitPushNotifyView(View):
             src_updated = True
         else:
             # Check what has changed between the two revisions
-            repo = pygit2.Repository(course.absolute_repository_path)
+            repo = git_utils.open_repository(course.absolute_repository_path)
             material_updated, src_updated = git_utils.paths_changed(
                 repo.revparse_single(old_rev),
                 repo.revparse_single(new_rev),
@@ -120,6 +118,10 @@ class GitPushNotifyView(View):
                 settings.MS_GIT_SRC_SUBDIR,
             )
 
+        if new_rev not in git_utils.NULL_REFS:
+            # Keep the commit index up to date for notifications and feeds
+            spooled_index_course_commits(course.pk)
+
         if material_updated or src_updated:
             LOGGER.debug(
                 "User %r updated %r for course %d from %r to %r (material=%r src=%r)",
@@ -2,17 +2,62 @@
 Implementations for building material in different formats.
 """
 
+import collections
+import concurrent.futures
+import contextlib
+import fcntl
 import fnmatch
+import functools
 import glob
+import gzip
+import hashlib
+import io
+import json
 import os
+import posixpath
+import re
+import resource
 import shutil
+import signal
 import subprocess
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+import pygit2
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from .git import utils as git_utils
 
 
 # Glob patterns that match files/directories serving a specific purpose.
 # Only basenames can be matched, so don't try to include slashes in the patterns.
 BUILD_ARTIFACT_PATTERNS = ("gladtex.cache",)
 MD_PATTERNS = ("*.md",)
+# Markdown file the table of contents of a lecture is generated into by matuc
+TOC_NAME = "inhalt.md"
+
+# Name of the file in a build results directory listing the files of the build
+MANIFEST_NAME = "manifest.json"
+# Unreferenced blobs are kept for this many seconds, so that builds still running
+# can reference them in their manifests
+BLOB_GRACE_SECS = 3600
+
+# Files of HTML builds matching these patterns get precompressed variants stored,
+# as long as they're at least COMPRESS_MIN_SIZE bytes large
+COMPRESSIBLE_PATTERNS = ("*.css", "*.html", "*.js", "*.svg", "*.txt", "*.xml")
+COMPRESS_MIN_SIZE = 1024
+# File name suffixes of precompressed variants of blobs, by content coding
+ENCODING_SUFFIXES = {"br": ".br", "gzip": ".gz"}
+
+# Lines of Markdown that may influence files generated for the whole lecture, such as
+# the table of contents: headings (ATX and setext style) and page numbers
+OUTLINE_PATTERN = re.compile(r"^\s*(?:#|\|\||=+\s*$|-+\s*$)")
 
 
 class MatucFailed(Exception):
@@ -32,22 +77,165 @@ class MatucFailed(Exception):
         )
 
 
-def build_epub(build):
-    run_matuc("conv", ".", "-f", "epub")
-    os.makedirs(build.absolute_path)
-    epub_files = glob.glob("*.epub")
+def build_epub(build, build_dir, chapters=None):
+    """Build an EPUB file from the lecture in ``build_dir``.
+
+    The EPUB is a single document, hence the whole lecture is always converted and
+    ``chapters`` is ignored.
+    """
+    # Don't pick up the file of a previous build, its name may have changed
+    for path in glob.glob(os.path.join(glob.escape(build_dir), "*.epub")):
+        os.remove(path)
+    with build.record_phase("run_matuc"):
+        build.peak_rss = run_matuc("conv", ".", "-f", "epub", cwd=build_dir)
+    epub_files = glob.glob(os.path.join(glob.escape(build_dir), "*.epub"))
     assert len(epub_files) == 1, f"Found more than one epub file: {epub_files[:10]}"
     assert os.path.isfile(epub_files[0]), f"{epub_files[0]!r} is not a file"
-    shutil.copyfile(epub_files[0], os.path.join(build.absolute_path, epub_files[0]))
+    with build.record_phase("store_files"):
+        build.output_files, build.output_size = store_files(
+            ((os.path.basename(epub_files[0]), epub_files[0]),),
+            build.absolute_manifest_path,
+        )
+
+
+def build_html(build, build_dir, chapters=None):
+    """Build HTML files from the lecture in ``build_dir``.
+
+    If ``chapters`` is given, only these Markdown files are converted and the
+    results of the previous build are kept for all others.
+    """
+    with build.record_phase("run_matuc"):
+        build.peak_rss = convert(
+            "html", build_dir, chapters, toc=build.course.magsbs_generate_toc
+        )
+    with build.record_phase("store_files"):
+        build.output_files, build.output_size = store_files(
+            walk_files(
+                build_dir, ignore_by_patterns(BUILD_ARTIFACT_PATTERNS + MD_PATTERNS)
+            ),
+            build.absolute_manifest_path,
+            compress=True,
+        )
+
+
+def convert(format, build_dir, chapters=None, toc=True):
+    """Convert the lecture in ``build_dir`` with matuc.
 
+    If ``chapters`` is given, only these Markdown files are converted, otherwise the
+    whole lecture is. With a single job (see ``MS_MATERIAL_BUILD_JOBS``), the whole
+    lecture is converted by one matuc run. With multiple jobs, all chapters are
+    converted in parallel instead and only the table of contents, the one file
+    depending on the whole lecture, is generated afterwards if ``toc`` is set.
 
-def build_html(build):
-    run_matuc("conv", ".", "-f", "html")
-    shutil.copytree(
-        ".",
-        build.absolute_path,
-        ignore=ignore_by_patterns(BUILD_ARTIFACT_PATTERNS + MD_PATTERNS),
+    The peak resident set size of matuc processes in bytes is returned.
+    """
+    jobs = settings.MS_MATERIAL_BUILD_JOBS
+    if chapters is not None:
+        return convert_chapters(format, build_dir, chapters, jobs)
+    if jobs == 1:
+        return run_matuc("conv", ".", "-f", format, cwd=build_dir)
+    peak_rss = convert_chapters(
+        format,
+        build_dir,
+        [
+            path
+            for path, _ in walk_files(build_dir)
+            # Left over from a previous build, it's regenerated below
+            if _is_markdown(path) and path != TOC_NAME
+        ],
+        jobs,
     )
+    if toc:
+        peak_rss = max(
+            peak_rss,
+            run_matuc("toc", "-o", TOC_NAME, ".", cwd=build_dir),
+            run_matuc("conv", TOC_NAME, "-f", format, cwd=build_dir),
+        )
+    return peak_rss
+
+
+def convert_chapters(format, build_dir, chapters, jobs=1):
+    """Convert the given Markdown files with up to ``jobs`` matuc processes.
+
+    Paths of ``chapters`` are relative to ``build_dir``. Files in the same
+    directory share caches and images, so they're always converted one after
+    another. The peak resident set size of matuc processes in bytes is returned.
+
+    :raises MatucFailed: for the first failed conversion
+    """
+    by_dir = collections.defaultdict(list)
+    for chapter in chapters:
+        by_dir[posixpath.dirname(chapter)].append(chapter)
+
+    def _convert_dir(chapters):
+        return max(
+            run_matuc("conv", chapter, "-f", format, cwd=build_dir)
+            for chapter in chapters
+        )
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(_convert_dir, paths) for paths in by_dir.values()]
+    return max((future.result() for future in futures), default=0)
+
+
+def compress_blob(digest, encoding):
+    """Store a variant of a blob compressed with given content coding.
+
+    Variants are stored next to their blobs and, like these, shared between all
+    builds. Nothing is compressed when the variant exists already. ``False`` is
+    returned if the variant turned out to be no smaller than the blob and hence
+    wasn't stored, ``True`` otherwise.
+    """
+    blob_path = get_blob_path(digest)
+    path = get_blob_path(digest, encoding)
+    try:
+        os.utime(path)
+        return True
+    except FileNotFoundError:
+        pass
+    with open(blob_path, "rb") as file:
+        data = file.read()
+    if encoding == "br":
+        compressed = brotli.compress(data, quality=11)
+    else:
+        assert encoding == "gzip", encoding
+        buffer = io.BytesIO()
+        # Use a fixed mtime, so that the output only depends on the data
+        with gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=9, mtime=0) as gz:
+            gz.write(data)
+        compressed = buffer.getvalue()
+    if len(compressed) >= len(data):
+        return False
+    _write_blob_file(path, lambda dest: dest.write(compressed))
+    return True
+
+
+def get_blob_path(digest, encoding=None):
+    """Return the absolute path of the blob with given SHA-256 hex digest.
+
+    If ``encoding`` is given, the path of the blob's variant compressed with that
+    content coding (one of ``ENCODING_SUFFIXES``) is returned instead.
+    """
+    return os.path.join(
+        settings.MEDIA_ROOT,
+        "material_build_blobs",
+        digest[:2],
+        digest[2:] + (ENCODING_SUFFIXES[encoding] if encoding else ""),
+    )
+
+
+def get_supported_encodings():
+    """Return the content codings precompressed variants can be created for."""
+    return ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def hash_file(path):
+    """Return the SHA-256 hex digest of the file at ``path``."""
+    hasher = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
 
 
 def ignore_by_patterns(patterns):
@@ -69,17 +257,381 @@ def ignore_by_patterns(patterns):
     return _filter_names
 
 
-def run_matuc(*args):
-    """Runs the matuc command with given arguments.
+def run_matuc(*args, cwd):
+    """Runs the matuc command with given arguments in the directory ``cwd``.
+
+    matuc and all processes it starts are limited according to the
+    ``MS_MATUC_CPU_LIMIT`` and ``MS_MATUC_MEMORY_LIMIT`` settings and killed when
+    they don't finish within ``MS_MATUC_TIMEOUT`` seconds.
+
+    The peak resident set size of matuc and its children in bytes is returned. As
+    the kernel accounts the memory of the forking process to the child until it
+    executes matuc, the spooler's own size is a lower bound of the result.
 
-    :raises MatucFailed: if the process exits with a non-zero code
+    :raises MatucFailed: if the process exits with a non-zero code or times out
     """
-    result = subprocess.run(
+    # A session of its own allows killing matuc's children as well
+    proc = subprocess.Popen(
         ["matuc", *args],
-        stdin=None,
+        cwd=cwd,
+        stdin=subprocess.DEVNULL,
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
         text=True,
+        start_new_session=True,
     )
-    if result.returncode != 0:
-        raise MatucFailed(result.returncode, result.stdout)
+    timed_out = threading.Event()
+
+    def _on_timeout():
+        timed_out.set()
+        _kill_process_group(proc.pid)
+
+    # Not using communicate() in order to get the resource usage when reaping
+    killer = threading.Timer(settings.MS_MATUC_TIMEOUT, _on_timeout)
+    try:
+        # Applied from outside, since preexec_fn isn't safe to use in threads.
+        # Processes started by matuc inherit the limits.
+        if settings.MS_MATUC_CPU_LIMIT:
+            resource.prlimit(
+                proc.pid,
+                resource.RLIMIT_CPU,
+                (settings.MS_MATUC_CPU_LIMIT, settings.MS_MATUC_CPU_LIMIT),
+            )
+        if settings.MS_MATUC_MEMORY_LIMIT:
+            limit = settings.MS_MATUC_MEMORY_LIMIT * 1024 * 1024
+            resource.prlimit(proc.pid, resource.RLIMIT_DATA, (limit, limit))
+        if settings.MS_MATUC_TIMEOUT:
+            killer.start()
+        # EOF is reached once matuc and its children have exited or were killed
+        output = proc.stdout.read()
+    except BaseException:
+        _kill_process_group(proc.pid)
+        raise
+    finally:
+        killer.cancel()
+        proc.stdout.close()
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = (
+            -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        )
+    if timed_out.is_set():
+        raise MatucFailed(
+            proc.returncode,
+            f"{output}\nKilled after {settings.MS_MATUC_TIMEOUT} seconds.",
+        )
+    if proc.returncode != 0:
+        raise MatucFailed(proc.returncode, output)
+    # ru_maxrss is given in KiB on Linux
+    return rusage.ru_maxrss * 1024
+
+
+def _kill_process_group(pgid):
+    with contextlib.suppress(ProcessLookupError):
+        os.killpg(pgid, signal.SIGKILL)
+
+
+def _get_edit_tree(repo, revision):
+    """Return the :class:`pygit2.Tree` of the edit subdirectory at ``revision``.
+
+    :raises KeyError: if the revision or directory doesn't exist
+    """
+    node = git_utils.resolve_committish(repo, revision).tree[
+        settings.MS_GIT_EDIT_SUBDIR
+    ]
+    if not isinstance(node, pygit2.Tree):
+        raise KeyError(settings.MS_GIT_EDIT_SUBDIR)
+    return node
+
+
+def _is_markdown(path):
+    name = os.path.basename(path)
+    return any(fnmatch.fnmatchcase(name, pattern) for pattern in MD_PATTERNS)
+
+
+def _get_outline(content):
+    """Return the lines of Markdown ``content`` that make up the lecture's outline.
+
+    Setext-style headings are underlined, so the line before is included as well.
+    """
+    lines = content.decode("utf-8", "replace").splitlines()
+    return [
+        (lines[idx - 1] if idx else "", line)
+        for idx, line in enumerate(lines)
+        if OUTLINE_PATTERN.match(line)
+    ]
+
+
+class BuildWorkspace:
+    """
+    Directory kept between the builds of a course in one format.
+
+    It holds the edited material of the revision built last together with matuc's
+    outputs and caches (like ``gladtex.cache``), so that a new revision only needs
+    the changed files to be written and the changed chapters to be converted.
+    Used as a context manager, the workspace is locked exclusively, since
+    concurrent builds would mess up each other's files.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # matuc sometimes pollutes the parent directory, so give it an inner one
+        self.build_dir = os.path.join(path, "build")
+        self._lock_file = None
+        self._revision_file = os.path.join(path, "revision")
+
+    def __enter__(self):
+        os.makedirs(self.build_dir, exist_ok=True)
+        self._lock_file = open(os.path.join(self.path, "lock"), "w")
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._lock_file.close()
+        self._lock_file = None
+
+    @property
+    def revision(self):
+        """The revision built successfully last or ``None``."""
+        try:
+            with open(self._revision_file) as file:
+                return file.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def finish(self, revision):
+        """Record that ``revision`` has been built successfully."""
+        with open(self._revision_file, "w") as file:
+            file.write(revision)
+
+    def update(self, repo, revision):
+        """Bring the workspace to the state of ``revision``.
+
+        Only the differences to the previously built revision are written. The
+        Markdown files that need to be converted are returned, or ``None`` when the
+        lecture has to be converted as a whole.
+        """
+        old_revision = self.revision
+        # Until the new revision was built successfully, the state is unknown
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self._revision_file)
+        new_tree = _get_edit_tree(repo, revision)
+        if old_revision is not None:
+            try:
+                old_tree = _get_edit_tree(repo, old_revision)
+            except (KeyError, ValueError, pygit2.GitError):
+                # The old revision is gone, e.g. after a forced push
+                pass
+            else:
+                return self._apply_diff(repo, old_tree, new_tree)
+        self._check_out(new_tree)
+        return None
+
+    def _apply_diff(self, repo, old_tree, new_tree):
+        deltas = tuple(old_tree.diff_to_tree(new_tree).deltas)
+        # Remove first, a directory may be replaced by a file of the same name
+        for delta in deltas:
+            if delta.status == pygit2.GIT_DELTA_DELETED:
+                self._remove(delta.old_file.path)
+        chapters = []
+        convert_all = False
+        for delta in deltas:
+            path = delta.new_file.path
+            if delta.status != pygit2.GIT_DELTA_DELETED:
+                self._write(repo, path, delta.new_file.id, delta.new_file.mode)
+            if path == settings.MS_MATUC_CONFIG_FILE:
+                # Metadata is contained in every generated file
+                convert_all = True
+            elif _is_markdown(path):
+                if delta.status == pygit2.GIT_DELTA_MODIFIED and _get_outline(
+                    repo[delta.old_file.id].data
+                ) == _get_outline(repo[delta.new_file.id].data):
+                    chapters.append(path)
+                else:
+                    # Chapters were added, removed or restructured, so the table
+                    # of contents and navigation links need to be regenerated
+                    convert_all = True
+        return None if convert_all else chapters
+
+    def _check_out(self, tree):
+        """Replace all files except for build artifacts with the contents of tree."""
+        is_artifact = ignore_by_patterns(BUILD_ARTIFACT_PATTERNS)
+        for root, dirnames, filenames in os.walk(self.build_dir, topdown=False):
+            keep = set(is_artifact(root, dirnames + filenames))
+            for name in filenames:
+                if name not in keep:
+                    os.remove(os.path.join(root, name))
+            for name in dirnames:
+                if name not in keep:
+                    with contextlib.suppress(OSError):
+                        os.rmdir(os.path.join(root, name))
+        git_utils.write_tree_to_fs(tree, self.build_dir)
+
+    def _remove(self, path):
+        """Remove a file and the output generated from it."""
+        disk_path = os.path.join(self.build_dir, path)
+        to_remove = [disk_path]
+        if _is_markdown(path):
+            to_remove.append(os.path.splitext(disk_path)[0] + ".html")
+        for disk_path in to_remove:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(disk_path)
+        # Clean up directories that became empty
+        to_clean = os.path.dirname(path)
+        while to_clean:
+            try:
+                os.rmdir(os.path.join(self.build_dir, to_clean))
+            except OSError:
+                # Directory not empty, stop cleaning
+                break
+            to_clean = os.path.dirname(to_clean)
+
+    def _write(self, repo, path, blob_id, mode):
+        if mode not in git_utils.WRITABLE_FILEMODES:
+            return
+        disk_path = os.path.join(self.build_dir, path)
+        os.makedirs(os.path.dirname(disk_path), exist_ok=True)
+        with open(disk_path, "wb") as file:
+            file.write(repo[blob_id].read_raw())
+        os.chmod(disk_path, mode)
+
+
+def read_manifest(manifest_path):
+    """Return the contents of a manifest as written by :func:`store_files`.
+
+    Manifests are cached per process until they're replaced, so the returned
+    dictionary must not be modified.
+
+    :raises OSError: if the manifest can't be read
+    """
+    stat = os.stat(manifest_path)
+    return _read_manifest(manifest_path, stat.st_ino, stat.st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=64)
+def _read_manifest(manifest_path, ino, mtime_ns):
+    with open(manifest_path) as file:
+        manifest = json.load(file)
+    # Manifests written before precompression was introduced lack this key
+    manifest.setdefault("encodings", {})
+    return manifest
+
+
+def remove_unreferenced_blobs(referenced_digests):
+    """Remove blobs not contained in ``referenced_digests`` from the blob store.
+
+    Blobs stored or re-used within the last ``BLOB_GRACE_SECS`` seconds are kept.
+    The number of removed blobs and bytes freed are returned.
+    """
+    store_dir = os.path.join(settings.MEDIA_ROOT, "material_build_blobs")
+    min_mtime = time.time() - BLOB_GRACE_SECS
+    num = size = 0
+    for root, dirnames, filenames in os.walk(store_dir):
+        for filename in filenames:
+            # Compressed variants go together with their blob
+            digest = os.path.basename(root) + filename.split(".", 1)[0]
+            path = os.path.join(root, filename)
+            if digest in referenced_digests:
+                continue
+            try:
+                stat = os.stat(path)
+                if stat.st_mtime >= min_mtime:
+                    continue
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            num += 1
+            size += stat.st_size
+    return num, size
+
+
+def store_files(files, manifest_path, compress=False):
+    """Add files to the content-addressed blob store and write a manifest of them.
+
+    ``files`` has to be an iterable of ``(relative path, disk path)`` tuples. Files
+    with identical content, no matter of which build or course, are stored only
+    once. The manifest maps the relative paths to the SHA-256 digests of the files.
+
+    If ``compress`` is set, precompressed variants are created for the files
+    matching ``COMPRESSIBLE_PATTERNS`` (see :func:`compress_blob`) and the content
+    codings available for each file are recorded in the manifest as well.
+
+    The number of files and their total size in bytes are returned.
+    """
+    files_manifest = {}
+    encodings_manifest = {}
+    total_size = 0
+    for rel_path, disk_path in files:
+        digest = hash_file(disk_path)
+        blob_path = get_blob_path(digest)
+        try:
+            # Refresh modification time to protect the blob from being removed
+            # before the manifest is written
+            os.utime(blob_path)
+        except FileNotFoundError:
+
+            def _copy(dest):
+                with open(disk_path, "rb") as src:
+                    shutil.copyfileobj(src, dest)
+
+            _write_blob_file(blob_path, _copy)
+        files_manifest[rel_path] = digest
+        size = os.path.getsize(blob_path)
+        total_size += size
+        if (
+            compress
+            and any(
+                fnmatch.fnmatchcase(posixpath.basename(rel_path), pattern)
+                for pattern in COMPRESSIBLE_PATTERNS
+            )
+            and size >= COMPRESS_MIN_SIZE
+        ):
+            encodings = [
+                encoding
+                for encoding in get_supported_encodings()
+                if compress_blob(digest, encoding)
+            ]
+            if encodings:
+                encodings_manifest[rel_path] = encodings
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    with open(manifest_path, "w") as file:
+        json.dump({"files": files_manifest, "encodings": encodings_manifest}, file)
+    return len(files_manifest), total_size
+
+
+def walk_files(root, ignore=None):
+    """Yield ``(relative path, disk path)`` tuples of all files under ``root``.
+
+    Relative paths use forward slashes. ``ignore`` may be a callable as produced by
+    :func:`ignore_by_patterns`, matching files and directories are skipped.
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        if ignore is not None:
+            ignored = set(ignore(dirpath, dirnames + filenames))
+            dirnames[:] = [name for name in dirnames if name not in ignored]
+            filenames = [name for name in filenames if name not in ignored]
+        rel_dir = os.path.relpath(dirpath, root)
+        for filename in filenames:
+            yield (
+                posixpath.normpath(posixpath.join(*rel_dir.split(os.sep), filename)),
+                os.path.join(dirpath, filename),
+            )
+
+
+def _write_blob_file(path, write_func):
+    """Create a file in the blob store atomically.
+
+    ``write_func`` is called with a file object opened for writing binary data.
+    It's written to a temporary file first, so that no incomplete blob can appear.
+    """
+    blob_dir = os.path.dirname(path)
+    os.makedirs(blob_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=blob_dir, prefix=".tmp_")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            write_func(file)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
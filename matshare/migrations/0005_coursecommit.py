@@ -0,0 +1,56 @@
+# Generated by Django 3.0.14 on 2026-10-16 19:36
+
+from django.db import migrations, models
+import django.db.models.deletion
+import rules.contrib.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("matshare", "0004_auto_20201012_1804"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CourseCommit",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("revision", models.CharField(max_length=64, verbose_name="revision")),
+                ("seq", models.PositiveIntegerField()),
+                (
+                    "author_email",
+                    models.TextField(verbose_name="author e-mail address"),
+                ),
+                ("author_name", models.TextField(verbose_name="author name")),
+                ("author_time", models.DateTimeField(verbose_name="author time")),
+                ("message", models.TextField(verbose_name="message")),
+                ("material_changed", models.BooleanField()),
+                ("sources_changed", models.BooleanField()),
+                (
+                    "course",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="commits",
+                        to="matshare.Course",
+                        verbose_name="course",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "commit",
+                "verbose_name_plural": "commits",
+                "unique_together": {("course", "revision")},
+                "index_together": {("course", "seq")},
+            },
+            bases=(rules.contrib.models.RulesModelMixin, models.Model),
+        ),
+    ]
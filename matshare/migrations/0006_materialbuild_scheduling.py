@@ -0,0 +1,29 @@
+# Generated by Django 3.0.14 on 2026-10-16 19:55
+
+from django.db import migrations, models
+import matshare.models
+import matshare.utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("matshare", "0005_coursecommit"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="materialbuild",
+            name="date_started",
+            field=models.DateTimeField(null=True, verbose_name="started"),
+        ),
+        migrations.AddField(
+            model_name="materialbuild",
+            name="priority",
+            field=matshare.utils.IntegerEnumField(
+                matshare.models.MaterialBuild.Priority,
+                default=100,
+                verbose_name="priority",
+            ),
+        ),
+    ]
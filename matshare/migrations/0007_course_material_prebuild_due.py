@@ -0,0 +1,20 @@
+# Generated by Django 3.0.14 on 2026-10-16 19:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("matshare", "0006_materialbuild_scheduling"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="course",
+            name="material_prebuild_due",
+            field=models.DateTimeField(
+                blank=True, null=True, verbose_name="material pre-build due"
+            ),
+        ),
+    ]
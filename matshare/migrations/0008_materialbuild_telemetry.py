@@ -0,0 +1,36 @@
+# Generated by Django 3.0.14 on 2026-10-16 19:59
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("matshare", "0007_course_material_prebuild_due"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="materialbuild",
+            name="output_files",
+            field=models.PositiveIntegerField(null=True, verbose_name="output files"),
+        ),
+        migrations.AddField(
+            model_name="materialbuild",
+            name="output_size",
+            field=models.BigIntegerField(null=True, verbose_name="output size"),
+        ),
+        migrations.AddField(
+            model_name="materialbuild",
+            name="peak_rss",
+            field=models.BigIntegerField(null=True, verbose_name="peak memory usage"),
+        ),
+        migrations.AddField(
+            model_name="materialbuild",
+            name="phase_durations",
+            field=django.contrib.postgres.fields.jsonb.JSONField(
+                blank=True, default=dict, verbose_name="phase durations"
+            ),
+        ),
+    ]
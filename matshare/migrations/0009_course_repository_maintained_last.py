@@ -0,0 +1,20 @@
+# Generated by Django 3.0.14 on 2026-10-16 20:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("matshare", "0008_materialbuild_telemetry"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="course",
+            name="repository_maintained_last",
+            field=models.DateTimeField(
+                blank=True, null=True, verbose_name="repository maintained last"
+            ),
+        ),
+    ]
@@ -1,9 +1,13 @@
 import contextlib
 import datetime
 import functools
+import hashlib
 import logging
 import os
 import posixpath
+import subprocess
+import tempfile
+import time
 from xml.dom import minidom
 import xml.etree.ElementTree as ET
 
@@ -17,13 +21,17 @@ from django.contrib.postgres.fields import (
     RangeBoundary,
     RangeOperators,
 )
+from django.contrib.postgres.fields.jsonb import KeyTextTransform
 from django.core import validators as django_validators
+from django.core.cache import cache
 from django.core.exceptions import (
     ImproperlyConfigured,
     PermissionDenied,
     ValidationError,
 )
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Cast
 from django.http import HttpRequest
 from django.urls import reverse
 from django.utils import timezone, translation
@@ -41,8 +49,15 @@ from rules.contrib.models import RulesModel, RulesModelBase
 from timezone_field import TimeZoneField
 import watson.search
 
+from . import material_building
 from .git import utils as git_utils
-from .utils import ISBNField, IntegerEnumField, MatShareEmailMessage
+from .utils import (
+    ISBNField,
+    IntegerEnumField,
+    MatShareEmailMessage,
+    rmtree_and_clean,
+    stream_zip,
+)
 
 
 LOGGER = logging.getLogger(__name__)
@@ -150,6 +165,20 @@ class DateRange(models.Func):
     output_field = DateRangeField()
 
 
+class Percentile(models.Aggregate):
+    """
+    Adapter for PostgreSQL's PERCENTILE_DISC aggregate, which picks the
+    ``percent``-th percentile of an expression's values using the nearest rank.
+    """
+
+    function = "PERCENTILE_DISC"
+    name = "Percentile"
+    template = "%(function)s(%(percent)s) WITHIN GROUP (ORDER BY %(expressions)s)"
+
+    def __init__(self, expression, percent, **extra):
+        super().__init__(expression, percent=percent / 100, **extra)
+
+
 class NotificationFrequency(models.IntegerChoices):
     """
     How often to send notificatzion mails about changes at most.
@@ -209,8 +238,8 @@ class CourseQuerySet(QuerySet):
         something else than ``Course.AccessLevel.none``, but all work is done solely
         by the database.
 
-        Note that the resulting query set may contain the same course multiple times
-        due to JOINs, so call ``distinct()`` on it if desired.
+        Memberships are checked with ``IN`` subqueries rather than JOINs, hence
+        every course is contained at most once and no ``distinct()`` is needed.
         """
         if isinstance(request_or_user, HttpRequest):
             request = request_or_user
@@ -241,27 +270,137 @@ class CourseQuerySet(QuerySet):
             Q(metadata_audience__lte=Course.Audience.users)
             # Courses visible to study courses the user is in
             | Q(metadata_audience=Course.Audience.study_course)
-            & Q(study_course__students__in=(user,))
+            & Q(
+                study_course__in=User.study_courses.through.objects.filter(
+                    user=user
+                ).values("studycourse")
+            )
             # Courses the user is editor of
-            | Q(editors__in=(user,))
+            | Q(
+                pk__in=CourseEditorSubscription.objects.filter(user=user).values(
+                    "course"
+                )
+            )
             # Courses the user is subscribed to
-            | Q(students__in=(user,))
+            | Q(
+                pk__in=CourseStudentSubscription.objects.filter(user=user).values(
+                    "course"
+                )
+            )
         )
 
-    def with_access_level_prefetching(self):
-        """Prefetch all fields required for calculating access levels."""
-        return self.select_related("study_course").prefetch_related(
-            "editors",
-            "student_subscriptions",
-            "student_subscriptions__user",
-            "super_courses",
-            "super_courses__student_subscriptions",
-            "super_courses__student_subscriptions__user",
+    def maintain_repositories(self):
+        """Pack the objects of repositories changed since they were maintained last.
+
+        Repositories with more loose objects come first, followed by the ones
+        changed most recently. Only those with at least
+        ``MS_GIT_MAINTENANCE_LOOSE_OBJECTS`` loose objects are maintained, up to
+        ``MS_GIT_MAINTENANCE_MAX_REPOS`` per call. The remaining ones are left for
+        later calls. See :func:`matshare.git.utils.maintain_repository` for what's
+        done.
+        """
+        now = timezone.now()
+        candidates = []
+        courses = self.filter(is_static=False).filter(
+            Q(repository_maintained_last=None)
+            | Q(material_updated_last__gt=models.F("repository_maintained_last"))
+            | Q(sources_updated_last__gt=models.F("repository_maintained_last"))
         )
+        for course in courses:
+            try:
+                stats = git_utils.get_object_stats(course.absolute_repository_path)
+            except (OSError, subprocess.CalledProcessError):
+                LOGGER.exception("Can't inspect repository of %r", course)
+                continue
+            last_activity = max(
+                filter(
+                    None, (course.material_updated_last, course.sources_updated_last)
+                ),
+                default=datetime.datetime.min.replace(tzinfo=datetime.timezone.utc),
+            )
+            candidates.append((stats["count"], last_activity, course))
+        candidates.sort(key=lambda candidate: candidate[:2], reverse=True)
+        done = [
+            course
+            for count, last_activity, course in candidates
+            if count < settings.MS_GIT_MAINTENANCE_LOOSE_OBJECTS
+        ]
+        num_maintained = 0
+        total_duration = 0
+        total_reclaimed = 0
+        for count, last_activity, course in candidates[
+            : settings.MS_GIT_MAINTENANCE_MAX_REPOS
+        ]:
+            if count < settings.MS_GIT_MAINTENANCE_LOOSE_OBJECTS:
+                break
+            try:
+                result = git_utils.maintain_repository(course.absolute_repository_path)
+            except (OSError, subprocess.CalledProcessError):
+                LOGGER.exception("Maintaining the repository of %r failed", course)
+                continue
+            done.append(course)
+            num_maintained += 1
+            reclaimed = result["size_before"] - result["size_after"]
+            total_duration += result["duration"]
+            total_reclaimed += reclaimed
+            LOGGER.info(
+                "Maintained repository of %r with %d loose objects in %.2f seconds "
+                "(full repack: %r), %d bytes reclaimed",
+                course,
+                count,
+                result["duration"],
+                result["full_repack"],
+                reclaimed,
+            )
+        # Changes made meanwhile will have a later date and qualify again
+        self.filter(pk__in=[course.pk for course in done]).update(
+            repository_maintained_last=now
+        )
+        if num_maintained:
+            LOGGER.info(
+                "Maintained %d repositories in %.2f seconds, %d bytes reclaimed",
+                num_maintained,
+                total_duration,
+                total_reclaimed,
+            )
+
+    def prebuild_material(self):
+        """Create background builds for courses with a pre-build being due.
+
+        Courses with more active student subscriptions come first, so that their
+        material is likely to be ready when students want to download it. See
+        :meth:`Course.mark_material_updated` for how pre-builds get due.
+        """
+        now = timezone.now()
+        courses = (
+            self.filter(material_prebuild_due__lte=now)
+            .annotate(
+                num_subscribers=models.Count(
+                    "student_subscriptions",
+                    filter=Q(student_subscriptions__active=True),
+                )
+            )
+            .order_by("-num_subscribers", "material_prebuild_due")
+        )
+        for course in courses:
+            with transaction.atomic():
+                # Another push might have postponed the pre-build in the meantime
+                if not self.filter(pk=course.pk, material_prebuild_due__lte=now).update(
+                    material_prebuild_due=None
+                ):
+                    continue
+                course.refresh_from_db(fields=("material_revision",))
+                if not course.material_revision:
+                    continue
+                LOGGER.debug("Pre-building material of %r", course)
+                for format in MaterialBuild.Format:
+                    MaterialBuild.objects.request(
+                        course, format, MaterialBuild.Priority.background
+                    )
 
     def with_prefetching(self):
         """Prefetch fields needed for displaying."""
-        return self.select_related("term", "type")
+        return self.select_related("study_course", "term", "type")
 
 
 def _get_default_course_publisher():
@@ -533,6 +672,9 @@ class Course(create_slug_mixin(max_length=150, unique=False), Model):
     material_updated_last = models.DateTimeField(
         null=True, blank=True, verbose_name=_("material updated last")
     )
+    material_prebuild_due = models.DateTimeField(
+        null=True, blank=True, verbose_name=_("material pre-build due")
+    )
     sources_revision = models.CharField(
         max_length=64,
         blank=True,
@@ -541,6 +683,9 @@ class Course(create_slug_mixin(max_length=150, unique=False), Model):
     sources_updated_last = models.DateTimeField(
         null=True, blank=True, verbose_name=_("sources updated last")
     )
+    repository_maintained_last = models.DateTimeField(
+        null=True, blank=True, verbose_name=_("repository maintained last")
+    )
 
     def __str__(self):
         if self.term is None:
@@ -573,6 +718,18 @@ class Course(create_slug_mixin(max_length=150, unique=False), Model):
         self._ensure_not_is_static()
         return os.path.join(settings.MS_GIT_ROOT, self.repository_path)
 
+    @cached_property
+    def absolute_material_build_workspaces_path(self):
+        """Absolute path of the directory holding this course's build workspaces.
+
+        Workspaces are kept across revisions, hence they're stored per course pk
+        rather than per slug path.
+        """
+        self._ensure_not_is_static()
+        return os.path.join(
+            settings.MEDIA_ROOT, "material_build_workspaces", str(self.pk)
+        )
+
     @cached_property
     def absolute_static_material_path(self):
         """Absolute path of the directory this course's static material resides in."""
@@ -671,99 +828,13 @@ class Course(create_slug_mixin(max_length=150, unique=False), Model):
         Two values are returned: The `class:`AccessLevel` object and the
         :class:`EasyAccess` object that led to this access level. If the
         authorization is not EasyAccess-based, the second value will be ``None``.
-        """
-        # The code flow in this function looks a bit fiddly, that's because it hardly
-        # tries to do only as much as really needed. Since this method is called in
-        # most requests, optimizing here makes a lot of sense and should justify the
-        # somewhat longer code. Comments are there to help understanding what's it
-        # all about.
-        if isinstance(request_or_user, HttpRequest):
-            request = request_or_user
-            user = request.user
-        else:
-            request = None
-            user = request_or_user
-
-        # Staff always has write access
-        if user.is_staff:
-            return self.AccessLevel.rw, None
-
-        # Authorization via EasyAccess link
-        easy_access = None
-        level = self.AccessLevel.none
-        if request is not None:
-            try:
-                easy_access_pk = request.session["easy_access"][str(self.pk)]
-                easy_access = (
-                    EasyAccess.objects.valid()
-                    # Double-check course matches, just for consistency
-                    .get(pk=easy_access_pk, course=self)
-                )
-                level = easy_access.access_level
-            except KeyError:
-                # No token for this course stored in the session
-                pass
-            except EasyAccess.DoesNotExist:
-                # Token no longer exists, clean up session data accordingly
-                del request.session["easy_access"][str(self.pk)]
-            else:
-                if level == self.AccessLevel.rw:
-                    # It can't get any higher, stop here
-                    return level, easy_access
-
-        if user.is_authenticated:
-            # Editors always have write access
-            if user in self.editors.all():
-                return self.AccessLevel.rw, None
-            # Subscribed students have their own access level
-            _level = level
-            # Subscribed students inherit their access from super courses,
-            # so we take the maximum level
-            for sub in self.student_subscriptions.all():
-                if sub.user == user and sub.access_level > _level:
-                    _level = sub.access_level
-            for course in self.super_courses.all():
-                for sub in course.student_subscriptions.all():
-                    if sub.user == user and sub.access_level > _level:
-                        _level = sub.access_level
-            # EasyAccess with same access_level takes precedence over subscription
-            if _level > level:
-                level = _level
-                easy_access = None
-
-        # The remaining checks won't yield a level higher than material, so maybe
-        # we can skip them straight away
-        if level >= self.AccessLevel.material:
-            return level, easy_access
-
-        # Check if self.material_audience applies
-        if (
-            self.material_audience == self.Audience.public
-            or user.is_authenticated
-            and (
-                self.material_audience == self.Audience.users
-                or self.material_audience == self.Audience.study_course
-                and self.study_course in user.study_courses.all()
-            )
-        ):
-            return self.AccessLevel.material, None
 
-        # Last resort is self.metadata_audience
-        if level == self.AccessLevel.metadata:
-            return level, easy_access
-        if (
-            self.metadata_audience == self.Audience.public
-            or user.is_authenticated
-            and (
-                self.metadata_audience == self.Audience.users
-                or self.metadata_audience == self.Audience.study_course
-                and self.study_course in users.study_courses.all()
-            )
-        ):
-            return self.AccessLevel.metadata, None
-
-        # All available authorization methods exhausted, no access
-        return self.AccessLevel.none, None
+        The authorization data of the request and/or user is loaded only once and
+        then re-used for all further courses, see :class:`AccessLevelResolver`.
+        """
+        return AccessLevelResolver.for_request_or_user(
+            request_or_user
+        ).get_access_level(self)
 
     def get_git_acl(self, user):
         """Return a tuple of git ACL entries for given user.
@@ -803,15 +874,56 @@ class Course(create_slug_mixin(max_length=150, unique=False), Model):
             ),
         )
 
+    def get_revision_to_mark(self, new_rev, marked_rev):
+        """Return the revision to mark as updated after committing ``new_rev``.
+
+        Changes committed without locking the course might be recorded after
+        those of a concurrent push, which ``marked_rev`` (``material_revision`` or
+        ``sources_revision``) would then contain already. Hence ``new_rev`` is
+        only returned if the main reference still points to it or it descends
+        from ``marked_rev``. Otherwise, the revision the main reference points to
+        now is returned. The course should be locked while calling this.
+        """
+        self._ensure_not_is_static()
+        if new_rev == marked_rev:
+            return new_rev
+        repo = git_utils.open_repository(self.absolute_repository_path)
+        try:
+            current_rev = git_utils.resolve_committish(
+                repo, settings.MS_GIT_MAIN_REF
+            ).id.hex
+        except KeyError:
+            # The reference was deleted
+            current_rev = git_utils.NULL_REFS[0]
+        if new_rev == current_rev:
+            return new_rev
+        if marked_rev:
+            try:
+                if repo.descendant_of(new_rev, marked_rev):
+                    return new_rev
+            except (KeyError, ValueError, pygit2.GitError):
+                # The marked revision is gone, e.g. after a forced push
+                pass
+        return current_rev
+
     def mark_material_updated(self, new_rev):
         """Update git revision in which material was last updated.
 
         All student subscriptions of this course and super-courses are marked for
         notification mail sending.
+
+        If ``MS_MATERIAL_PREBUILD`` is enabled, the material is scheduled for being
+        built in all formats ``MS_MATERIAL_PREBUILD_DELAY`` seconds later. Further
+        updates within that time postpone the pre-build again.
         """
         self._ensure_not_is_static()
         self.material_revision = "" if new_rev in git_utils.NULL_REFS else new_rev
         self.material_updated_last = timezone.now()
+        if settings.MS_MATERIAL_PREBUILD:
+            self.material_prebuild_due = (
+                self.material_updated_last
+                + datetime.timedelta(seconds=settings.MS_MATERIAL_PREBUILD_DELAY)
+            )
         CourseStudentSubscription.objects.filter(
             Q(course=self) | Q(course__sub_courses=self)
         ).update(needs_notification=True)
@@ -881,6 +993,188 @@ class Course(create_slug_mixin(max_length=150, unique=False), Model):
         super().validate_unique(exclude=exclude)
 
 
+class AccessLevelResolver:
+    """
+    Computes :class:`Course.AccessLevel` objects of a request and/or user for any
+    number of courses.
+
+    All authorization data (editor memberships, student subscriptions, courses of
+    study and EasyAccess tokens) is loaded lazily with one query per kind, so that
+    listing many courses doesn't cost any queries per course. Use
+    :meth:`for_request_or_user` rather than instantiating this directly, so that
+    the resolver is shared for the whole request.
+
+    The data of a user can additionally be cached across requests for
+    ``MS_ACCESS_LEVEL_CACHE_SECS`` seconds. The signal handlers in
+    :mod:`matshare.django_signals` invalidate it when subscriptions change.
+    EasyAccess tokens aren't tied to users, hence they're never cached.
+    """
+
+    CACHE_KEY_PREFIX = "matshare:access_level"
+
+    def __init__(self, request_or_user):
+        if isinstance(request_or_user, HttpRequest):
+            self.request = request_or_user
+            self.user = request_or_user.user
+        else:
+            self.request = None
+            self.user = request_or_user
+
+    @classmethod
+    def for_request_or_user(cls, request_or_user):
+        """Return the resolver attached to a request or user, creating it first."""
+        try:
+            return request_or_user._access_level_resolver
+        except AttributeError:
+            resolver = cls(request_or_user)
+            request_or_user._access_level_resolver = resolver
+            return resolver
+
+    @classmethod
+    def get_cache_key(cls, user_pk):
+        return f"{cls.CACHE_KEY_PREFIX}:{user_pk}"
+
+    @classmethod
+    def invalidate(cls, *user_pks):
+        """Drop the cached authorization data of the given users."""
+        if settings.MS_ACCESS_LEVEL_CACHE_SECS and user_pks:
+            keys = [cls.get_cache_key(pk) for pk in user_pks]
+            # Other processes could re-cache the old state until the change is
+            # committed, so wait for that
+            transaction.on_commit(lambda: cache.delete_many(keys))
+
+    @cached_property
+    def easy_accesses(self):
+        """Mapping of course pks to valid :class:`EasyAccess` objects of the session."""
+        if self.request is None:
+            # EasyAccess only works when a request was provided
+            return {}
+        session_data = self.request.session.get("easy_access")
+        if not session_data:
+            return {}
+        easy_accesses = {}
+        for easy_access in EasyAccess.objects.valid().filter(
+            pk__in=session_data.values()
+        ):
+            # Double-check course matches, just for consistency
+            if session_data.get(str(easy_access.course_id)) == easy_access.pk:
+                easy_accesses[easy_access.course_id] = easy_access
+        # Tokens no longer existing, clean up session data accordingly
+        for course_pk in tuple(session_data):
+            if int(course_pk) not in easy_accesses:
+                del session_data[course_pk]
+                self.request.session.modified = True
+        return easy_accesses
+
+    @cached_property
+    def user_data(self):
+        """Authorization data of an authenticated user.
+
+        It's a tuple of the set of edited course pks, a mapping of course pks to
+        the access levels granted by subscriptions and the set of pks of the
+        user's courses of study.
+        """
+        timeout = settings.MS_ACCESS_LEVEL_CACHE_SECS
+        if timeout:
+            data = cache.get(self.get_cache_key(self.user.pk))
+            if data is not None:
+                return data
+        edited_pks = frozenset(
+            CourseEditorSubscription.objects.filter(user=self.user).values_list(
+                "course", flat=True
+            )
+        )
+        own_levels = dict(
+            CourseStudentSubscription.objects.filter(user=self.user).values_list(
+                "course", "access_level"
+            )
+        )
+        # Subscribed students inherit their access from super courses,
+        # so we take the maximum level
+        levels = dict(own_levels)
+        for super_pk, sub_pk in SubCourseRelation.objects.filter(
+            super_course__in=tuple(own_levels)
+        ).values_list("super_course", "sub_course"):
+            if own_levels[super_pk] > levels.get(sub_pk, Course.AccessLevel.none):
+                levels[sub_pk] = own_levels[super_pk]
+        study_course_pks = frozenset(
+            self.user.study_courses.values_list("pk", flat=True)
+        )
+        data = (edited_pks, levels, study_course_pks)
+        if timeout:
+            cache.set(self.get_cache_key(self.user.pk), data, timeout)
+        return data
+
+    def get_access_level(self, course):
+        """Implementation of :meth:`Course.get_access_level`."""
+        # The code flow in this function looks a bit fiddly, that's because it hardly
+        # tries to do only as much as really needed. Since this method is called in
+        # most requests, optimizing here makes a lot of sense and should justify the
+        # somewhat longer code. Comments are there to help understanding what's it
+        # all about.
+        user = self.user
+
+        # Staff always has write access
+        if user.is_staff:
+            return Course.AccessLevel.rw, None
+
+        # Authorization via EasyAccess link
+        easy_access = self.easy_accesses.get(course.pk)
+        if easy_access is None:
+            level = Course.AccessLevel.none
+        else:
+            level = easy_access.access_level
+            if level == Course.AccessLevel.rw:
+                # It can't get any higher, stop here
+                return level, easy_access
+
+        if user.is_authenticated:
+            edited_pks, levels, study_course_pks = self.user_data
+            # Editors always have write access
+            if course.pk in edited_pks:
+                return Course.AccessLevel.rw, None
+            # Subscribed students have their own access level,
+            # EasyAccess with same access_level takes precedence over subscription
+            _level = levels.get(course.pk, Course.AccessLevel.none)
+            if _level > level:
+                level = _level
+                easy_access = None
+        else:
+            study_course_pks = frozenset()
+
+        # The remaining checks won't yield a level higher than material, so maybe
+        # we can skip them straight away
+        if level >= Course.AccessLevel.material:
+            return level, easy_access
+
+        # Check if course.material_audience applies
+        if course.material_audience == Course.Audience.public or (
+            user.is_authenticated
+            and (
+                course.material_audience == Course.Audience.users
+                or course.material_audience == Course.Audience.study_course
+                and course.study_course_id in study_course_pks
+            )
+        ):
+            return Course.AccessLevel.material, None
+
+        # Last resort is course.metadata_audience
+        if level == Course.AccessLevel.metadata:
+            return level, easy_access
+        if course.metadata_audience == Course.Audience.public or (
+            user.is_authenticated
+            and (
+                course.metadata_audience == Course.Audience.users
+                or course.metadata_audience == Course.Audience.study_course
+                and course.study_course_id in study_course_pks
+            )
+        ):
+            return Course.AccessLevel.metadata, None
+
+        # All available authorization methods exhausted, no access
+        return Course.AccessLevel.none, None
+
+
 class SubCourseRelation(Model):
     """
     Relation describing a :class:`Course` is part of another :class:`Course`.
@@ -924,6 +1218,186 @@ class SubCourseRelation(Model):
             raise ValidationError(_("A course can't be a sub-course of itself."))
 
 
+# First key of the PostgreSQL advisory locks serializing updates of the commit index
+# of a course, the second one is the course's primary key
+COURSE_COMMIT_INDEX_LOCK_KEY = 0x6D617463
+
+
+class CourseCommitQuerySet(QuerySet):
+    def between(self, course, revision, since_revision=None):
+        """Commits after ``since_revision`` up to and including ``revision``.
+
+        The commits are ordered newest first. When ``since_revision`` is ``None``
+        or not part of the index, the whole history up to ``revision`` is included.
+        The index is normally updated by the spooler after the main reference has
+        changed. Should ``revision`` not be indexed yet, this is done right away.
+        """
+        if not revision or revision in git_utils.NULL_REFS:
+            return self.none()
+        try:
+            tip = self.get(course=course, revision=revision)
+        except CourseCommit.DoesNotExist:
+            self.index_main_ref(course)
+            try:
+                tip = self.get(course=course, revision=revision)
+            except CourseCommit.DoesNotExist:
+                # Not part of the history anymore
+                return self.none()
+        qs = self.filter(course=course, seq__lte=tip.seq)
+        if since_revision:
+            try:
+                since = self.get(course=course, revision=since_revision)
+            except CourseCommit.DoesNotExist:
+                pass
+            else:
+                qs = qs.filter(seq__gt=since.seq)
+        return qs.order_by("-seq")
+
+    def index_main_ref(self, course):
+        """Bring the index of ``course`` up to date with its main reference.
+
+        The :class:`CourseCommit` the reference points to is returned, ``None`` if
+        the reference doesn't exist.
+        """
+        repo = git_utils.open_repository(course.absolute_repository_path)
+        try:
+            commit = git_utils.resolve_committish(repo, settings.MS_GIT_MAIN_REF)
+        except KeyError:
+            return None
+        return self.index_revision(course, commit.id.hex)
+
+    def index_revision(self, course, revision):
+        """Make the index of ``course`` contain the history of ``revision``.
+
+        ``revision`` is supposed to be what the main reference points to. Only
+        commits added since the commit indexed last are inspected. Entries not
+        reachable from ``revision`` anymore, like after a force-push, are removed.
+        The :class:`CourseCommit` of ``revision`` is returned.
+        """
+        with transaction.atomic():
+            # Serialize index updates without blocking others from locking the course
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT PG_ADVISORY_XACT_LOCK(%s, %s)",
+                    (COURSE_COMMIT_INDEX_LOCK_KEY, course.pk),
+                )
+            repo = git_utils.open_repository(course.absolute_repository_path)
+            commit = git_utils.resolve_committish(repo, revision)
+            indexed = self.filter(course=course)
+            # Parents are always indexed before their children, so this is the
+            # revision indexed last and all others are its ancestors
+            last = indexed.order_by("-seq").first()
+            if last is not None and last.revision == commit.id.hex:
+                return last
+
+            walker = repo.walk(
+                commit.id, pygit2.GIT_SORT_TOPOLOGICAL | pygit2.GIT_SORT_REVERSE
+            )
+            next_seq = 0
+            if last is not None:
+                try:
+                    base_id = repo.merge_base(commit.id, last.revision)
+                except (KeyError, ValueError, pygit2.GitError):
+                    # Previously indexed commit is gone from the repository
+                    base_id = None
+                if base_id is None:
+                    # No common history at all, start from scratch
+                    indexed.delete()
+                else:
+                    if base_id.hex != last.revision:
+                        # History was rewritten, drop what's only reachable from
+                        # the revision indexed last
+                        unreachable = repo.walk(last.revision)
+                        unreachable.hide(base_id)
+                        revisions = [child.id.hex for child in unreachable]
+                        for idx in range(0, len(revisions), 500):
+                            indexed.filter(
+                                revision__in=revisions[idx : idx + 500]
+                            ).delete()
+                        LOGGER.debug(
+                            "Removed %d unreachable commits of %r",
+                            len(revisions),
+                            course,
+                        )
+                    walker.hide(base_id)
+                    next_seq = last.seq + 1
+
+            entries = []
+            for seq, child in enumerate(walker, next_seq):
+                if child.parents:
+                    material_changed, sources_changed = git_utils.paths_changed(
+                        child.parents[0],
+                        child,
+                        settings.MS_GIT_EDIT_SUBDIR,
+                        settings.MS_GIT_SRC_SUBDIR,
+                    )
+                else:
+                    # As before, the root commit isn't reported as a change
+                    material_changed = sources_changed = False
+                entries.append(
+                    CourseCommit(
+                        course=course,
+                        revision=child.id.hex,
+                        seq=seq,
+                        material_changed=material_changed,
+                        sources_changed=sources_changed,
+                        **git_utils.extract_commit_info(child),
+                    )
+                )
+            self.bulk_create(entries, batch_size=500)
+            LOGGER.debug("Indexed %d commits of %r", len(entries), course)
+            if entries:
+                return entries[-1]
+            # The reference was moved back to an ancestor
+            return indexed.get(revision=commit.id.hex)
+
+
+class CourseCommit(Model):
+    """
+    A commit in the history of a :class:`Course`'s repository.
+
+    This index is maintained in order to not walk and diff the git history again
+    each time notification mails and feeds are generated.
+    """
+
+    class Meta:
+        index_together = (
+            # Used for querying ranges of the history
+            ("course", "seq"),
+        )
+        unique_together = (("course", "revision"),)
+        verbose_name = _("commit")
+        verbose_name_plural = _("commits")
+        rules_permissions = {
+            "add": rules.always_false,
+            "change": rules.always_false,
+            "delete": rules.is_staff,
+            "view": rules.is_staff,
+        }
+
+    objects = CourseCommitQuerySet.as_manager()
+
+    course = models.ForeignKey(
+        "Course",
+        on_delete=models.CASCADE,
+        related_name="commits",
+        verbose_name=_("course"),
+    )
+    revision = models.CharField(max_length=64, verbose_name=_("revision"))
+    # Position in the topologically sorted history, parents come before children
+    seq = models.PositiveIntegerField()
+    author_email = models.TextField(verbose_name=_("author e-mail address"))
+    author_name = models.TextField(verbose_name=_("author name"))
+    author_time = models.DateTimeField(verbose_name=_("author time"))
+    message = models.TextField(verbose_name=_("message"))
+    # Whether the commit changed MS_GIT_EDIT_SUBDIR or MS_GIT_SRC_SUBDIR, respectively
+    material_changed = models.BooleanField()
+    sources_changed = models.BooleanField()
+
+    def __str__(self):
+        return f"{self.revision[:7]} @ {self.course}"
+
+
 class CourseEditorSubscriptionQuerySet(QuerySet):
     def get_by_natural_key(self, course, user):
         return self.get(course=course, user=user)
@@ -977,17 +1451,13 @@ class CourseEditorSubscription(Model):
         ):
             return
 
-        # Annotate course with the commits since the last notification
-        self.course.latest_commits = []
-        repo = pygit2.Repository(self.course.absolute_repository_path)
-        for parent, child in git_utils.walk_pairwise(
-            repo, self.course.sources_revision, self.last_notified_revision
-        ):
-            # Only respect commits that changed the src directory
-            if next(git_utils.paths_changed(parent, child, settings.MS_GIT_SRC_SUBDIR)):
-                self.course.latest_commits.append(git_utils.extract_commit_info(child))
-                if len(self.course.latest_commits) == 10:
-                    break
+        # Annotate course with the commits since the last notification that
+        # changed the src directory
+        self.course.latest_commits = list(
+            CourseCommit.objects.between(
+                self.course, self.course.sources_revision, self.last_notified_revision
+            ).filter(sources_changed=True)[:10]
+        )
 
         # Send the mail
         with self.user.localized():
@@ -1118,20 +1588,14 @@ class CourseStudentSubscription(Model):
         """Send mail about new material to the user."""
         # Annotate courses with the commits since the last notification
         for course in self.unnotified_courses:
-            course.latest_commits = []
-            repo = pygit2.Repository(course.absolute_repository_path)
-            for parent, child in git_utils.walk_pairwise(
-                repo,
-                course.material_revision,
-                self.last_notified_revisions.get(str(course.pk)),
-            ):
-                # Only respect commits that changed the edit directory
-                if next(
-                    git_utils.paths_changed(parent, child, settings.MS_GIT_EDIT_SUBDIR)
-                ):
-                    course.latest_commits.append(git_utils.extract_commit_info(child))
-                    if len(course.latest_commits) == 10:
-                        break
+            # Only respect commits that changed the edit directory
+            course.latest_commits = list(
+                CourseCommit.objects.between(
+                    course,
+                    course.material_revision,
+                    self.last_notified_revisions.get(str(course.pk)),
+                ).filter(material_changed=True)[:10]
+            )
 
         # Send the mail
         if self.unnotified_courses:
@@ -1317,16 +1781,299 @@ class CourseType(create_slug_mixin(max_length=20), Model):
         return (self.slug,)
 
 
+# First key of the PostgreSQL advisory locks spooler processes hold while running a
+# build, the second one is the build's primary key
+MATERIAL_BUILD_LOCK_KEY = 0x6D617473
+
+
 class MaterialBuildQuerySet(QuerySet):
     def clear_outdated(self):
-        """Remove all builds except those of the current revisions."""
-        num, _ = self.exclude(revision=models.F("course__material_revision")).delete()
+        """Remove the results of all builds except those of the current revisions.
+
+        Builds of older revisions are kept in the database for
+        ``MS_MATERIAL_BUILD_HISTORY_DAYS`` days for the sake of their telemetry.
+        Should their revision become current again, :meth:`request` queues them
+        again.
+        """
+        outdated = self.exclude(revision=models.F("course__material_revision"))
+        num, _ = outdated.filter(
+            date_created__lt=timezone.now()
+            - datetime.timedelta(days=settings.MS_MATERIAL_BUILD_HISTORY_DAYS)
+        ).delete()
         LOGGER.debug("Deleted %d outdated material builds", num)
+        for build in outdated.with_prefetching().filter(
+            status__in=(MaterialBuild.Status.completed, MaterialBuild.Status.failed)
+        ):
+            build.remove_results()
+        # Now remove files no remaining build refers to
+        digests = set()
+        for build in MaterialBuild.objects.with_prefetching():
+            try:
+                digests.update(
+                    material_building.read_manifest(build.absolute_manifest_path)[
+                        "files"
+                    ].values()
+                )
+            except FileNotFoundError:
+                # Not finished yet, outdated or made before manifests were introduced
+                pass
+        num, size = material_building.remove_unreferenced_blobs(digests)
+        LOGGER.debug("Removed %d unreferenced blobs with %d bytes", num, size)
+
+    def claim_next(self):
+        """Pick the next build to run from the queue and mark it as building.
+
+        Waiting builds of revisions that aren't current anymore are marked as
+        superseded first, so that a burst of pushes results in one build only.
+        Builds with higher priority are picked first, then the longest waiting ones.
+        Courses having ``MS_MATERIAL_BUILD_COURSE_CONCURRENCY`` builds running
+        already are skipped. ``None`` is returned if there's nothing to build.
+
+        The returned build is marked as running by an advisory lock held by the
+        current database connection, which :meth:`MaterialBuild.release_lock` has to
+        release once done. Builds that were interrupted are queued again first, see
+        :meth:`requeue_interrupted`.
+        """
+        self.requeue_interrupted()
+        num = (
+            self.filter(status=MaterialBuild.Status.waiting)
+            .exclude(revision=models.F("course__material_revision"))
+            .update(status=MaterialBuild.Status.superseded, date_done=timezone.now())
+        )
+        if num:
+            LOGGER.info("Superseded %d waiting material builds", num)
+        limit = settings.MS_MATERIAL_BUILD_COURSE_CONCURRENCY
+        busy_course_pks = (
+            self.filter(status=MaterialBuild.Status.building)
+            .values("course")
+            .annotate(num=models.Count("pk"))
+            .filter(num__gte=limit)
+            .values("course")
+        )
+        candidates = (
+            self.filter(status=MaterialBuild.Status.waiting)
+            .exclude(course__in=busy_course_pks)
+            .order_by("-priority", "date_created")
+            .values_list("pk", "course")
+        )
+        for build_pk, course_pk in candidates:
+            with transaction.atomic():
+                # Serialize claims per course to enforce the concurrency limit
+                if (
+                    Course.objects.select_for_update().filter(pk=course_pk).first()
+                    is None
+                ):
+                    # Deleted in the meantime
+                    continue
+                if (
+                    self.filter(
+                        course=course_pk, status=MaterialBuild.Status.building
+                    ).count()
+                    >= limit
+                ):
+                    continue
+                build = (
+                    self.with_prefetching()
+                    .select_for_update(of=("self",), skip_locked=True)
+                    .filter(pk=build_pk, status=MaterialBuild.Status.waiting)
+                    .first()
+                )
+                if build is None:
+                    # Claimed by someone else in the meantime
+                    continue
+                # Taken before the build is visible as building to others, so that
+                # requeue_interrupted() never sees it without the lock
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        "SELECT PG_ADVISORY_LOCK(%s, %s)",
+                        (MATERIAL_BUILD_LOCK_KEY, build.pk),
+                    )
+                build.status = MaterialBuild.Status.building
+                build.date_started = timezone.now()
+                build.save()
+                return build
+        return None
+
+    def get_queue_stats(self):
+        """Return a dict with figures about the build queue for monitoring.
+
+        It contains the number of waiting builds per priority, the number of running
+        builds and the longest current wait. Average and maximum wait and build time
+        are computed over builds done within the last 24 hours. Times are given as
+        :class:`datetime.timedelta` objects or ``None``.
+        """
+        now = timezone.now()
+        waiting = self.filter(status=MaterialBuild.Status.waiting)
+        stats = {
+            "waiting": {
+                priority: waiting.filter(priority=priority).count()
+                for priority in MaterialBuild.Priority
+            },
+            "building": self.filter(status=MaterialBuild.Status.building).count(),
+            "oldest_waiting": None,
+        }
+        oldest = waiting.order_by("date_created").values_list(
+            "date_created", flat=True
+        )[:1]
+        if oldest:
+            stats["oldest_waiting"] = now - oldest[0]
+        stats.update(
+            self.filter(
+                date_started__isnull=False,
+                date_done__gte=now - datetime.timedelta(days=1),
+            ).aggregate(
+                avg_wait=models.Avg(
+                    models.F("date_started") - models.F("date_created")
+                ),
+                max_wait=models.Max(
+                    models.F("date_started") - models.F("date_created")
+                ),
+                avg_build=models.Avg(models.F("date_done") - models.F("date_started")),
+                max_build=models.Max(models.F("date_done") - models.F("date_started")),
+            )
+        )
+        return stats
+
+    def get_telemetry_stats(self, limit=None):
+        """Return percentiles of build telemetry per course and format.
+
+        Completed builds are grouped by course and format. For each group, a dict
+        with ``course``, ``format``, number of ``builds`` and the 50th and 95th
+        percentiles of build time (``build_p50``, ``build_p95``), each phase's
+        duration (``phases`` mapping phase names to ``(p50, p95)`` tuples in
+        seconds), ``peak_rss``, ``output_size`` and ``output_files`` is generated.
+        Groups are ordered by descending 95th percentile of build time and only the
+        first ``limit`` ones are returned, if given. Percentiles are computed by
+        the database.
+        """
+        builds = self.filter(
+            status=MaterialBuild.Status.completed, date_started__isnull=False
+        )
+        phases = sorted(
+            builds.annotate(
+                phase=models.Func(
+                    models.F("phase_durations"), function="JSONB_OBJECT_KEYS"
+                )
+            )
+            .order_by()
+            .values_list("phase", flat=True)
+            .distinct()
+        )
+        aggregates = {"builds": models.Count("pk")}
+        for key, expression in (
+            ("build", models.F("date_done") - models.F("date_started")),
+            ("peak_rss", "peak_rss"),
+            ("output_size", "output_size"),
+            ("output_files", "output_files"),
+            *(
+                (
+                    f"phase_{idx}",
+                    Cast(
+                        KeyTextTransform(phase, "phase_durations"),
+                        models.FloatField(),
+                    ),
+                )
+                for idx, phase in enumerate(phases)
+            ),
+        ):
+            aggregates[f"{key}_p50"] = Percentile(expression, 50)
+            aggregates[f"{key}_p95"] = Percentile(expression, 95)
+        rows = (
+            builds.values("course", "format")
+            .annotate(**aggregates)
+            .order_by(models.F("build_p95").desc(nulls_last=True), "course", "format")
+        )
+        if limit is not None:
+            rows = rows[:limit]
+        rows = list(rows)
+        courses = Course.objects.select_related("term", "type").in_bulk(
+            {row["course"] for row in rows}
+        )
+        stats = []
+        for row in rows:
+            item = {
+                "course": courses[row.pop("course")],
+                "format": MaterialBuild.Format(row.pop("format")),
+                "phases": {},
+            }
+            for idx, phase in enumerate(phases):
+                p50, p95 = row.pop(f"phase_{idx}_p50"), row.pop(f"phase_{idx}_p95")
+                if p50 is not None:
+                    item["phases"][phase] = (p50, p95)
+            item.update(row)
+            stats.append(item)
+        return stats
+
+    def requeue_interrupted(self):
+        """Queue builds again whose spooler process died while running them.
+
+        Running a build, a spooler holds an advisory lock in the database, which
+        vanishes with its connection when it crashes, is restarted or killed.
+        Builds marked as building without the lock being held hence never finish
+        and would count against the course's concurrency limit forever. The number
+        of builds queued again is returned.
+        """
+        num = (
+            self.filter(status=MaterialBuild.Status.building)
+            .exclude(
+                pk__in=RawSQL(
+                    # Advisory locks are scoped to the database they're taken in,
+                    # other databases of the server may use the same keys
+                    "SELECT objid::integer FROM pg_locks "
+                    "WHERE locktype = 'advisory' AND classid = %s AND objsubid = 2 "
+                    "AND database = "
+                    "(SELECT oid FROM pg_database WHERE datname = current_database())",
+                    (MATERIAL_BUILD_LOCK_KEY,),
+                )
+            )
+            .update(status=MaterialBuild.Status.waiting, date_started=None)
+        )
+        if num:
+            LOGGER.warning("Queued %d interrupted material builds again", num)
+        return num
+
+    def request(self, course, format, priority=None):
+        """Return the build of the course's current material revision in ``format``.
+
+        The build is created when it doesn't exist yet. ``priority`` defaults to
+        :attr:`MaterialBuild.Priority.interactive`, as someone is waiting for the
+        result then. A waiting build's priority is raised if necessary.
+
+        The main reference may return to an older revision, e.g. by resetting it.
+        That revision's build is queued again if it was superseded or its results
+        were removed as outdated already.
+        """
+        if priority is None:
+            priority = MaterialBuild.Priority.interactive
+        build, created = self.with_prefetching().get_or_create(
+            course=course,
+            format=format,
+            revision=course.material_revision,
+            defaults={"priority": priority},
+        )
+        if created:
+            return build
+        if build.needs_requeue:
+            with transaction.atomic():
+                # Lock the build against concurrent requests and claiming
+                build = (
+                    self.with_prefetching()
+                    .select_for_update(of=("self",))
+                    .get(pk=build.pk)
+                )
+                if build.needs_requeue:
+                    LOGGER.info("Queueing %r again", build)
+                    build.requeue(priority)
+                    return build
+        if build.status == MaterialBuild.Status.waiting and build.priority < priority:
+            build.priority = priority
+            self.filter(pk=build.pk).update(priority=priority)
+        return build
 
     def with_prefetching(self):
         """Prefetch fields used in many methods of :class:`MaterialBuild`."""
         return self.select_related(
-            "course", "course__term", "course__type"
+            "course", "course__study_course", "course__term", "course__type"
         ).prefetch_related("course__sub_courses")
 
 
@@ -1339,11 +2086,16 @@ class MaterialBuild(Model):
         epub = 100, "EPUB"
         html = 200, "HTML"
 
+    class Priority(models.IntegerChoices):
+        background = 100, _("background")
+        interactive = 200, _("interactive")
+
     class Status(models.IntegerChoices):
         waiting = 100, _("waiting")
         building = 200, _("building")
         completed = 300, _("completed")
         failed = 400, _("failed")
+        superseded = 500, _("superseded")
 
     class Meta:
         unique_together = (("course", "format", "revision"),)
@@ -1367,9 +2119,21 @@ class MaterialBuild(Model):
     revision = models.CharField(max_length=40, verbose_name=_("revision"))
     format = IntegerEnumField(Format, verbose_name=_("format"))
     status = IntegerEnumField(Status, default=Status.waiting, verbose_name=_("status"))
+    priority = IntegerEnumField(
+        Priority, default=Priority.background, verbose_name=_("priority")
+    )
     error_message = models.TextField(blank=True, verbose_name=_("error message"))
     date_created = models.DateTimeField(auto_now_add=True, verbose_name=_("created"))
+    date_started = models.DateTimeField(null=True, verbose_name=_("started"))
     date_done = models.DateTimeField(null=True, verbose_name=_("done"))
+    phase_durations = JSONField(
+        default=dict, blank=True, verbose_name=_("phase durations")
+    )
+    peak_rss = models.BigIntegerField(null=True, verbose_name=_("peak memory usage"))
+    output_size = models.BigIntegerField(null=True, verbose_name=_("output size"))
+    output_files = models.PositiveIntegerField(
+        null=True, verbose_name=_("output files")
+    )
 
     def __repr__(self):
         return (
@@ -1381,6 +2145,79 @@ class MaterialBuild(Model):
     def __str__(self):
         return f"{self.course} ({self.revision[:7]}, {self.format.label})"
 
+    @contextlib.contextmanager
+    def record_phase(self, name):
+        """Context manager measuring the duration of a build phase.
+
+        The duration in seconds is added to :attr:`phase_durations` under ``name``,
+        also when an exception is raised.
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phase_durations[name] = self.phase_durations.get(name, 0) + (
+                time.monotonic() - start
+            )
+
+    def remove_results(self):
+        """Remove the build results directory, if any."""
+        if not os.path.exists(self.absolute_path):
+            return
+        LOGGER.info("Removing material build directory %r", self.absolute_path)
+        try:
+            rmtree_and_clean(self.absolute_path, settings.MEDIA_ROOT)
+        except OSError as err:
+            LOGGER.warning("Failed to remove %r: %r", self.absolute_path, err)
+
+    def release_lock(self):
+        """Release the lock marking the build as running.
+
+        See :meth:`MaterialBuildQuerySet.claim_next`.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT PG_ADVISORY_UNLOCK(%s, %s)", (MATERIAL_BUILD_LOCK_KEY, self.pk)
+            )
+
+    def requeue(self, priority):
+        """Reset the build to waiting with given priority, dropping its telemetry."""
+        self.status = MaterialBuild.Status.waiting
+        self.priority = priority
+        self.error_message = ""
+        self.date_created = timezone.now()
+        self.date_started = self.date_done = None
+        self.phase_durations = {}
+        self.peak_rss = self.output_size = self.output_files = None
+        self.save()
+
+    @property
+    def build_duration(self):
+        """Time the build took to run as :class:`datetime.timedelta` or ``None``."""
+        if self.date_started is None or self.date_done is None:
+            return None
+        return self.date_done - self.date_started
+
+    @property
+    def wait_duration(self):
+        """Time the build spent in the queue as :class:`datetime.timedelta`.
+
+        For builds not started yet, the time waited so far is returned.
+        """
+        return (self.date_started or timezone.now()) - self.date_created
+
+    @property
+    def needs_requeue(self):
+        """Whether the build has to run (again) to provide results.
+
+        That's the case for superseded builds, which never ran, and completed ones
+        whose results were removed.
+        """
+        return self.status == MaterialBuild.Status.superseded or (
+            self.status == MaterialBuild.Status.completed
+            and not os.path.isdir(self.absolute_path)
+        )
+
     @cached_property
     def absolute_path(self):
         """Absolute path of the build results directory."""
@@ -1397,6 +2234,265 @@ class MaterialBuild(Model):
             self.format.name,
         )
 
+    @cached_property
+    def absolute_manifest_path(self):
+        """Absolute path of the manifest listing the files of this build."""
+        return os.path.join(self.absolute_path, material_building.MANIFEST_NAME)
+
+    @cached_property
+    def files(self):
+        """Mapping of relative paths of the build results to absolute disk paths.
+
+        Paths are resolved through the build's manifest into the blob store. Builds
+        made before manifests were introduced are read from their directory.
+        """
+        if self.manifest is None:
+            return dict(material_building.walk_files(self.absolute_path))
+        return {
+            rel_path: material_building.get_blob_path(digest)
+            for rel_path, digest in self.manifest["files"].items()
+        }
+
+    @cached_property
+    def manifest(self):
+        """The build's manifest as returned by :func:`material_building.read_manifest`.
+
+        It's ``None`` for builds made before manifests were introduced.
+        """
+        try:
+            return material_building.read_manifest(self.absolute_manifest_path)
+        except FileNotFoundError:
+            return None
+
+    def get_encodings(self, rel_path):
+        """Return the content codings of precompressed variants of a file.
+
+        The result is empty for files without such variants.
+        """
+        if self.manifest is None:
+            return ()
+        return self.manifest["encodings"].get(rel_path, ())
+
+    def get_etag(self, rel_path, encoding=None):
+        """Return a strong ETag for the file at ``rel_path`` of the build results.
+
+        The ETag is derived from the file's content, so that it stays the same
+        across revisions as long as the file doesn't change. Precompressed variants
+        get their content coding appended.
+
+        :raises KeyError: if the file isn't part of the build
+        """
+        if self.manifest is not None:
+            digest = self.manifest["files"][rel_path]
+        elif rel_path in self.files:
+            # Files of a revision never change
+            digest = hashlib.sha256(f"{self.revision}:{rel_path}".encode()).hexdigest()
+        else:
+            raise KeyError(rel_path)
+        return f'"{digest}-{encoding}"' if encoding else f'"{digest}"'
+
+    def resolve_file(self, rel_path, encoding=None):
+        """Return the absolute disk path of the file at ``rel_path``.
+
+        If ``encoding`` is given, the path of the variant precompressed with that
+        content coding is returned instead.
+
+        :raises KeyError: if the file isn't part of the build
+        """
+        if self.manifest is None:
+            return self.files[rel_path]
+        return material_building.get_blob_path(
+            self.manifest["files"][rel_path], encoding
+        )
+
+    @cached_property
+    def absolute_workspace_path(self):
+        """Absolute path of the workspace re-used by all builds of course and format."""
+        return os.path.join(
+            self.course.absolute_material_build_workspaces_path, self.format.name
+        )
+
+
+class MaterialBundle:
+    """
+    The material of a course in one format, optionally together with that of its
+    sub-courses, as it is offered for downloading.
+
+    Multiple files are downloaded as a ZIP archive. Archives are cached on disk under
+    a key derived from everything that affects their contents: the courses and their
+    names, the revisions built and the state of static material.
+    """
+
+    def __init__(self, course, format, include_sub_courses=False):
+        self.course = course
+        self.format = format
+        self.include_sub_courses = include_sub_courses
+
+    @staticmethod
+    def clear_outdated_archives():
+        """Remove cached archives that don't match the current material anymore."""
+        current = set()
+        for course in Course.objects.select_related(
+            "study_course", "term", "type"
+        ).prefetch_related("sub_courses", "sub_courses__term", "sub_courses__type"):
+            for format in MaterialBuild.Format:
+                for include_sub_courses in (False, True):
+                    bundle = MaterialBundle(course, format, include_sub_courses)
+                    if include_sub_courses and len(bundle.courses) < 2:
+                        continue
+                    current.add(bundle.absolute_archive_path)
+        min_mtime = time.time() - material_building.BLOB_GRACE_SECS
+        archives_dir = os.path.join(settings.MEDIA_ROOT, "material_archives")
+        num = 0
+        for root, dirnames, filenames in os.walk(archives_dir, topdown=False):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                if path in current:
+                    continue
+                # Don't remove archives being written right now
+                if filename.startswith(".tmp_"):
+                    with contextlib.suppress(FileNotFoundError):
+                        if os.stat(path).st_mtime >= min_mtime:
+                            continue
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+                    num += 1
+            if root != archives_dir:
+                with contextlib.suppress(OSError):
+                    os.rmdir(root)
+        LOGGER.debug("Removed %d outdated material archives", num)
+
+    @cached_property
+    def absolute_archive_path(self):
+        """Absolute path of the cached ZIP archive of this bundle."""
+        return os.path.join(
+            settings.MEDIA_ROOT,
+            "material_archives",
+            str(self.course.pk),
+            f"{self.cache_key}.zip",
+        )
+
+    @cached_property
+    def cache_key(self):
+        """SHA-256 hex digest identifying the contents of this bundle."""
+        hasher = hashlib.sha256()
+        hasher.update(f"{self.format.name}\0{self.course.download_name}\0".encode())
+        for course in self.courses:
+            hasher.update(f"{course.pk}\0{course.download_name}\0".encode())
+            if not course.is_static:
+                hasher.update(f"{course.material_revision}\0".encode())
+                continue
+            root = course.absolute_static_material_path
+            for rel_path, path in sorted(material_building.walk_files(root)):
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                hasher.update(
+                    f"{rel_path}\0{stat.st_mtime_ns}\0{stat.st_size}\0".encode()
+                )
+        return hasher.hexdigest()
+
+    @cached_property
+    def courses(self):
+        """The courses with material in this bundle."""
+        courses = [self.course]
+        if self.include_sub_courses:
+            courses.extend(self.course.sub_courses.all())
+        return tuple(
+            course for course in courses if course.is_static or course.material_revision
+        )
+
+    @cached_property
+    def static_courses(self):
+        """The courses with static material in this bundle."""
+        return tuple(course for course in self.courses if course.is_static)
+
+    def get_builds(self, create=True):
+        """Return :class:`MaterialBuild` objects of the material revisions.
+
+        If ``create`` is ``False``, missing builds aren't created and ``None`` is
+        returned when any build doesn't exist yet.
+        """
+        builds = []
+        for course in self.courses:
+            if course.is_static:
+                continue
+            if create:
+                builds.append(MaterialBuild.objects.request(course, self.format))
+                continue
+            try:
+                builds.append(
+                    MaterialBuild.objects.with_prefetching().get(
+                        course=course,
+                        format=self.format,
+                        revision=course.material_revision,
+                    )
+                )
+            except MaterialBuild.DoesNotExist:
+                return None
+        return tuple(builds)
+
+    def get_single_file(self, builds):
+        """Return disk path and download name if the bundle is just a single file.
+
+        ``None`` is returned when a ZIP archive is needed.
+        """
+        if len(builds) == 1 and not self.static_courses:
+            files = builds[0].files
+            if len(files) == 1:
+                rel_path, path = next(iter(files.items()))
+                if "/" not in rel_path:
+                    return (
+                        path,
+                        builds[0].course.download_name + os.path.splitext(rel_path)[1],
+                    )
+        elif not builds and len(self.static_courses) == 1:
+            root = self.static_courses[0].absolute_static_material_path
+            if os.path.isdir(root):
+                items = os.listdir(root)
+                if len(items) == 1 and os.path.isfile(os.path.join(root, items[0])):
+                    return (
+                        os.path.join(root, items[0]),
+                        self.static_courses[0].download_name
+                        + os.path.splitext(items[0])[1],
+                    )
+        return None
+
+    def iter_zip_members(self, builds):
+        """Yield ``(disk path, name in archive)`` of the files to put into a ZIP."""
+        zip_root = self.course.download_name
+        # Collect build results
+        for build in builds:
+            for rel_path, path in sorted(build.files.items()):
+                yield (
+                    path,
+                    posixpath.join(zip_root, build.course.download_name, rel_path),
+                )
+        # Collect static material
+        for course in self.static_courses:
+            root = course.absolute_static_material_path
+            for rel_path, path in material_building.walk_files(root):
+                yield path, posixpath.join(zip_root, course.download_name, rel_path)
+
+    def write_archive(self, builds):
+        """Write the ZIP archive of this bundle to :attr:`absolute_archive_path`."""
+        archive_dir = os.path.dirname(self.absolute_archive_path)
+        os.makedirs(archive_dir, exist_ok=True)
+        # Write to a temporary file first, so that no incomplete archive is served
+        fd, tmp_path = tempfile.mkstemp(dir=archive_dir, prefix=".tmp_", suffix=".zip")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                for chunk in stream_zip(self.iter_zip_members(builds)):
+                    file.write(chunk)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.absolute_archive_path)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp_path)
+            raise
+        LOGGER.info("Created material archive %r", self.absolute_archive_path)
+
 
 class StudyCourseManager(Manager):
     def get_by_natural_key(self, slug):
@@ -235,6 +235,16 @@ FORCE_SCRIPT_NAME = MS_URL_SPL.path
 # User uploaded files
 MEDIA_ROOT = os.path.abspath(env.str("MS_MEDIA_ROOT", root("media")))
 
+# How to send material files once MatShare authorized access to them:
+# "" sends them through MatShare itself, where uWSGI's offload threads (see
+# main.ini) take over the transfer, and "x-accel-redirect" hands them to nginx (needs
+# the internal location from nginx.conf and MEDIA_ROOT mounted into nginx)
+MS_FILE_OFFLOAD = env.str("MS_FILE_OFFLOAD", "")
+if MS_FILE_OFFLOAD not in ("", "x-accel-redirect"):
+    raise ImproperlyConfigured("MS_FILE_OFFLOAD must be one of: '', 'x-accel-redirect'")
+# Internal nginx location MEDIA_ROOT is aliased to for X-Accel-Redirect
+MS_FILE_OFFLOAD_PREFIX = "/" + env.str("MS_FILE_OFFLOAD_PREFIX", "/_media/").strip("/")
+
 
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/3.0/howto/static-files/
@@ -287,6 +297,13 @@ if DEBUG:
         }
 
 
+# Seconds to cache the authorization data of users across requests, 0 disables it.
+# Changes made by other processes are only picked up after expiration unless CACHES
+# points to a shared backend.
+MS_ACCESS_LEVEL_CACHE_SECS = env.int("MS_ACCESS_LEVEL_CACHE_SECS", 0)
+assert MS_ACCESS_LEVEL_CACHE_SECS >= 0
+
+
 # Password resetting
 MS_PASSWORD_RESET = env.bool("MS_PASSWORD_RESET", True)
 # How long should password reset links be valid
@@ -317,6 +334,17 @@ MS_GIT_MAIN_REF = env.str("MS_GIT_MAIN_REF", "refs/heads/master")
 # Directory the git repositories of courses are stored in
 MS_GIT_ROOT = os.path.abspath(env.str("MS_GIT_ROOT", root("git_repos")))
 
+# Maximum number of open repository handles to keep per process (and thread)
+MS_GIT_REPOSITORY_POOL_SIZE = env.int("MS_GIT_REPOSITORY_POOL_SIZE", 32)
+assert MS_GIT_REPOSITORY_POOL_SIZE >= 0
+
+# Repositories changed since their last maintenance are packed hourly once they have
+# at least this many loose objects, up to the given number of repositories per hour
+MS_GIT_MAINTENANCE_LOOSE_OBJECTS = env.int("MS_GIT_MAINTENANCE_LOOSE_OBJECTS", 100)
+assert MS_GIT_MAINTENANCE_LOOSE_OBJECTS >= 0
+MS_GIT_MAINTENANCE_MAX_REPOS = env.int("MS_GIT_MAINTENANCE_MAX_REPOS", 20)
+assert MS_GIT_MAINTENANCE_MAX_REPOS >= 0
+
 # Mapping of keys and values to add to git config when creating a repository
 MS_GIT_EXTRA_CONFIG = env.dict("MS_GIT_EXTRA_CONFIG", default={})
 
@@ -332,3 +360,35 @@ MS_GIT_SRC_SUBDIR = env.str("MS_GIT_SRC_SUBDIR", "src")
 
 # Matuc configuration file inside the edit subdirectory
 MS_MATUC_CONFIG_FILE = ".lecture_meta_data.dcxml"
+
+# Number of matuc processes to run in parallel when building material of a course
+MS_MATERIAL_BUILD_JOBS = env.int("MS_MATERIAL_BUILD_JOBS", os.cpu_count() or 1)
+assert MS_MATERIAL_BUILD_JOBS > 0
+
+# Builds of outdated revisions are kept this many days for their telemetry, but
+# their results are removed right away
+MS_MATERIAL_BUILD_HISTORY_DAYS = env.int("MS_MATERIAL_BUILD_HISTORY_DAYS", 30)
+
+# Number of builds each spooler process runs in parallel threads
+MS_MATERIAL_BUILD_WORKERS = env.int("MS_MATERIAL_BUILD_WORKERS", 1)
+assert MS_MATERIAL_BUILD_WORKERS > 0
+
+# Limits for each matuc process and the processes it starts: wall-clock seconds,
+# CPU seconds and MiB of data memory, 0 means unlimited
+MS_MATUC_TIMEOUT = env.int("MS_MATUC_TIMEOUT", 3600)
+MS_MATUC_CPU_LIMIT = env.int("MS_MATUC_CPU_LIMIT", 3600)
+MS_MATUC_MEMORY_LIMIT = env.int("MS_MATUC_MEMORY_LIMIT", 0)
+
+# Number of builds of a single course that may run at the same time, further ones
+# wait in the queue so that builds of other courses are picked instead
+MS_MATERIAL_BUILD_COURSE_CONCURRENCY = env.int(
+    "MS_MATERIAL_BUILD_COURSE_CONCURRENCY", 1
+)
+assert MS_MATERIAL_BUILD_COURSE_CONCURRENCY > 0
+
+# Build material in all formats in the background after it was updated, instead of
+# waiting for the first student to request it
+MS_MATERIAL_PREBUILD = env.bool("MS_MATERIAL_PREBUILD", False)
+# Seconds to wait after the last update before pre-building, so that a series of
+# pushes results in a single build
+MS_MATERIAL_PREBUILD_DELAY = env.int("MS_MATERIAL_PREBUILD_DELAY", 120)
@@ -0,0 +1,39 @@
+import shutil
+import tempfile
+
+from django.test import TestCase, override_settings
+from django.utils.text import slugify
+
+from ..models import Course, CourseType, StudyCourse
+
+
+class MatShareTestCase(TestCase):
+    """
+    Keeps the repositories and media files of every test in a temporary directory.
+    """
+
+    def setUp(self):
+        super().setUp()
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        settings_override = override_settings(
+            MEDIA_ROOT=f"{root}/media", MS_GIT_ROOT=f"{root}/git_repos"
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def create_course(self, name="Test", **kwargs):
+        """Create a course, including its repository unless it's static."""
+        study_course, _ = StudyCourse.objects.get_or_create(
+            slug="test", defaults={"name": "Test"}
+        )
+        course_type, _ = CourseType.objects.get_or_create(
+            slug="test", defaults={"name": "Test"}
+        )
+        return Course.objects.create(
+            name=name,
+            slug=slugify(name),
+            study_course=study_course,
+            type=course_type,
+            **kwargs,
+        )
@@ -0,0 +1,127 @@
+from unittest import mock
+
+from django.conf import settings
+import pygit2
+
+from ..git import utils as git_utils
+from ..models import CourseCommit
+from .base import MatShareTestCase
+
+
+SIG = pygit2.Signature("Test", "test@invalid")
+
+
+class CourseCommitIndexTest(MatShareTestCase):
+    def setUp(self):
+        super().setUp()
+        self.course = self.create_course()
+        self.repo = git_utils.open_repository(self.course.absolute_repository_path)
+        # Other tasks may have indexed the repository's creation already
+        CourseCommit.objects.filter(course=self.course).delete()
+
+    def commit(self, path, message):
+        editor = git_utils.TreeEditor(self.repo, settings.MS_GIT_MAIN_REF)
+        editor.add_from_bytes(path, message.encode())
+        return editor.commit(SIG, message, settings.MS_GIT_MAIN_REF).hex
+
+    def reset(self, revision):
+        """Move the main reference like a force-push does."""
+        self.repo.references[settings.MS_GIT_MAIN_REF].set_target(revision)
+
+    def get_indexed(self):
+        return list(
+            CourseCommit.objects.filter(course=self.course)
+            .order_by("seq")
+            .values_list("message", "material_changed", "sources_changed")
+        )
+
+    def test_index(self):
+        self.commit("edit/k01/k01.md", "Material")
+        tip = self.commit("src/a.pdf", "Sources")
+        entry = CourseCommit.objects.index_main_ref(self.course)
+        self.assertEqual(entry.revision, tip)
+        self.assertEqual(
+            self.get_indexed()[-2:],
+            [("Material", True, False), ("Sources", False, True)],
+        )
+
+    def test_incremental(self):
+        self.commit("src/a.pdf", "First")
+        CourseCommit.objects.index_main_ref(self.course)
+        num_indexed = len(self.get_indexed())
+        self.commit("src/b.pdf", "Second")
+        self.commit("src/c.pdf", "Third")
+        with mock.patch.object(
+            git_utils, "paths_changed", wraps=git_utils.paths_changed
+        ) as paths_changed:
+            CourseCommit.objects.index_main_ref(self.course)
+            # Indexing the same revision again is a no-op
+            CourseCommit.objects.index_main_ref(self.course)
+        self.assertEqual(paths_changed.call_count, 2)
+        self.assertEqual(len(self.get_indexed()), num_indexed + 2)
+
+    def test_force_push_prunes_unreachable(self):
+        base = self.commit("src/a.pdf", "Base")
+        self.commit("src/b.pdf", "Gone 1")
+        self.commit("src/c.pdf", "Gone 2")
+        CourseCommit.objects.index_main_ref(self.course)
+        self.reset(base)
+        tip = self.commit("edit/k01/k01.md", "New")
+        entry = CourseCommit.objects.index_main_ref(self.course)
+        self.assertEqual(entry.revision, tip)
+        messages = [message for message, *_ in self.get_indexed()]
+        self.assertEqual(messages[-2:], ["Base", "New"])
+        self.assertNotIn("Gone 1", messages)
+        self.assertNotIn("Gone 2", messages)
+
+    def test_force_push_prunes_merged_branch(self):
+        root = self.commit("src/root.pdf", "Root")
+        side = self.commit("src/side.pdf", "Side")
+        self.reset(root)
+        main = self.commit("src/main.pdf", "Main")
+        # Merge the side branch, which gets indexed before the main commit
+        editor = git_utils.TreeEditor(self.repo, main)
+        editor.add_from_bytes("src/side.pdf", b"Side")
+        merge_id = self.repo.create_commit(
+            None, SIG, SIG, "Merge", editor.write_tree(), [main, side]
+        )
+        self.reset(merge_id)
+        CourseCommit.objects.index_main_ref(self.course)
+        self.reset(main)
+        self.commit("edit/k01/k01.md", "New")
+        CourseCommit.objects.index_main_ref(self.course)
+        messages = [message for message, *_ in self.get_indexed()]
+        self.assertEqual(messages[-3:], ["Root", "Main", "New"])
+        self.assertNotIn("Side", messages)
+
+    def test_reset_to_ancestor(self):
+        base = self.commit("src/a.pdf", "Base")
+        self.commit("src/b.pdf", "Gone")
+        CourseCommit.objects.index_main_ref(self.course)
+        self.reset(base)
+        entry = CourseCommit.objects.index_main_ref(self.course)
+        self.assertEqual(entry.revision, base)
+        self.assertEqual(self.get_indexed()[-1][0], "Base")
+
+    def test_between(self):
+        first = self.commit("src/a.pdf", "First")
+        self.commit("edit/k01/k01.md", "Second")
+        tip = self.commit("src/b.pdf", "Third")
+        # Not indexed yet, like when the spooler hasn't caught up
+        self.assertEqual(
+            [
+                commit.message
+                for commit in CourseCommit.objects.between(self.course, tip, first)
+            ],
+            ["Third", "Second"],
+        )
+        self.assertEqual(
+            [
+                commit.message
+                for commit in CourseCommit.objects.between(
+                    self.course, tip, first
+                ).filter(sources_changed=True)
+            ],
+            ["Third"],
+        )
+        self.assertFalse(CourseCommit.objects.between(self.course, "1" * 40))
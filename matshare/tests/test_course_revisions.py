@@ -0,0 +1,44 @@
+from django.conf import settings
+import pygit2
+
+from ..git import utils as git_utils
+from .base import MatShareTestCase
+
+
+SIG = pygit2.Signature("Test", "test@invalid")
+
+
+class RevisionToMarkTest(MatShareTestCase):
+    def setUp(self):
+        super().setUp()
+        self.course = self.create_course()
+        self.repo = git_utils.open_repository(self.course.absolute_repository_path)
+
+    def commit(self, path):
+        editor = git_utils.TreeEditor(self.repo, settings.MS_GIT_MAIN_REF)
+        editor.add_from_bytes(path, path.encode())
+        return editor.commit(SIG, path, settings.MS_GIT_MAIN_REF).hex
+
+    def test_current_revision(self):
+        marked = self.commit("src/a.pdf")
+        new = self.commit("src/b.pdf")
+        self.assertEqual(self.course.get_revision_to_mark(new, marked), new)
+        self.assertEqual(self.course.get_revision_to_mark(new, ""), new)
+
+    def test_descendant_of_marked_revision(self):
+        marked = self.commit("src/a.pdf")
+        new = self.commit("src/b.pdf")
+        # Pushed meanwhile, but not recorded yet
+        self.commit("src/c.pdf")
+        self.assertEqual(self.course.get_revision_to_mark(new, marked), new)
+
+    def test_newer_revision_recorded_already(self):
+        new = self.commit("src/a.pdf")
+        # A push landed and was recorded before the commit
+        pushed = self.commit("src/b.pdf")
+        self.assertEqual(self.course.get_revision_to_mark(new, pushed), pushed)
+
+    def test_marked_revision_gone(self):
+        new = self.commit("src/a.pdf")
+        current = self.commit("src/b.pdf")
+        self.assertEqual(self.course.get_revision_to_mark(new, "1" * 40), current)
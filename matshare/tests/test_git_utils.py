@@ -0,0 +1,380 @@
+import concurrent.futures
+import os
+import shutil
+import subprocess
+import tempfile
+from unittest import mock
+
+from django.test import SimpleTestCase
+import pygit2
+
+from ..git import utils as git_utils
+
+
+REF = "refs/heads/main"
+SIG = pygit2.Signature("Test", "test@invalid")
+
+
+class GitTestCase(SimpleTestCase):
+    """Provides an empty bare repository as ``self.repo`` for every test."""
+
+    def setUp(self):
+        super().setUp()
+        self.repo_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.repo_dir)
+        self.repo = pygit2.init_repository(self.repo_dir, bare=True)
+
+    def commit_files(self, files, base=REF):
+        """Commit a dict of paths and contents on top of ``base``, return the id."""
+        editor = git_utils.TreeEditor(self.repo, base)
+        for path, content in files.items():
+            editor.add_from_bytes(path, content)
+        return editor.commit(SIG, "Test", REF)
+
+    def get_files(self, committish=REF):
+        """Return a dict of paths and contents of all files in ``committish``."""
+        files = {}
+
+        def _walk(tree, prefix):
+            for entry in tree:
+                obj = self.repo[entry.id]
+                if isinstance(obj, pygit2.Tree):
+                    _walk(obj, f"{prefix}{entry.name}/")
+                else:
+                    files[prefix + entry.name] = obj.data
+
+        _walk(git_utils.resolve_committish(self.repo, committish).tree, "")
+        return files
+
+
+class TreeEditorTest(GitTestCase):
+    FILES = {
+        "edit/k01/k01.md": b"# Chapter 1\n",
+        "src/a": b"a",
+        "src/b/c": b"c",
+        "src/b/d/e": b"e",
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.commit_files(self.FILES, None)
+
+    def test_add_and_remove(self):
+        editor = git_utils.TreeEditor(self.repo, REF)
+        editor.add_from_bytes("src/b/d/f", b"f")
+        editor.add_from_bytes("src/new/g", b"g")
+        editor.remove("src/b/c")
+        editor.commit(SIG, "Test", REF)
+        files = dict(self.FILES, **{"src/b/d/f": b"f", "src/new/g": b"g"})
+        del files["src/b/c"]
+        self.assertEqual(self.get_files(), files)
+
+    def test_empty_directories_are_removed(self):
+        editor = git_utils.TreeEditor(self.repo, REF)
+        editor.remove("src/b/c")
+        editor.remove("src/b/d/e")
+        editor.add_from_bytes("tmp/x", b"x")
+        editor.remove("tmp")
+        self.assertRaises(KeyError, editor.remove, "src/b")
+        editor.commit(SIG, "Test", REF)
+        self.assertEqual(
+            self.get_files(),
+            {"edit/k01/k01.md": b"# Chapter 1\n", "src/a": b"a"},
+        )
+
+    def test_add_replaces_file_with_directory(self):
+        editor = git_utils.TreeEditor(self.repo, REF)
+        editor.add_from_bytes("src/a/x", b"x")
+        self.assertEqual(editor["src/a/x"].data, b"x")
+        editor.commit(SIG, "Test", REF)
+        files = dict(self.FILES, **{"src/a/x": b"x"})
+        del files["src/a"]
+        self.assertEqual(self.get_files(), files)
+
+    def test_lookup(self):
+        editor = git_utils.TreeEditor(self.repo, REF)
+        self.assertEqual(editor["src/b/d/e"].data, b"e")
+        editor.add_from_bytes("src/b/d/e", b"changed")
+        self.assertEqual(editor["src/b/d/e"].data, b"changed")
+        for path in ("src/b", "src/missing", "src/b/missing/e", "src/a/foo"):
+            with self.subTest(path=path):
+                self.assertRaises(KeyError, editor.__getitem__, path)
+
+    def test_lookup_and_remove_through_file_keep_tree(self):
+        tree_id = git_utils.resolve_committish(self.repo, REF).tree.id
+        editor = git_utils.TreeEditor(self.repo, REF)
+        self.assertRaises(KeyError, editor.__getitem__, "src/a/foo")
+        self.assertRaises(KeyError, editor.remove, "src/a/foo")
+        self.assertRaises(KeyError, editor.remove, "src/b/c/x/zzz")
+        self.assertRaises(KeyError, editor.remove, "src/missing/x/zzz")
+        self.assertEqual(editor.write_tree(), tree_id)
+        editor.add_from_bytes("src/b/d/f", b"f")
+        editor.commit(SIG, "Test", REF)
+        self.assertEqual(self.get_files(), dict(self.FILES, **{"src/b/d/f": b"f"}))
+
+    def test_remove_everything(self):
+        editor = git_utils.TreeEditor(self.repo, REF)
+        editor.remove(".")
+        editor.add_from_bytes("x", b"x")
+        editor.commit(SIG, "Test", REF)
+        self.assertEqual(self.get_files(), {"x": b"x"})
+
+    def test_commit_replays_changes_onto_new_tip(self):
+        editor = git_utils.TreeEditor(self.repo, REF)
+        editor.add_from_bytes("src/b/d/f", b"f")
+        editor.remove("src/a")
+        editor.remove("src/b/c")
+        # Committed concurrently, which removes what is to be removed as well
+        self.commit_files({"src/z": b"z"})
+        other = git_utils.TreeEditor(self.repo, REF)
+        other.remove("src/b/c")
+        other.commit(SIG, "Test", REF)
+        commit_id = editor.commit(SIG, "Test", REF)
+        self.assertEqual(
+            git_utils.resolve_committish(self.repo, REF).id,
+            commit_id,
+        )
+        self.assertEqual(
+            self.get_files(),
+            {
+                "edit/k01/k01.md": b"# Chapter 1\n",
+                "src/b/d/e": b"e",
+                "src/b/d/f": b"f",
+                "src/z": b"z",
+            },
+        )
+
+    def test_commit_replays_failed_removal_through_file(self):
+        editor = git_utils.TreeEditor(self.repo, REF)
+        editor.add_from_bytes("src/b/f", b"f")
+        editor.remove("src/b/d/e")
+        # src/b/d turns into a file concurrently, so removing src/b/d/e fails when
+        # replaying and must not affect anything else
+        other = git_utils.TreeEditor(self.repo, REF)
+        other.add_from_bytes("src/b/d", b"d")
+        other.commit(SIG, "Test", REF)
+        editor.commit(SIG, "Test", REF)
+        files = dict(self.FILES, **{"src/b/d": b"d", "src/b/f": b"f"})
+        del files["src/b/d/e"]
+        self.assertEqual(self.get_files(), files)
+
+
+class UpdateRefTest(GitTestCase):
+    def setUp(self):
+        super().setUp()
+        self.old_id = self.commit_files({"a": b"a"}, None)
+        self.new_id = self.commit_files({"a": b"b"})
+        self.repo.references[REF].set_target(self.old_id)
+
+    def test_update(self):
+        self.assertTrue(git_utils.update_ref(self.repo, REF, self.new_id, self.old_id))
+        self.assertEqual(self.repo.references[REF].target, self.new_id)
+
+    def test_create(self):
+        self.assertTrue(
+            git_utils.update_ref(self.repo, "refs/heads/other", self.new_id, None)
+        )
+        self.assertFalse(
+            git_utils.update_ref(self.repo, "refs/heads/other", self.new_id, None)
+        )
+
+    def test_changed_concurrently(self):
+        self.assertFalse(git_utils.update_ref(self.repo, REF, self.old_id, self.new_id))
+        self.assertEqual(self.repo.references[REF].target, self.old_id)
+
+    def test_locked(self):
+        lock_path = os.path.join(self.repo.path, REF + ".lock")
+        open(lock_path, "w").close()
+        self.addCleanup(os.remove, lock_path)
+        self.assertFalse(git_utils.update_ref(self.repo, REF, self.new_id, self.old_id))
+
+    def test_other_failure_raises(self):
+        with self.assertRaises(subprocess.CalledProcessError) as ctx:
+            git_utils.update_ref(self.repo, REF, "1" * 40, self.old_id)
+        self.assertIn(b"nonexistent object", ctx.exception.stderr)
+        self.assertEqual(self.repo.references[REF].target, self.old_id)
+
+    def test_commit_raises_other_failure_immediately(self):
+        editor = git_utils.TreeEditor(self.repo, REF)
+        editor.add_from_bytes("b", b"b")
+        with mock.patch.object(
+            git_utils, "update_ref", side_effect=subprocess.CalledProcessError(1, "git")
+        ) as update_ref, self.assertRaises(subprocess.CalledProcessError):
+            editor.commit(SIG, "Test", REF)
+        update_ref.assert_called_once()
+
+
+class ContentBrowserCommitTest(GitTestCase):
+    def setUp(self):
+        super().setUp()
+        self.commit_files({"a": b"a", "b": b"b"}, None)
+
+    def test_commit_merges_concurrent_changes(self):
+        browser = git_utils.ContentBrowser(self.repo, REF)
+        browser.add_from_bytes("c", b"c")
+        self.commit_files({"a": b"A"})
+        commit_id = browser.commit(SIG, "Test", REF)
+        self.assertEqual(self.repo.references[REF].target, commit_id)
+        self.assertEqual(self.get_files(), {"a": b"A", "b": b"b", "c": b"c"})
+
+    def test_commit_raises_on_conflict(self):
+        browser = git_utils.ContentBrowser(self.repo, REF)
+        browser.add_from_bytes("a", b"mine")
+        tip_id = self.commit_files({"a": b"theirs"})
+        with self.assertRaises(git_utils.RefUpdateFailed):
+            browser.commit(SIG, "Test", REF)
+        self.assertEqual(self.repo.references[REF].target, tip_id)
+
+    def test_commit_gives_up_when_ref_keeps_changing(self):
+        browser = git_utils.ContentBrowser(self.repo, REF)
+        browser.add_from_bytes("c", b"c")
+        with mock.patch.object(
+            git_utils, "update_ref", return_value=False
+        ) as update_ref, mock.patch.object(git_utils, "_backoff"):
+            with self.assertRaises(git_utils.RefUpdateFailed):
+                browser.commit(SIG, "Test", REF)
+        self.assertEqual(update_ref.call_count, git_utils.COMMIT_ATTEMPTS)
+
+
+class RepositoryPoolTest(SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.paths = []
+        for name in ("a", "b", "c"):
+            path = os.path.join(self.root, name)
+            pygit2.init_repository(path, bare=True)
+            self.paths.append(path)
+
+    def test_reuse(self):
+        pool = git_utils.RepositoryPool(2)
+        repo = pool.get(self.paths[0])
+        self.assertIs(pool.get(self.paths[0] + "/"), repo)
+        self.assertEqual(pool.stats()["hits"], 1)
+        self.assertEqual(pool.stats()["misses"], 1)
+
+    def test_lru_eviction(self):
+        pool = git_utils.RepositoryPool(2)
+        repo_a = pool.get(self.paths[0])
+        pool.get(self.paths[1])
+        # Using a makes b the least recently used one
+        pool.get(self.paths[0])
+        pool.get(self.paths[2])
+        self.assertEqual(pool.stats()["evictions"], 1)
+        self.assertEqual(pool.stats()["size"], 2)
+        self.assertIs(pool.get(self.paths[0]), repo_a)
+        misses = pool.misses
+        pool.get(self.paths[1])
+        self.assertEqual(pool.misses, misses + 1)
+
+    def test_disabled(self):
+        pool = git_utils.RepositoryPool(0)
+        self.assertIsNot(pool.get(self.paths[0]), pool.get(self.paths[0]))
+        self.assertEqual(pool.stats()["size"], 0)
+
+    def test_replaced_directory(self):
+        pool = git_utils.RepositoryPool(2)
+        repo = pool.get(self.paths[0])
+        # Like deleting a course and creating it again
+        shutil.rmtree(self.paths[0])
+        pygit2.init_repository(self.paths[0], bare=True)
+        self.assertIsNot(pool.get(self.paths[0]), repo)
+
+    def test_missing_repository(self):
+        pool = git_utils.RepositoryPool(2)
+        pool.get(self.paths[0])
+        shutil.rmtree(self.paths[0])
+        with self.assertRaises(pygit2.GitError):
+            pool.get(self.paths[0])
+        self.assertEqual(pool.stats()["size"], 0)
+
+    def test_invalidate(self):
+        pool = git_utils.RepositoryPool(3)
+        nested = os.path.join(self.paths[0], "nested")
+        pygit2.init_repository(nested, bare=True)
+        repo_a = pool.get(self.paths[0])
+        pool.get(nested)
+        repo_b = pool.get(self.paths[1])
+        pool.invalidate(self.paths[0])
+        self.assertEqual(pool.stats()["size"], 1)
+        self.assertIs(pool.get(self.paths[1]), repo_b)
+        self.assertIsNot(pool.get(self.paths[0]), repo_a)
+
+    def test_threads_have_own_handles(self):
+        pool = git_utils.RepositoryPool(2)
+        repo = pool.get(self.paths[0])
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            other = executor.submit(pool.get, self.paths[0]).result()
+        self.assertIsNot(other, repo)
+        self.assertIs(pool.get(self.paths[0]), repo)
+
+
+class BlobStreamTest(GitTestCase):
+    def setUp(self):
+        super().setUp()
+        self.content = bytes(range(256)) * 10
+        self.blob_id = self.repo.create_blob(self.content)
+
+    def read(self, start=None, length=None, chunk_size=100):
+        stream = git_utils.BlobStream(self.repo, self.blob_id, chunk_size)
+        self.addCleanup(stream.close)
+        if start is not None:
+            stream.set_range(start, length)
+        return stream, b"".join(stream)
+
+    def test_whole_blob(self):
+        stream, data = self.read()
+        self.assertEqual(stream.size, len(self.content))
+        self.assertEqual(data, self.content)
+
+    def test_range(self):
+        for start, length in ((0, 1), (150, 300), (2000, 560)):
+            with self.subTest(start=start, length=length):
+                _, data = self.read(start, length)
+                self.assertEqual(data, self.content[start : start + length])
+
+    def test_invalid_range(self):
+        stream, _ = self.read()
+        with self.assertRaises(ValueError):
+            stream.set_range(2500, 100)
+
+    def test_missing_blob(self):
+        with self.assertRaises(KeyError):
+            git_utils.BlobStream(self.repo, "1" * 40)
+
+    def test_close_before_reading(self):
+        stream = git_utils.BlobStream(self.repo, self.blob_id)
+        stream.close()
+        self.assertIsNotNone(stream._proc.returncode)
+
+
+class MaintainRepositoryTest(GitTestCase):
+    def test_full_repack_keeps_unreachable_packed_objects(self):
+        self.commit_files({"a": b"a"}, None)
+        blob_id = self.repo.create_blob(b"unreachable")
+        # Pack the object, like pushed objects whose reference isn't updated yet
+        subprocess.run(
+            [
+                "git",
+                "--git-dir",
+                self.repo.path,
+                "pack-objects",
+                "-q",
+                "objects/pack/pack",
+            ],
+            cwd=self.repo.path,
+            input=f"{blob_id}\n".encode(),
+            stdout=subprocess.DEVNULL,
+            check=True,
+        )
+        subprocess.run(["git", "--git-dir", self.repo.path, "prune-packed"], check=True)
+        stats = git_utils.maintain_repository(self.repo.path)
+        self.assertTrue(stats["full_repack"])
+        self.assertEqual(
+            subprocess.run(
+                ["git", "--git-dir", self.repo.path, "cat-file", "-p", str(blob_id)],
+                stdout=subprocess.PIPE,
+            ).stdout,
+            b"unreachable",
+        )
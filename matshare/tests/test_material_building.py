@@ -0,0 +1,251 @@
+import gzip
+import os
+import shutil
+import tempfile
+import time
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from .. import material_building
+from ..git import utils as git_utils
+from .test_git_utils import GitTestCase, REF, SIG
+
+
+class ConvertTest(SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.build_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.build_dir)
+        for path in ("k01/k01.md", "k02/k02.md", "k02/bild.png", "inhalt.md"):
+            path = os.path.join(self.build_dir, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, "w").close()
+        patcher = mock.patch.object(material_building, "run_matuc", return_value=1)
+        self.run_matuc = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_calls(self):
+        return [call.args for call in self.run_matuc.call_args_list]
+
+    @override_settings(MS_MATERIAL_BUILD_JOBS=1)
+    def test_single_job(self):
+        material_building.convert("html", self.build_dir)
+        self.assertEqual(self.get_calls(), [("conv", ".", "-f", "html")])
+
+    @override_settings(MS_MATERIAL_BUILD_JOBS=4)
+    def test_parallel(self):
+        material_building.convert("html", self.build_dir)
+        calls = self.get_calls()
+        # The whole lecture is converted once, with the table of contents last
+        self.assertCountEqual(
+            calls[:2],
+            [
+                ("conv", "k01/k01.md", "-f", "html"),
+                ("conv", "k02/k02.md", "-f", "html"),
+            ],
+        )
+        self.assertEqual(
+            calls[2:],
+            [("toc", "-o", "inhalt.md", "."), ("conv", "inhalt.md", "-f", "html")],
+        )
+
+    @override_settings(MS_MATERIAL_BUILD_JOBS=4)
+    def test_parallel_without_toc(self):
+        material_building.convert("html", self.build_dir, toc=False)
+        self.assertCountEqual(
+            self.get_calls(),
+            [
+                ("conv", "k01/k01.md", "-f", "html"),
+                ("conv", "k02/k02.md", "-f", "html"),
+            ],
+        )
+
+    @override_settings(MS_MATERIAL_BUILD_JOBS=1)
+    def test_chapters(self):
+        material_building.convert("html", self.build_dir, ["k02/k02.md"])
+        self.assertEqual(self.get_calls(), [("conv", "k02/k02.md", "-f", "html")])
+
+
+@override_settings(MS_GIT_EDIT_SUBDIR="edit")
+class BuildWorkspaceTest(GitTestCase):
+    FILES = {
+        "edit/k01/k01.md": b"# Chapter 1\n\nText\n",
+        "edit/k02/k02.md": b"Chapter 2\n=========\n\nText\n",
+        "edit/k02/bild.png": b"png",
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.workspace_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workspace_dir)
+        self.workspace = material_building.BuildWorkspace(self.workspace_dir)
+        self.workspace.__enter__()
+        self.addCleanup(self.workspace.__exit__, None, None, None)
+        self.update(self.commit_files(self.FILES, None))
+
+    def update(self, commit_id):
+        chapters = self.workspace.update(self.repo, commit_id.hex)
+        self.workspace.finish(commit_id.hex)
+        return chapters
+
+    def read(self, path):
+        with open(os.path.join(self.workspace.build_dir, path), "rb") as file:
+            return file.read()
+
+    def test_first_build(self):
+        self.assertEqual(self.read("k02/bild.png"), b"png")
+        self.assertEqual(self.workspace.revision, self.repo.references[REF].target.hex)
+
+    def test_text_changed(self):
+        chapters = self.update(
+            self.commit_files({"edit/k01/k01.md": b"# Chapter 1\n\nOther text\n"})
+        )
+        self.assertEqual(chapters, ["k01/k01.md"])
+        self.assertEqual(self.read("k01/k01.md"), b"# Chapter 1\n\nOther text\n")
+
+    def test_image_changed(self):
+        self.assertEqual(
+            self.update(self.commit_files({"edit/k02/bild.png": b"new"})), []
+        )
+        self.assertEqual(self.read("k02/bild.png"), b"new")
+
+    def test_outline_changed(self):
+        for content in (
+            b"# Chapter One\n\nText\n",
+            b"# Chapter 1\n\n## Section\n",
+            b"# Chapter 1\n\n|| - Seite 2 -\n",
+            b"# Chapter 1\n\nSection\n-------\n",
+        ):
+            with self.subTest(content=content):
+                self.assertIsNone(
+                    self.update(self.commit_files({"edit/k01/k01.md": content}))
+                )
+                # Back to the original outline
+                self.update(self.commit_files(self.FILES))
+
+    def test_chapter_added_or_removed(self):
+        self.assertIsNone(
+            self.update(self.commit_files({"edit/k03/k03.md": b"# Chapter 3\n"}))
+        )
+        editor = git_utils.TreeEditor(self.repo, REF)
+        editor.remove("edit/k03/k03.md")
+        self.assertIsNone(self.update(editor.commit(SIG, "Remove", REF)))
+        self.assertFalse(os.path.exists(os.path.join(self.workspace.build_dir, "k03")))
+
+    def test_config_changed(self):
+        self.assertIsNone(
+            self.update(
+                self.commit_files({"edit/.lecture_meta_data.dcxml": b"<config/>"})
+            )
+        )
+
+    def test_unknown_revision(self):
+        # Like after a forced push removing the revision built last
+        with open(self.workspace._revision_file, "w") as file:
+            file.write("0" * 40)
+        self.assertIsNone(self.update(self.commit_files({"edit/k02/bild.png": b"new"})))
+        self.assertEqual(self.read("k01/k01.md"), self.FILES["edit/k01/k01.md"])
+
+
+class BlobStoreTest(SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        settings_override = override_settings(MEDIA_ROOT=f"{self.root}/media")
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def write_files(self, files):
+        """Write a dict of paths and contents to a new directory, return its path."""
+        src_dir = tempfile.mkdtemp(dir=self.root)
+        for path, content in files.items():
+            disk_path = os.path.join(src_dir, path)
+            os.makedirs(os.path.dirname(disk_path), exist_ok=True)
+            with open(disk_path, "wb") as file:
+                file.write(content)
+        return src_dir
+
+    def store(self, files, name, compress=False):
+        manifest_path = os.path.join(self.root, name, "manifest.json")
+        result = material_building.store_files(
+            material_building.walk_files(self.write_files(files)),
+            manifest_path,
+            compress=compress,
+        )
+        return result, material_building.read_manifest(manifest_path)
+
+    def read_blob(self, digest, encoding=None):
+        with open(material_building.get_blob_path(digest, encoding), "rb") as file:
+            return file.read()
+
+    def age_blobs(self):
+        """Make all blobs older than the grace period."""
+        mtime = time.time() - material_building.BLOB_GRACE_SECS - 1
+        for _, disk_path in material_building.walk_files(
+            os.path.join(self.root, "media")
+        ):
+            os.utime(disk_path, (mtime, mtime))
+
+    def test_store_and_deduplicate(self):
+        (num, size), manifest = self.store(
+            {"a.html": b"same", "sub/b.html": b"same", "c.png": b"other"}, "first"
+        )
+        self.assertEqual((num, size), (3, 13))
+        files = manifest["files"]
+        self.assertEqual(files["a.html"], files["sub/b.html"])
+        self.assertEqual(self.read_blob(files["c.png"]), b"other")
+        _, other_manifest = self.store({"x.html": b"same"}, "second")
+        self.assertEqual(other_manifest["files"]["x.html"], files["a.html"])
+        num_blobs = sum(
+            1
+            for _ in material_building.walk_files(
+                os.path.join(self.root, "media", "material_build_blobs")
+            )
+        )
+        self.assertEqual(num_blobs, 2)
+
+    def test_compress(self):
+        html = b"<p>Text</p>\n" * 200
+        _, manifest = self.store(
+            {"a.html": html, "small.html": b"<p></p>", "b.png": html},
+            "build",
+            compress=True,
+        )
+        self.assertEqual(
+            manifest["encodings"],
+            {"a.html": list(material_building.get_supported_encodings())},
+        )
+        self.assertEqual(
+            gzip.decompress(self.read_blob(manifest["files"]["a.html"], "gzip")), html
+        )
+
+    def test_remove_unreferenced(self):
+        _, kept = self.store({"a.html": b"kept"}, "kept", compress=True)
+        _, removed = self.store(
+            {"b.html": b"<p>Removed</p>\n" * 200}, "removed", compress=True
+        )
+        self.assertIn("gzip", removed["encodings"]["b.html"])
+        referenced = set(kept["files"].values())
+        # Recently stored blobs are kept for builds still running
+        self.assertEqual(
+            material_building.remove_unreferenced_blobs(referenced), (0, 0)
+        )
+        self.age_blobs()
+        num, size = material_building.remove_unreferenced_blobs(referenced)
+        # The compressed variants are removed along with their blob
+        self.assertEqual(num, 1 + len(removed["encodings"]["b.html"]))
+        self.assertGreater(size, 0)
+        self.assertEqual(self.read_blob(kept["files"]["a.html"]), b"kept")
+        self.assertFalse(
+            os.path.exists(material_building.get_blob_path(removed["files"]["b.html"]))
+        )
+
+    def test_reuse_protects_blob(self):
+        _, manifest = self.store({"a.html": b"content"}, "first")
+        self.age_blobs()
+        # Storing the same content again refreshes the blob's modification time
+        self.store({"a.html": b"content"}, "second")
+        self.assertEqual(material_building.remove_unreferenced_blobs(set()), (0, 0))
+        self.assertEqual(self.read_blob(manifest["files"]["a.html"]), b"content")
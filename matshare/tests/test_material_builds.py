@@ -0,0 +1,258 @@
+import datetime
+import os
+
+from django.db import connection
+from django.test import override_settings
+from django.utils import timezone
+import psycopg2
+
+from ..models import MATERIAL_BUILD_LOCK_KEY, MaterialBuild
+from .base import MatShareTestCase
+
+
+REVISION_1 = 40 * "1"
+REVISION_2 = 40 * "2"
+
+
+class MaterialBuildRequestTest(MatShareTestCase):
+    def setUp(self):
+        super().setUp()
+        self.course = self.create_course(material_revision=REVISION_1)
+
+    def complete(self, build, **telemetry):
+        """Mark the build completed, with an empty results directory."""
+        build.status = MaterialBuild.Status.completed
+        build.date_started = build.date_done = timezone.now()
+        for key, value in telemetry.items():
+            setattr(build, key, value)
+        build.save()
+        os.makedirs(build.absolute_path)
+
+    def set_revision(self, revision):
+        self.course.material_revision = revision
+        self.course.save()
+
+    def test_request_creates_and_raises_priority(self):
+        build = MaterialBuild.objects.request(
+            self.course, MaterialBuild.Format.html, MaterialBuild.Priority.background
+        )
+        self.assertEqual(build.status, MaterialBuild.Status.waiting)
+        self.assertEqual(build.priority, MaterialBuild.Priority.background)
+        again = MaterialBuild.objects.request(self.course, MaterialBuild.Format.html)
+        self.assertEqual(again.pk, build.pk)
+        build.refresh_from_db()
+        self.assertEqual(build.priority, MaterialBuild.Priority.interactive)
+
+    def test_completed_build_is_reused(self):
+        build = MaterialBuild.objects.request(self.course, MaterialBuild.Format.html)
+        self.complete(build, peak_rss=1000)
+        again = MaterialBuild.objects.request(self.course, MaterialBuild.Format.html)
+        self.assertEqual(again.status, MaterialBuild.Status.completed)
+        self.assertEqual(again.peak_rss, 1000)
+
+    def test_outdated_build_is_requeued_when_current_again(self):
+        build = MaterialBuild.objects.request(self.course, MaterialBuild.Format.html)
+        self.complete(build, peak_rss=1000)
+        self.set_revision(REVISION_2)
+        MaterialBuild.objects.clear_outdated()
+        # Kept for the telemetry, but without results
+        build.refresh_from_db()
+        self.assertEqual(build.status, MaterialBuild.Status.completed)
+        self.assertFalse(os.path.exists(build.absolute_path))
+
+        # The main reference is reset to the former revision
+        self.set_revision(REVISION_1)
+        again = MaterialBuild.objects.request(self.course, MaterialBuild.Format.html)
+        self.assertEqual(again.pk, build.pk)
+        self.assertEqual(again.status, MaterialBuild.Status.waiting)
+        self.assertEqual(again.priority, MaterialBuild.Priority.interactive)
+        self.assertIsNone(again.date_done)
+        self.assertIsNone(again.peak_rss)
+        again.refresh_from_db()
+        self.assertEqual(again.status, MaterialBuild.Status.waiting)
+
+    def test_superseded_build_is_requeued_when_current_again(self):
+        build = MaterialBuild.objects.request(self.course, MaterialBuild.Format.html)
+        self.set_revision(REVISION_2)
+        self.assertIsNone(MaterialBuild.objects.claim_next())
+        build.refresh_from_db()
+        self.assertEqual(build.status, MaterialBuild.Status.superseded)
+        self.set_revision(REVISION_1)
+        again = MaterialBuild.objects.request(self.course, MaterialBuild.Format.html)
+        self.assertEqual(again.pk, build.pk)
+        self.assertEqual(again.status, MaterialBuild.Status.waiting)
+
+    def test_failed_build_is_kept(self):
+        build = MaterialBuild.objects.request(self.course, MaterialBuild.Format.html)
+        build.status = MaterialBuild.Status.failed
+        build.save()
+        again = MaterialBuild.objects.request(self.course, MaterialBuild.Format.html)
+        self.assertEqual(again.status, MaterialBuild.Status.failed)
+
+    @override_settings(MS_MATERIAL_BUILD_HISTORY_DAYS=1)
+    def test_clear_outdated_deletes_old_builds(self):
+        build = MaterialBuild.objects.request(self.course, MaterialBuild.Format.html)
+        self.complete(build)
+        MaterialBuild.objects.filter(pk=build.pk).update(
+            date_created=timezone.now() - datetime.timedelta(days=2)
+        )
+        MaterialBuild.objects.clear_outdated()
+        self.assertTrue(MaterialBuild.objects.filter(pk=build.pk).exists())
+        self.set_revision(REVISION_2)
+        MaterialBuild.objects.clear_outdated()
+        self.assertFalse(MaterialBuild.objects.filter(pk=build.pk).exists())
+
+
+class MaterialBuildTelemetryTest(MatShareTestCase):
+    def create_build(self, course, revision, seconds, **telemetry):
+        now = timezone.now()
+        return MaterialBuild.objects.create(
+            course=course,
+            format=MaterialBuild.Format.html,
+            revision=revision,
+            status=MaterialBuild.Status.completed,
+            date_started=now - datetime.timedelta(seconds=seconds),
+            date_done=now,
+            **telemetry,
+        )
+
+    def test_percentiles(self):
+        slow = self.create_course("Slow")
+        fast = self.create_course("Fast")
+        for idx in range(1, 21):
+            self.create_build(
+                slow,
+                f"{idx:040d}",
+                idx * 10,
+                peak_rss=idx * 1000,
+                output_files=idx,
+                phase_durations={"run_matuc": float(idx), "store_files": 0.5},
+            )
+        self.create_build(fast, REVISION_1, 1, phase_durations={"run_matuc": 1.0})
+        # Neither running nor failed builds count
+        MaterialBuild.objects.create(
+            course=fast,
+            format=MaterialBuild.Format.html,
+            revision=REVISION_2,
+            status=MaterialBuild.Status.failed,
+            date_started=timezone.now() - datetime.timedelta(hours=1),
+            date_done=timezone.now(),
+        )
+
+        stats = MaterialBuild.objects.get_telemetry_stats()
+        self.assertEqual([item["course"] for item in stats], [slow, fast])
+        item = stats[0]
+        self.assertEqual(item["format"], MaterialBuild.Format.html)
+        self.assertEqual(item["builds"], 20)
+        self.assertEqual(item["build_p50"], datetime.timedelta(seconds=100))
+        self.assertEqual(item["build_p95"], datetime.timedelta(seconds=190))
+        self.assertEqual(item["peak_rss_p50"], 10000)
+        self.assertEqual(item["peak_rss_p95"], 19000)
+        self.assertEqual(item["output_files_p95"], 19)
+        self.assertIsNone(item["output_size_p50"])
+        self.assertEqual(
+            item["phases"], {"run_matuc": (10.0, 19.0), "store_files": (0.5, 0.5)}
+        )
+        self.assertEqual(stats[1]["builds"], 1)
+        self.assertEqual(stats[1]["phases"], {"run_matuc": (1.0, 1.0)})
+
+        self.assertEqual(
+            [item["course"] for item in MaterialBuild.objects.get_telemetry_stats(1)],
+            [slow],
+        )
+
+
+class MaterialBuildQueueTest(MatShareTestCase):
+    def setUp(self):
+        super().setUp()
+        self.course1 = self.create_course("One", material_revision=REVISION_1)
+        self.course2 = self.create_course("Two", material_revision=REVISION_1)
+
+    def claim_next(self):
+        build = MaterialBuild.objects.claim_next()
+        if build is not None:
+            self.addCleanup(build.release_lock)
+        return build
+
+    def test_claim_order(self):
+        background = MaterialBuild.objects.request(
+            self.course1, MaterialBuild.Format.epub, MaterialBuild.Priority.background
+        )
+        first = MaterialBuild.objects.request(self.course2, MaterialBuild.Format.epub)
+        second = MaterialBuild.objects.request(self.course2, MaterialBuild.Format.html)
+        with self.settings(MS_MATERIAL_BUILD_COURSE_CONCURRENCY=2):
+            self.assertEqual(self.claim_next(), first)
+            self.assertEqual(self.claim_next(), second)
+            self.assertEqual(self.claim_next(), background)
+            self.assertIsNone(self.claim_next())
+        first.refresh_from_db()
+        self.assertEqual(first.status, MaterialBuild.Status.building)
+        self.assertIsNotNone(first.date_started)
+
+    def test_course_concurrency(self):
+        first = MaterialBuild.objects.request(self.course1, MaterialBuild.Format.epub)
+        second = MaterialBuild.objects.request(self.course1, MaterialBuild.Format.html)
+        other = MaterialBuild.objects.request(
+            self.course2, MaterialBuild.Format.html, MaterialBuild.Priority.background
+        )
+        self.assertEqual(self.claim_next(), first)
+        # The course has a build running already
+        self.assertEqual(self.claim_next(), other)
+        self.assertIsNone(self.claim_next())
+        MaterialBuild.objects.filter(pk=first.pk).update(
+            status=MaterialBuild.Status.completed
+        )
+        self.assertEqual(self.claim_next(), second)
+
+    def test_waiting_builds_of_old_revisions_are_superseded(self):
+        build = MaterialBuild.objects.request(self.course1, MaterialBuild.Format.html)
+        self.course1.material_revision = REVISION_2
+        self.course1.save()
+        self.assertIsNone(self.claim_next())
+        build.refresh_from_db()
+        self.assertEqual(build.status, MaterialBuild.Status.superseded)
+
+    def test_interrupted_builds_are_requeued(self):
+        running = MaterialBuild.objects.request(self.course1, MaterialBuild.Format.html)
+        self.assertEqual(self.claim_next(), running)
+        # Left behind by a spooler that crashed, so nobody holds its lock
+        interrupted = MaterialBuild.objects.create(
+            course=self.course2,
+            format=MaterialBuild.Format.html,
+            revision=REVISION_1,
+            status=MaterialBuild.Status.building,
+            date_started=timezone.now(),
+        )
+        self.assertEqual(MaterialBuild.objects.requeue_interrupted(), 1)
+        interrupted.refresh_from_db()
+        self.assertEqual(interrupted.status, MaterialBuild.Status.waiting)
+        self.assertIsNone(interrupted.date_started)
+        running.refresh_from_db()
+        self.assertEqual(running.status, MaterialBuild.Status.building)
+        # The course's build can run again
+        self.assertEqual(self.claim_next(), interrupted)
+
+        running.release_lock()
+        self.assertEqual(MaterialBuild.objects.requeue_interrupted(), 1)
+        running.refresh_from_db()
+        self.assertEqual(running.status, MaterialBuild.Status.waiting)
+
+    def test_locks_of_other_databases_are_ignored(self):
+        interrupted = MaterialBuild.objects.create(
+            course=self.course1,
+            format=MaterialBuild.Format.html,
+            revision=REVISION_1,
+            status=MaterialBuild.Status.building,
+            date_started=timezone.now(),
+        )
+        # Another database of the same server happens to use the same lock key
+        params = connection.get_connection_params()
+        params["database"] = "postgres"
+        other = psycopg2.connect(**params)
+        self.addCleanup(other.close)
+        with other.cursor() as cursor:
+            cursor.execute(
+                "SELECT PG_ADVISORY_LOCK(%s, %s)",
+                (MATERIAL_BUILD_LOCK_KEY, interrupted.pk),
+            )
+        self.assertEqual(MaterialBuild.objects.requeue_interrupted(), 1)
@@ -0,0 +1,116 @@
+import os
+import shutil
+import tempfile
+
+from django.test import override_settings
+from django.utils import timezone
+
+from .. import material_building
+from ..models import MaterialBuild, User
+from .base import MatShareTestCase
+
+
+REVISION_1 = 40 * "1"
+REVISION_2 = 40 * "2"
+HTML = b"<p>Chapter 1</p>\n" * 200
+
+
+@override_settings(MS_FILE_OFFLOAD="")
+class MaterialHTMLViewTest(MatShareTestCase):
+    def setUp(self):
+        super().setUp()
+        self.course = self.create_course(material_revision=REVISION_1)
+        self.client.force_login(
+            User.objects.create_superuser("admin", "admin@invalid", "admin")
+        )
+
+    def complete_build(self, files):
+        """Request the HTML build of the current revision and complete it."""
+        build = MaterialBuild.objects.request(self.course, MaterialBuild.Format.html)
+        src_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, src_dir)
+        for path, content in files.items():
+            with open(os.path.join(src_dir, path), "wb") as file:
+                file.write(content)
+        material_building.store_files(
+            material_building.walk_files(src_dir),
+            build.absolute_manifest_path,
+            compress=True,
+        )
+        build.status = MaterialBuild.Status.completed
+        build.date_started = build.date_done = timezone.now()
+        build.save()
+        return build
+
+    def get(self, path="inhalt.html", revision=REVISION_1, **headers):
+        return self.client.get(
+            self.course.urls.reverse(
+                "course_material_html_revision", revision=revision, path=path
+            ),
+            **headers,
+        )
+
+    def test_redirect_to_revision(self):
+        self.complete_build({"inhalt.html": HTML})
+        response = self.client.get(
+            self.course.urls.reverse("course_material_html", path="inhalt.html")
+        )
+        self.assertRedirects(
+            response,
+            self.course.urls.reverse(
+                "course_material_html_revision", revision=REVISION_1, path="inhalt.html"
+            ),
+            fetch_redirect_response=False,
+        )
+        self.assertIn("no-cache", response["Cache-Control"])
+        # Outdated revisions redirect as well
+        self.assertEqual(self.get(revision=REVISION_2).status_code, 302)
+
+    def test_serve(self):
+        build = self.complete_build({"inhalt.html": HTML})
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), HTML)
+        self.assertEqual(response["ETag"], build.get_etag("inhalt.html"))
+        self.assertIn("Last-Modified", response)
+        self.assertIn("immutable", response["Cache-Control"])
+        self.assertIn("private", response["Cache-Control"])
+        # Files not part of the build raise Http404
+        response = self.get("missing.html")
+        self.assertTemplateUsed(response, "matshare/404.html")
+        self.assertNotIn("ETag", response)
+
+    def test_not_modified(self):
+        self.complete_build({"inhalt.html": HTML})
+        etag = self.get()["ETag"]
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+        self.assertIn("immutable", response["Cache-Control"])
+
+    def test_unchanged_file_of_new_revision(self):
+        self.complete_build({"inhalt.html": HTML, "k01.html": b"old"})
+        etags = {path: self.get(path)["ETag"] for path in ("inhalt.html", "k01.html")}
+        self.course.material_revision = REVISION_2
+        self.course.save()
+        self.complete_build({"inhalt.html": HTML, "k01.html": b"new"})
+        self.assertEqual(
+            self.get(
+                "inhalt.html", REVISION_2, HTTP_IF_NONE_MATCH=etags["inhalt.html"]
+            ).status_code,
+            304,
+        )
+        self.assertEqual(
+            self.get(
+                "k01.html", REVISION_2, HTTP_IF_NONE_MATCH=etags["k01.html"]
+            ).status_code,
+            200,
+        )
+
+    def test_precompressed(self):
+        build = self.complete_build({"inhalt.html": HTML})
+        response = self.get(HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(response["ETag"], build.get_etag("inhalt.html", "gzip"))
+        self.assertIn("Accept-Encoding", response["Vary"])
+        self.assertNotEqual(response["ETag"], self.get()["ETag"])
@@ -0,0 +1,82 @@
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+import pygit2
+
+from ..git import utils as git_utils
+from ..models import User
+from .base import MatShareTestCase
+
+
+CONTENT = bytes(range(256)) * 4
+
+
+class SourceFileTest(MatShareTestCase):
+    def setUp(self):
+        super().setUp()
+        self.course = self.create_course()
+        repo = git_utils.open_repository(self.course.absolute_repository_path)
+        editor = git_utils.TreeEditor(repo, settings.MS_GIT_MAIN_REF)
+        editor.add_from_bytes(f"{settings.MS_GIT_SRC_SUBDIR}/doc.pdf", CONTENT)
+        editor.commit(
+            pygit2.Signature("Test", "test@invalid"), "Test", settings.MS_GIT_MAIN_REF
+        )
+        self.client.force_login(
+            User.objects.create_superuser(
+                "admin", "admin@invalid", "admin", first_name="Ad", last_name="Min"
+            )
+        )
+
+    def get(self, **headers):
+        return self.client.get(
+            self.course.urls.reverse("course_sources", path="doc.pdf"), **headers
+        )
+
+    def test_whole_file(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), CONTENT)
+        self.assertEqual(response["Content-Type"], "application/pdf")
+        self.assertEqual(response["Content-Length"], str(len(CONTENT)))
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+        self.assertIn("no-cache", response["Cache-Control"])
+
+    def test_not_modified(self):
+        etag = self.get()["ETag"]
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+    def test_range(self):
+        response = self.get(HTTP_RANGE="bytes=100-199")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], f"bytes 100-199/{len(CONTENT)}")
+        self.assertEqual(response["Content-Length"], "100")
+        self.assertEqual(b"".join(response.streaming_content), CONTENT[100:200])
+
+    def test_if_range(self):
+        etag = self.get()["ETag"]
+        response = self.get(HTTP_RANGE="bytes=100-199", HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b"".join(response.streaming_content), CONTENT[100:200])
+        # The client's copy is outdated, so the whole file is sent
+        response = self.get(HTTP_RANGE="bytes=100-199", HTTP_IF_RANGE='"other"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), CONTENT)
+
+    def test_not_satisfiable(self):
+        response = self.get(HTTP_RANGE=f"bytes={len(CONTENT)}-")
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], f"bytes */{len(CONTENT)}")
+
+    def test_upload_marks_sources_updated(self):
+        response = self.client.post(
+            self.course.urls.reverse("course_sources"),
+            {"upload": "1", "files": SimpleUploadedFile("new.pdf", b"new")},
+        )
+        self.assertEqual(response.status_code, 302)
+        repo = git_utils.open_repository(self.course.absolute_repository_path)
+        self.course.refresh_from_db()
+        self.assertEqual(
+            self.course.sources_revision,
+            git_utils.resolve_committish(repo, settings.MS_GIT_MAIN_REF).id.hex,
+        )
@@ -0,0 +1,87 @@
+import os
+import shutil
+import tempfile
+
+from django.test import SimpleTestCase, override_settings
+
+from ..utils import parse_range_header, serve_file
+
+
+class ServeFileTest(SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        self.path = os.path.join(self.media_root, "some dir", "blob")
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, "wb") as file:
+            file.write(b"content")
+
+    def test_sent_by_matshare(self):
+        with self.settings(MEDIA_ROOT=self.media_root, MS_FILE_OFFLOAD=""):
+            response = serve_file(
+                self.path, filename="style.css", content_encoding="gzip"
+            )
+        self.assertEqual(b"".join(response.streaming_content), b"content")
+        self.assertEqual(response["Content-Type"], "text/css")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(
+            response["Content-Disposition"], 'inline; filename="style.css"'
+        )
+        response.close()
+
+    @override_settings(
+        MS_FILE_OFFLOAD="x-accel-redirect", MS_FILE_OFFLOAD_PREFIX="/_media"
+    )
+    def test_x_accel_redirect(self):
+        with self.settings(MEDIA_ROOT=self.media_root):
+            response = serve_file(
+                self.path, filename="Skript ä.pdf", as_attachment=True
+            )
+        self.assertEqual(response.content, b"")
+        self.assertEqual(response["X-Accel-Redirect"], "/_media/some%20dir/blob")
+        self.assertEqual(response["Content-Type"], "application/pdf")
+        self.assertEqual(
+            response["Content-Disposition"],
+            "attachment; filename*=utf-8''Skript%20%C3%A4.pdf",
+        )
+
+    @override_settings(MS_FILE_OFFLOAD="x-accel-redirect")
+    def test_x_accel_redirect_only_inside_media_root(self):
+        with self.settings(MEDIA_ROOT=os.path.join(self.media_root, "other")):
+            response = serve_file(self.path)
+        self.assertNotIn("X-Accel-Redirect", response)
+        self.assertEqual(b"".join(response.streaming_content), b"content")
+        self.assertEqual(response["Content-Type"], "application/octet-stream")
+        response.close()
+
+    @override_settings(MS_FILE_OFFLOAD="x-accel-redirect")
+    def test_missing_file(self):
+        with self.settings(MEDIA_ROOT=self.media_root):
+            with self.assertRaises(OSError):
+                serve_file(os.path.join(self.media_root, "missing"))
+
+
+class ParseRangeHeaderTest(SimpleTestCase):
+    def test_ranges(self):
+        for header, expected in (
+            ("bytes=0-9", (0, 10)),
+            ("bytes=5-", (5, 95)),
+            ("bytes=90-200", (90, 10)),
+            ("bytes=-10", (90, 10)),
+            ("bytes=-200", (0, 100)),
+            ("BYTES = 1-1", (1, 1)),
+        ):
+            with self.subTest(header=header):
+                self.assertEqual(parse_range_header(header, 100), expected)
+
+    def test_whole_resource(self):
+        for header in (None, "", "items=0-9", "bytes=0-1,5-6", "bytes=-", "bytes=5-2"):
+            with self.subTest(header=header):
+                self.assertIsNone(parse_range_header(header, 100))
+
+    def test_not_satisfiable(self):
+        for header, size in (("bytes=100-", 100), ("bytes=0-", 0)):
+            with self.subTest(header=header, size=size):
+                with self.assertRaises(ValueError):
+                    parse_range_header(header, size)
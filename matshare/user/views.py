@@ -15,13 +15,12 @@ from django.utils.translation import gettext_lazy as _
 from django.views.decorators.cache import never_cache
 from django.views.generic import TemplateView, View
 from feedgen.feed import FeedGenerator
-import pygit2
 
 from .. import __version__
 from ..context_processors import matshare_context_processor
-from ..git import utils as git_utils
 from ..models import (
     Course,
+    CourseCommit,
     CourseEditorSubscription,
     CourseStudentSubscription,
     MaterialBuild,
@@ -118,21 +117,12 @@ class EditorFeedView(FeedViewBase):
                 href=settings.MS_ROOT_URL + sub.course.get_absolute_url(),
                 rel="alternate",
             )
-            # Annotate course with the latest commits
-            sub.course.latest_commits = []
-            repo = pygit2.Repository(sub.course.absolute_repository_path)
-            for parent, child in git_utils.walk_pairwise(
-                repo, sub.course.sources_revision
-            ):
-                # Only respect commits that changed the src directory
-                if next(
-                    git_utils.paths_changed(parent, child, settings.MS_GIT_SRC_SUBDIR)
-                ):
-                    sub.course.latest_commits.append(
-                        git_utils.extract_commit_info(child)
-                    )
-                    if len(sub.course.latest_commits) == 5:
-                        break
+            # Annotate course with the latest commits that changed the src directory
+            sub.course.latest_commits = list(
+                CourseCommit.objects.between(
+                    sub.course, sub.course.sources_revision
+                ).filter(sources_changed=True)[:5]
+            )
             entry.content(
                 render_to_string(
                     "matshare/user/editor_feed_entry_content.html",
@@ -190,22 +180,12 @@ class StudentFeedView(FeedViewBase):
                 # Ignore courses with no commits, i.e. those with static material
                 if not course.material_revision:
                     continue
-                course.latest_commits = []
-                repo = pygit2.Repository(course.absolute_repository_path)
-                for parent, child in git_utils.walk_pairwise(
-                    repo, course.material_revision
-                ):
-                    # Only respect commits that changed the edit directory
-                    if next(
-                        git_utils.paths_changed(
-                            parent, child, settings.MS_GIT_EDIT_SUBDIR
-                        )
-                    ):
-                        course.latest_commits.append(
-                            git_utils.extract_commit_info(child)
-                        )
-                        if len(course.latest_commits) == 5:
-                            break
+                # Only respect commits that changed the edit directory
+                course.latest_commits = list(
+                    CourseCommit.objects.between(
+                        course, course.material_revision
+                    ).filter(material_changed=True)[:5]
+                )
             entry.content(
                 render_to_string(
                     "matshare/user/student_feed_entry_content.html",
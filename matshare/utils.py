@@ -1,7 +1,12 @@
 import base64
 import functools
+import io
+import mimetypes
 import os
+import re
 import shutil
+import urllib.parse
+import zipfile
 
 from django import forms
 from django.conf import settings
@@ -10,7 +15,7 @@ from django.core.exceptions import ValidationError
 from django.core.mail import EmailMessage
 from django.core.paginator import Paginator
 from django.db import models
-from django.http import HttpResponse
+from django.http import FileResponse, HttpResponse
 from django.template.loader import render_to_string
 from django.utils import timezone
 from django.utils.functional import cached_property
@@ -23,6 +28,14 @@ import stdnum.isbn
 from .context_processors import matshare_context_processor
 
 
+# Files with these extensions are compressed already and hence stored in ZIP archives
+# without compressing them again
+ZIP_STORED_EXTENSIONS = frozenset(
+    (".7z", ".bz2", ".epub", ".gif", ".gz", ".jpeg", ".jpg", ".mp3", ".mp4", ".png")
+    + (".webm", ".webp", ".xz", ".zip")
+)
+
+
 def basic_auth(func=None, realm="", auth_backend=None, max_header_size=None):
     """View decorator that performs HTTP Basic Authentication against Django."""
     # Simply strip out quotes and backslashes to avoid escaping
@@ -63,6 +76,66 @@ def basic_auth(func=None, realm="", auth_backend=None, max_header_size=None):
     return _basic_auth_wrapper
 
 
+def negotiate_content_encoding(request, available):
+    """Choose the content coding to respond with based on ``Accept-Encoding``.
+
+    ``available`` is a sequence of content codings (like ``"gzip"``) a variant is
+    available for, in order of preference. The first one acceptable with the highest
+    quality value is returned, or ``None`` if the identity coding should be used.
+    """
+    qualities = {}
+    for item in request.META.get("HTTP_ACCEPT_ENCODING", "").split(","):
+        coding, *params = (part.strip() for part in item.split(";"))
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.lower()] = quality
+    best = None
+    best_quality = 0.0
+    for coding in available:
+        quality = qualities.get(coding, qualities.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+def parse_range_header(header, size):
+    """Parse the value of a ``Range`` header for a resource of ``size`` bytes.
+
+    ``(start, length)`` of the requested range is returned, or ``None`` if the
+    header is missing, malformed or requests multiple ranges, in which case the
+    whole resource should be sent.
+
+    :raises ValueError: if the range can't be satisfied
+    """
+    unit, _, spec = (header or "").partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    match = re.fullmatch(r"([0-9]*)-([0-9]*)", spec.strip())
+    if match is None or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = int(last) if last else max(start, size - 1)
+        if start > end:
+            return None
+    else:
+        # Suffix range, i.e. the last N bytes
+        start = max(size - int(last), 0)
+        end = size - 1
+    if start >= size:
+        raise ValueError(f"Range {header!r} not satisfiable for size {size}")
+    return start, min(end, size - 1) - start + 1
+
+
 def parse_ldap_group_query_string(query_string):
     """Parse OpenLDAP search filter-like strings, but for group queries instead.
 
@@ -157,6 +230,64 @@ def rmtree_and_clean(path, clean_up_to):
             break
 
 
+def set_content_disposition(response, filename, as_attachment=True):
+    """Set the Content-Disposition header of ``response`` the way ``FileResponse``
+    does, encoding non-ASCII file names according to RFC 5987.
+    """
+    disposition = "attachment" if as_attachment else "inline"
+    try:
+        filename.encode("ascii")
+        file_expr = f'filename="{filename}"'
+    except UnicodeEncodeError:
+        file_expr = f"filename*=utf-8''{urllib.parse.quote(filename)}"
+    response["Content-Disposition"] = f"{disposition}; {file_expr}"
+
+
+def serve_file(
+    path, content_type=None, filename=None, as_attachment=False, content_encoding=None
+):
+    """Return a response sending the file at ``path``.
+
+    Depending on the ``MS_FILE_OFFLOAD`` setting, only the headers are generated here
+    and the transfer is handed off to nginx, so that no worker is occupied with it.
+    Files outside ``MEDIA_ROOT`` are always sent by MatShare itself, which lets
+    uWSGI's offload threads do the transfer.
+    If ``content_type`` isn't given, it's guessed from ``filename`` or ``path``.
+    ``content_encoding`` has to be given when the file is compressed already.
+
+    :raises OSError: if the file can't be accessed
+    """
+    if content_type is None:
+        content_type, _ = mimetypes.guess_type(filename or path)
+    content_type = content_type or "application/octet-stream"
+    path = os.path.abspath(path)
+    offload = settings.MS_FILE_OFFLOAD
+    if not offload or not path.startswith(settings.MEDIA_ROOT + os.sep):
+        response = FileResponse(
+            open(path, "rb"), as_attachment=as_attachment, filename=filename or ""
+        )
+        # Set afterwards, FileResponse would guess text/html again from path
+        response["Content-Type"] = content_type
+        if content_encoding:
+            response["Content-Encoding"] = content_encoding
+        return response
+    # Fail early, as the webserver would only answer with a 404 itself
+    os.stat(path)
+    response = HttpResponse(content_type=content_type)
+    if content_encoding:
+        response["Content-Encoding"] = content_encoding
+    assert offload == "x-accel-redirect", offload
+    rel_path = os.path.relpath(path, settings.MEDIA_ROOT).replace(os.sep, "/")
+    response[
+        "X-Accel-Redirect"
+    ] = f"{settings.MS_FILE_OFFLOAD_PREFIX}/{urllib.parse.quote(rel_path)}"
+    if filename or as_attachment:
+        set_content_disposition(
+            response, filename or os.path.basename(path), as_attachment
+        )
+    return response
+
+
 def set_consent(request, response, consent_name, consent_given):
     """Update the state for a consent by (re)setting the consent cookie.
 
@@ -192,6 +323,64 @@ def set_consent(request, response, consent_name, consent_given):
         response.set_cookie("consents", value, max_age=60 * 60 * 24 * 365)
 
 
+class _ZipStreamBuffer(io.RawIOBase):
+    """
+    Unseekable file-like object collecting what :class:`zipfile.ZipFile` writes.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._pos = 0
+
+    def pop(self):
+        """Return and forget the data written since the last call."""
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+    def tell(self):
+        return self._pos
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._pos += len(data)
+        return len(data)
+
+
+def stream_zip(members, chunk_size=1024 * 1024):
+    """Generate a ZIP archive on the fly.
+
+    ``members`` has to be an iterable of ``(disk path, name in archive)`` tuples.
+    Chunks of ``bytes`` are yielded as soon as they're ready, so that the archive
+    can be sent while it's being created, e.g. with a
+    :class:`django.http.StreamingHttpResponse`. ZIP64 extensions are used as needed,
+    files listed in ``ZIP_STORED_EXTENSIONS`` are stored uncompressed.
+    """
+    buffer = _ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, mode="w", compression=zipfile.ZIP_DEFLATED) as zip:
+        for path, name in members:
+            info = zipfile.ZipInfo.from_file(path, name)
+            if os.path.splitext(name)[1].lower() in ZIP_STORED_EXTENSIONS:
+                info.compress_type = zipfile.ZIP_STORED
+            else:
+                info.compress_type = zipfile.ZIP_DEFLATED
+            with open(path, "rb") as src, zip.open(info, "w") as dest:
+                for chunk in iter(lambda: src.read(chunk_size), b""):
+                    dest.write(chunk)
+                    # Compressed data may not be available yet
+                    data = buffer.pop()
+                    if data:
+                        yield data
+            # Remaining data and the descriptor of this member
+            yield buffer.pop()
+    # Central directory
+    yield buffer.pop()
+
+
 class IntegerEnumField(models.PositiveSmallIntegerField):
     def __init__(self, enum, *args, exclude=(), **kwargs):
         self.enum = enum
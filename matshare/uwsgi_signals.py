@@ -19,12 +19,14 @@ from django.db import transaction
 # This will also set uwsgi.spooler to uwsgi_tasks's spooler callback during startup
 import uwsgi_tasks
 
+from .course.spooled_tasks import spooled_run_material_builds
 from .models import (
     Course,
     CourseEditorSubscription,
     CourseStudentSubscription,
     EasyAccess,
     MaterialBuild,
+    MaterialBundle,
     NotificationFrequency,
     User,
 )
@@ -89,8 +91,35 @@ def _send_student_notifications(notification_frequency):
 
 @uwsgi_tasks.cron(minute=19)
 def clear_material_builds(_):
-    """Removes material builds of old revisions."""
+    """Removes material builds of old revisions and outdated download archives."""
     MaterialBuild.objects.clear_outdated()
+    MaterialBundle.clear_outdated_archives()
+
+
+@uwsgi_tasks.cron(minute=-1)
+def prebuild_material(_):
+    """Creates background builds of updated material once pre-building is due."""
+    if settings.MS_MATERIAL_PREBUILD:
+        Course.objects.prebuild_material()
+
+
+@uwsgi_tasks.cron(minute=-5)
+def run_material_builds(_):
+    """Queues interrupted builds again and makes sure waiting builds are run.
+
+    Builds are usually run as soon as they're queued. This catches those that were
+    interrupted or skipped due to the concurrency limit when nothing else was left.
+    """
+    MaterialBuild.objects.requeue_interrupted()
+    if MaterialBuild.objects.filter(status=MaterialBuild.Status.waiting).exists():
+        spooled_run_material_builds()
+
+
+@uwsgi_tasks.cron(minute=49)
+def maintain_repositories(_):
+    """Packs the objects of course repositories that have changed."""
+    if settings.MS_GIT_MAINTENANCE_MAX_REPOS:
+        Course.objects.maintain_repositories()
 
 
 @uwsgi_tasks.cron(hour=2, minute=29)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark for committing uploads and deletions of sources.
+
+It creates a temporary repository with a large sources directory, then compares
+adding and removing a handful of files with ``ContentBrowser``, which reads the
+whole tree into an index, and ``TreeEditor``, which only rewrites the trees along
+the changed paths. Run it like:
+
+    python scripts/benchmark_tree_editor.py
+"""
+
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import pygit2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from matshare.git.utils import ContentBrowser, TreeEditor
+
+
+NUM_DIRECTORIES = 50
+FILES_PER_DIRECTORY = 400
+FILES_PER_CHANGE = 10
+REPEAT = 10
+REF = "refs/heads/main"
+SIG = pygit2.Signature("Benchmark", "benchmark@invalid")
+
+
+def populate(repo_path):
+    print(
+        f"Creating repository with {NUM_DIRECTORIES * FILES_PER_DIRECTORY} files in "
+        f"{NUM_DIRECTORIES} directories"
+    )
+    repo = pygit2.init_repository(repo_path, bare=True)
+    browser = ContentBrowser(repo)
+    for dir_idx in range(NUM_DIRECTORIES):
+        for idx in range(FILES_PER_DIRECTORY):
+            browser.add_from_bytes(
+                f"src/d{dir_idx:02d}/f{idx:04d}.pdf", f"{dir_idx}/{idx}".encode()
+            )
+    browser.commit(SIG, "Benchmark", REF)
+    return repo
+
+
+def change(cls, repo, run):
+    """Commit some new files, then remove them again."""
+    paths = [f"src/d00/new{run}-{idx}.pdf" for idx in range(FILES_PER_CHANGE)]
+    editor = cls(repo, REF)
+    for path in paths:
+        editor.add_from_bytes(path, path.encode())
+    editor.commit(SIG, "Sources added", REF)
+    editor = cls(repo, REF)
+    for path in paths:
+        editor.remove(path)
+    editor.commit(SIG, "Sources deleted", REF)
+
+
+def measure(cls, repo):
+    """Return durations in milliseconds of adding and removing files."""
+    durations = []
+    for run in range(REPEAT):
+        start = time.perf_counter()
+        change(cls, repo, run)
+        durations.append((time.perf_counter() - start) * 1000)
+    return durations
+
+
+def main():
+    base_dir = tempfile.mkdtemp()
+    try:
+        repo = populate(os.path.join(base_dir, "repo.git"))
+        initial_tree_id = repo.references[REF].peel(pygit2.Commit).tree.id
+        for label, cls in (
+            ("ContentBrowser (whole index)", ContentBrowser),
+            ("TreeEditor (changed trees only)", TreeEditor),
+        ):
+            durations = measure(cls, repo)
+            print(
+                f"{label}: {len(durations)} runs, "
+                f"median {statistics.median(durations):.2f} ms, "
+                f"max {max(durations):.2f} ms"
+            )
+            # Both must end up where they started
+            tree_id = repo.references[REF].peel(pygit2.Commit).tree.id
+            assert tree_id == initial_tree_id, "Tree differs"
+    finally:
+        shutil.rmtree(base_dir)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
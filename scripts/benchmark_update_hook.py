@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark for the ACL check of the ``update`` git hook.
+
+It creates a temporary repository with a large sources directory and pushes of 1,
+100 and 1000 commits, each changing one source file, then compares the former
+check, which diffed every commit with its parent, with the current one, which
+diffs the old and new commit once. The wall time of running the whole hook is
+measured as well. Run it like:
+
+    python scripts/benchmark_update_hook.py
+"""
+
+import importlib.machinery
+import importlib.util
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import pygit2
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from matshare.git import utils as git_utils
+
+
+HOOK_PATH = os.path.join(BASE_DIR, "git_hooks", "update")
+
+NUM_DIRECTORIES = 40
+FILES_PER_DIRECTORY = 250
+PUSH_SIZES = (1, 100, 1000)
+REPEAT = 3
+REF = "refs/heads/main"
+SIG = pygit2.Signature("Benchmark", "benchmark@invalid")
+# Typical ACL of an editor
+ACL = [("edit/*", True), ("src/*", True), (".*", False)]
+
+
+def load_hook():
+    """Import the update hook, which has no .py suffix, as module."""
+    loader = importlib.machinery.SourceFileLoader("update_hook", HOOK_PATH)
+    spec = importlib.util.spec_from_loader(loader.name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+def check_by_commits(repo, old_commit, new_commit, check_access):
+    """The former check of the update hook, returning the violations."""
+    violations = []
+    for parent, child in git_utils.walk_pairwise(repo, new_commit):
+        for delta in parent.tree.diff_to_tree(child.tree).deltas:
+            if not check_access(delta.new_file.path):
+                violations.append((child.short_id, delta.status, delta.new_file.path))
+        if parent.id == old_commit.id:
+            return violations
+    raise AssertionError("Force-push")
+
+
+def check_current(repo, old_commit, new_commit, check_access, hook):
+    # The hook runs git in the repository, which is the working directory
+    old_rev, new_rev = old_commit.id.hex, new_commit.id.hex
+    assert hook.is_fast_forward(old_rev, new_rev), "Force-push"
+    return hook.find_violations(old_rev, new_rev, check_access)
+
+
+def run_hook(repo, old_commit, new_commit):
+    """Run the update hook like git does when receiving a push."""
+    subprocess.run(
+        (HOOK_PATH, REF, old_commit.id.hex, new_commit.id.hex),
+        cwd=repo.path,
+        env={
+            **os.environ,
+            "MS_GIT_AUTH": "benchmark:"
+            + json.dumps({"acl": [[REF, *rule] for rule in ACL]}),
+        },
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=True,
+    )
+
+
+def populate(repo_path):
+    print(
+        f"Creating repository with {NUM_DIRECTORIES * FILES_PER_DIRECTORY} sources "
+        f"and {sum(PUSH_SIZES)} commits"
+    )
+    repo = pygit2.init_repository(repo_path, bare=True)
+    editor = git_utils.TreeEditor(repo)
+    editor.add_from_bytes("edit/k01/k01.md", b"# Chapter 1\n")
+    for dir_idx in range(NUM_DIRECTORIES):
+        for idx in range(FILES_PER_DIRECTORY):
+            editor.add_from_bytes(
+                f"src/d{dir_idx:02d}/f{idx:04d}.pdf", f"{dir_idx}/{idx}".encode()
+            )
+    editor.commit(SIG, "Initial", REF)
+    # Pairs of old and new commit for every push
+    pushes = []
+    for push_size in PUSH_SIZES:
+        old_commit = repo.references[REF].peel(pygit2.Commit)
+        for idx in range(push_size):
+            editor.add_from_bytes(
+                f"src/d{idx % NUM_DIRECTORIES:02d}/f{idx % FILES_PER_DIRECTORY:04d}.pdf",
+                f"{push_size}/{idx}".encode(),
+            )
+            editor.commit(SIG, "Change", REF)
+        pushes.append((old_commit, repo.references[REF].peel(pygit2.Commit)))
+    return repo, pushes
+
+
+def measure(func, *args):
+    """Return durations in milliseconds."""
+    durations = []
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        func(*args)
+        durations.append((time.perf_counter() - start) * 1000)
+    return durations
+
+
+def main():
+    hook = load_hook()
+    base_dir = tempfile.mkdtemp()
+    try:
+        repo, pushes = populate(os.path.join(base_dir, "repo.git"))
+        os.chdir(repo.path)
+        for push_size, (old_commit, new_commit) in zip(PUSH_SIZES, pushes):
+            print()
+            print(f"Push of {push_size} commits")
+            for label, func, args in (
+                ("Diff per commit", check_by_commits, ()),
+                ("Single diff", check_current, (hook,)),
+            ):
+                # Every hook invocation starts with an empty cache
+                durations = measure(
+                    lambda: func(
+                        repo,
+                        old_commit,
+                        new_commit,
+                        hook.make_access_checker(ACL),
+                        *args,
+                    )
+                )
+                print(
+                    f"    {label}: {len(durations)} runs, "
+                    f"median {statistics.median(durations):.2f} ms, "
+                    f"max {max(durations):.2f} ms"
+                )
+            durations = measure(run_hook, repo, old_commit, new_commit)
+            print(
+                f"    Whole hook process: {len(durations)} runs, "
+                f"median {statistics.median(durations):.2f} ms, "
+                f"max {max(durations):.2f} ms"
+            )
+
+        # Both must find the same violations when pushing with a restrictive ACL
+        old_commit, new_commit = pushes[1]
+        check_access = hook.make_access_checker([("edit/*", True)])
+        expected = [
+            (commit_id, path)
+            for commit_id, status, path in check_by_commits(
+                repo, old_commit, new_commit, check_access
+            )
+        ]
+        violations = [
+            (commit_id, path)
+            for commit_id, status, path in check_current(
+                repo, old_commit, new_commit, check_access, hook
+            )
+        ]
+        assert (
+            violations and violations == expected[: len(violations)]
+        ), "Violations differ"
+    finally:
+        shutil.rmtree(base_dir)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
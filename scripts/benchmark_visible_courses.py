@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark for ``Course.objects.visible()``.
+
+It fills the database with 10,000 courses and 50,000 users inside a transaction
+that is rolled back afterwards, then compares the query plans and timings of the
+former JOIN-based filter (which required ``distinct()``) with the current one.
+Run it against a PostgreSQL database, like:
+
+    DJANGO_SETTINGS_MODULE=matshare.settings python scripts/benchmark_visible_courses.py
+"""
+
+import random
+import statistics
+import sys
+import time
+
+import django
+
+django.setup()
+
+from django.db import transaction
+from django.db.models import Q
+
+from matshare.models import (
+    Course,
+    CourseEditorSubscription,
+    CourseStudentSubscription,
+    CourseType,
+    StudyCourse,
+    User,
+)
+
+
+NUM_COURSES = 10000
+NUM_USERS = 50000
+NUM_STUDY_COURSES = 50
+SUBSCRIPTIONS_PER_USER = 5
+# Every this many users is editor of some courses
+EDITOR_EVERY = 25
+COURSES_PER_EDITOR = 4
+# Users to sample and repetitions per user
+SAMPLE_USERS = 20
+REPEAT = 5
+# Simulate the first page of the course directory
+PAGE_SIZE = 20
+
+
+def visible_with_joins(user):
+    """The former implementation of ``CourseQuerySet.visible``."""
+    return Course.objects.filter(
+        Q(metadata_audience__lte=Course.Audience.users)
+        | Q(metadata_audience=Course.Audience.study_course)
+        & Q(study_course__students__in=(user,))
+        | Q(editors__in=(user,))
+        | Q(students__in=(user,))
+    ).distinct()
+
+
+def visible_with_subqueries(user):
+    return Course.objects.visible(user)
+
+
+def populate(rnd):
+    print("Creating", NUM_STUDY_COURSES, "courses of study")
+    study_courses = StudyCourse.objects.bulk_create(
+        StudyCourse(name=f"Study course {i}", slug=f"bench-sc-{i}")
+        for i in range(NUM_STUDY_COURSES)
+    )
+    course_type = CourseType.objects.create(name="Benchmark", slug="bench")
+
+    print("Creating", NUM_COURSES, "courses")
+    audiences = tuple(Course.Audience)
+    courses = Course.objects.bulk_create(
+        (
+            Course(
+                name=f"Course {i}",
+                slug=f"bench-{i}",
+                study_course=rnd.choice(study_courses),
+                type=course_type,
+                # Most courses are restricted to some degree
+                metadata_audience=rnd.choices(audiences, (1, 1, 3, 5))[0],
+                is_static=True,
+            )
+            for i in range(NUM_COURSES)
+        ),
+        batch_size=1000,
+    )
+
+    print("Creating", NUM_USERS, "users")
+    users = User.objects.bulk_create(
+        (
+            User(
+                username=f"bench-{i}",
+                email=f"bench-{i}@invalid",
+                first_name="Bench",
+                last_name=str(i),
+                password="!",
+            )
+            for i in range(NUM_USERS)
+        ),
+        batch_size=1000,
+    )
+
+    print("Creating memberships and subscriptions")
+    User.study_courses.through.objects.bulk_create(
+        (
+            User.study_courses.through(user=user, studycourse=rnd.choice(study_courses))
+            for user in users
+        ),
+        batch_size=5000,
+    )
+    CourseStudentSubscription.objects.bulk_create(
+        (
+            CourseStudentSubscription(user=user, course=course)
+            for user in users
+            for course in rnd.sample(courses, SUBSCRIPTIONS_PER_USER)
+        ),
+        batch_size=5000,
+    )
+    CourseEditorSubscription.objects.bulk_create(
+        (
+            CourseEditorSubscription(user=user, course=course)
+            for user in users[::EDITOR_EVERY]
+            for course in rnd.sample(courses, COURSES_PER_EDITOR)
+        ),
+        batch_size=5000,
+    )
+    return users
+
+
+def measure(func, users):
+    """Return per-query durations in milliseconds for a directory page and count."""
+    durations = []
+    for user in users:
+        for _ in range(REPEAT):
+            start = time.perf_counter()
+            qs = func(user).order_by("name")
+            list(qs[:PAGE_SIZE])
+            qs.count()
+            durations.append((time.perf_counter() - start) * 1000)
+    return durations
+
+
+def main():
+    rnd = random.Random(0)
+    with transaction.atomic():
+        users = populate(rnd)
+        with transaction.get_connection().cursor() as cursor:
+            cursor.execute("ANALYZE")
+        sample = rnd.sample(users, SAMPLE_USERS)
+
+        for user in sample:
+            assert set(visible_with_joins(user).values_list("pk", flat=True)) == set(
+                visible_with_subqueries(user).values_list("pk", flat=True)
+            ), f"Results differ for {user!r}"
+
+        for label, func in (
+            ("JOINs + DISTINCT", visible_with_joins),
+            ("IN subqueries", visible_with_subqueries),
+        ):
+            print()
+            print("=" * 79)
+            print(label)
+            print("=" * 79)
+            print(func(sample[0]).order_by("name")[:PAGE_SIZE].explain(analyze=True))
+            durations = measure(func, sample)
+            print()
+            print(
+                f"{len(durations)} runs: "
+                f"median {statistics.median(durations):.2f} ms, "
+                f"max {max(durations):.2f} ms"
+            )
+
+        # Leave the database as it was
+        transaction.set_rollback(True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark for ``ContentBrowser.write_to_fs()``.
+
+It creates a temporary repository resembling a large course, with Markdown files in
+the edit directory, hundreds of images and some sources, then compares the former
+implementation, which iterated over the whole index, with the current one and
+libgit2's native checkout. Only the edit directory is written, as for building.
+Run it like:
+
+    python scripts/benchmark_write_to_fs.py
+"""
+
+import os
+import posixpath
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import pygit2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from matshare.git.utils import ContentBrowser
+
+
+NUM_CHAPTERS = 40
+IMAGES_PER_CHAPTER = 15
+IMAGE_SIZE = 200 * 1024
+NUM_SOURCE_FILES = 300
+SOURCE_FILE_SIZE = 500 * 1024
+REPEAT = 5
+PREFIX = "edit"
+
+
+def write_to_fs_by_index(browser, dest_dir, prefix=""):
+    """The former implementation of ``ContentBrowser.write_to_fs``."""
+    prefix = posixpath.normpath(prefix)
+    for entry in browser.index:
+        if entry.mode not in (
+            pygit2.GIT_FILEMODE_BLOB,
+            pygit2.GIT_FILEMODE_BLOB_EXECUTABLE,
+        ):
+            continue
+        if (
+            prefix != "."
+            and entry.path != prefix
+            and not entry.path.startswith(prefix + "/")
+        ):
+            continue
+        if prefix == entry.path:
+            rel_path = prefix
+        else:
+            rel_path = posixpath.relpath(entry.path, prefix)
+        path = os.path.normpath(os.path.join(dest_dir, rel_path))
+        try:
+            os.makedirs(os.path.dirname(path))
+        except FileExistsError:
+            pass
+        with open(path, "wb") as file:
+            file.write(browser.repo[entry.id].read_raw())
+        os.chmod(path, entry.mode)
+
+
+def write_to_fs_by_checkout(browser, dest_dir, prefix=""):
+    """libgit2's checkout of the subtree into a target directory."""
+    tree = browser.repo[browser.index.write_tree(browser.repo)]
+    browser.repo.checkout_tree(
+        tree[prefix],
+        directory=dest_dir,
+        strategy=pygit2.GIT_CHECKOUT_FORCE | pygit2.GIT_CHECKOUT_DONT_UPDATE_INDEX,
+    )
+
+
+def write_to_fs_current(browser, dest_dir, prefix=""):
+    browser.write_to_fs(dest_dir, prefix)
+
+
+def populate(rnd, repo_path):
+    print(
+        f"Creating repository with {NUM_CHAPTERS} chapters, "
+        f"{NUM_CHAPTERS * IMAGES_PER_CHAPTER} images and {NUM_SOURCE_FILES} sources"
+    )
+    repo = pygit2.init_repository(repo_path, bare=True)
+    browser = ContentBrowser(repo)
+    for chapter in range(NUM_CHAPTERS):
+        chapter_dir = f"{PREFIX}/k{chapter:02d}"
+        paragraphs = "\n\n".join(
+            f"Paragraph {idx} ![image](bilder/{idx:02d}.png)"
+            for idx in range(IMAGES_PER_CHAPTER)
+        )
+        browser.add_from_bytes(
+            f"{chapter_dir}/k{chapter:02d}.md",
+            f"# Chapter {chapter}\n\n{paragraphs}\n".encode(),
+        )
+        for idx in range(IMAGES_PER_CHAPTER):
+            browser.add_from_bytes(
+                f"{chapter_dir}/bilder/{idx:02d}.png",
+                rnd.getrandbits(8 * IMAGE_SIZE).to_bytes(IMAGE_SIZE, "little"),
+            )
+    for idx in range(NUM_SOURCE_FILES):
+        browser.add_from_bytes(
+            f"sources/scan{idx:03d}.pdf",
+            rnd.getrandbits(8 * SOURCE_FILE_SIZE).to_bytes(SOURCE_FILE_SIZE, "little"),
+        )
+    browser.commit(
+        pygit2.Signature("Benchmark", "benchmark@invalid"),
+        "Benchmark",
+        "refs/heads/main",
+    )
+    return repo
+
+
+def measure(func, browser, base_dir):
+    """Return durations in milliseconds of writing to fresh directories."""
+    durations = []
+    for idx in range(REPEAT):
+        dest_dir = os.path.join(base_dir, f"{func.__name__}-{idx}")
+        start = time.perf_counter()
+        func(browser, dest_dir, PREFIX)
+        durations.append((time.perf_counter() - start) * 1000)
+    return durations
+
+
+def main():
+    rnd = random.Random(0)
+    base_dir = tempfile.mkdtemp()
+    try:
+        repo = populate(rnd, os.path.join(base_dir, "repo.git"))
+        browser = ContentBrowser(repo, "refs/heads/main")
+
+        outputs = []
+        for label, func in (
+            ("Iterating the whole index", write_to_fs_by_index),
+            ("libgit2 checkout", write_to_fs_by_checkout),
+            ("Tree walk with threaded writes", write_to_fs_current),
+        ):
+            durations = measure(func, browser, base_dir)
+            print(
+                f"{label}: {len(durations)} runs, "
+                f"median {statistics.median(durations):.2f} ms, "
+                f"max {max(durations):.2f} ms"
+            )
+            outputs.append(os.path.join(base_dir, f"{func.__name__}-0"))
+
+        # All variants must produce the same files
+        listings = []
+        for output in outputs:
+            listing = set()
+            for dirpath, dirnames, filenames in os.walk(output):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    with open(path, "rb") as file:
+                        listing.add((os.path.relpath(path, output), file.read()))
+            listings.append(listing)
+        assert all(listing == listings[0] for listing in listings), "Outputs differ"
+    finally:
+        shutil.rmtree(base_dir)
+
+
+if __name__ == "__main__":
+    sys.exit(main())